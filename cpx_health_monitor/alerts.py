@@ -0,0 +1,358 @@
+import bisect
+import json
+import logging
+import math
+import time
+
+from collections import defaultdict, deque
+from typing import Any, Callable, Deque, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import click
+import requests
+
+from cpx_health_monitor.exceptions import CPXHealthMonitorException
+from cpx_health_monitor.metrics import MetricSchema, default_metrics
+
+LOG = logging.getLogger(__name__)
+
+
+class AlertingException(CPXHealthMonitorException):
+    pass
+
+
+class InvalidAlertRuleError(AlertingException, ValueError):
+    pass
+
+
+SCOPE_INSTANCE = "instance"
+SCOPE_SERVICE = "service"
+
+STATE_FIRING = "firing"
+STATE_RESOLVED = "resolved"
+
+_COUNT_METRICS = ("total_instances", "healthy_instances", "unhealthy_instances")
+
+
+class Alert(NamedTuple):
+    rule: str
+    scope: str
+    key: str
+    metric: str
+    value: Any
+    state: str
+    timestamp: float
+
+    def to_dict(self) -> Dict[str, Any]:
+        return self._asdict()
+
+    def __str__(self) -> str:
+        s = f"[{self.state.upper()}] {self.rule}: {self.scope} {self.key}"
+        if self.value is not None:
+            s += f" {self.metric}={self.value}"
+        return s
+
+
+class _Signal:
+    """
+    A value derived once per key and sweep (e.g. the p95 CPU usage of an instance over
+    the last 10 sweeps), shared by all the rules that test it.
+
+    Thresholds of the rules are kept sorted so that finding the matching rules costs
+    a binary search rather than one comparison per rule.
+    """
+
+    def __init__(
+        self, metric: str, window: int, percentile: Optional[float], parse: Optional[Callable[[Any], Any]] = None
+    ) -> None:
+        self.metric = metric
+        self.parse = parse
+        self.window = window
+        self.percentile = percentile
+        self._above: List[Tuple[float, str]] = []
+        self._below: List[Tuple[float, str]] = []
+        self._equals: Dict[str, List[str]] = defaultdict(list)
+        self._windows: Dict[str, Deque[float]] = {}
+
+    def add_rule(self, name: str, rule: Dict[str, Any]) -> None:
+        if "above" in rule:
+            bisect.insort(self._above, (float(rule["above"]), name))
+        if "below" in rule:
+            bisect.insort(self._below, (float(rule["below"]), name))
+        if "equals" in rule:
+            self._equals[str(rule["equals"]).lower()].append(name)
+
+    def value(self, key: str, raw: Any) -> Any:
+        if self.metric == "status":
+            return raw
+        value = self.parse(raw) if self.parse is not None else raw
+        if value is None or self.window <= 1:
+            return value
+
+        samples = self._windows.get(key)
+        if samples is None:
+            samples = self._windows[key] = deque(maxlen=self.window)
+        samples.append(value)
+        if self.percentile is None:
+            return sum(samples) / len(samples)
+
+        ordered = sorted(samples)
+        rank = max(math.ceil(self.percentile / 100 * len(ordered)) - 1, 0)
+        return ordered[rank]
+
+    def matches(self, value: Any) -> Iterable[str]:
+        if self.metric == "status":
+            return self._equals.get(str(value).lower(), ())
+
+        matched = []
+        if self._above:
+            # Rules whose threshold is strictly below the value.
+            end = bisect.bisect_left(self._above, (value,))
+            matched.extend(name for _, name in self._above[:end])
+        if self._below:
+            start = bisect.bisect_right(self._below, (value, chr(0x10FFFF)))
+            matched.extend(name for _, name in self._below[start:])
+        matched.extend(self._equals.get(str(value).lower(), ()))
+        return matched
+
+    def forget(self, keys: Iterable[str]) -> None:
+        for key in keys:
+            self._windows.pop(key, None)
+
+
+def _signal_key(rule: Dict[str, Any]) -> Tuple[str, str, int, Optional[float]]:
+    return (
+        rule.get("scope", SCOPE_INSTANCE),
+        rule["metric"],
+        int(rule.get("window", 1)),
+        rule.get("percentile"),
+    )
+
+
+def _validate_rule(rule: Dict[str, Any], schema: MetricSchema) -> None:
+    name = rule.get("name")
+    if not name:
+        raise InvalidAlertRuleError("alert rules must have a name")
+
+    scope = rule.get("scope", SCOPE_INSTANCE)
+    metrics = ("status",) + tuple(metric.name for metric in schema.metrics)
+    if scope == SCOPE_SERVICE:
+        metrics += _COUNT_METRICS
+    elif scope != SCOPE_INSTANCE:
+        raise InvalidAlertRuleError(f"rule '{name}': invalid scope '{scope}'")
+
+    metric = rule.get("metric")
+    if metric not in metrics:
+        raise InvalidAlertRuleError(
+            f"rule '{name}': invalid metric '{metric}' for scope '{scope}'"
+        )
+    if metric == "status" and set(rule) & {"above", "below", "window", "percentile"}:
+        raise InvalidAlertRuleError(f"rule '{name}': status can only be tested with 'equals'")
+    if not set(rule) & {"above", "below", "equals"}:
+        raise InvalidAlertRuleError(f"rule '{name}': missing 'above', 'below' or 'equals'")
+
+
+class AlertEngine:
+    """
+    Evaluates alert rules against every sweep of the fleet.
+
+    Rules are compiled once into signals shared by all rules testing the same
+    scope, metric and window, so that each instance and service is processed once
+    per signal regardless of the number of rules. An alert is emitted when a rule
+    starts firing (after matching for the configured number of consecutive sweeps)
+    and when it resolves, never on every sweep in between.
+
+    Methods:
+        evaluate(instances: List[Dict[str, Dict[str, str]]], services: List[Dict[str, Dict[str, Any]]])
+            -> List[Alert]: Evaluates the rules against a sweep and dispatches the resulting alerts.
+    """
+
+    def __init__(
+        self,
+        rules: List[Dict[str, Any]],
+        sinks: Optional[List[Callable[[Alert], None]]] = None,
+        metrics: Optional[MetricSchema] = None,
+    ) -> None:
+        """
+        Compiles the alert rules.
+
+        Args:
+            rules (List[Dict[str, Any]]): The rules, as found in the alerts section of the config.
+            sinks (List[Callable[[Alert], None]], optional): Where alerts are dispatched to.
+            metrics (MetricSchema, optional): The metrics rules can test besides the status and
+                instance counts, e.g. CPXMonitor.metrics. Defaults to CPU and memory usage.
+        """
+        if metrics is None:
+            metrics = MetricSchema(default_metrics())
+        self._sinks = sinks or []
+        self._for: Dict[str, int] = {}
+        self._signals: Dict[str, List[_Signal]] = {SCOPE_INSTANCE: [], SCOPE_SERVICE: []}
+        self._metrics: Dict[str, str] = {}
+
+        signals = {}
+        for rule in rules:
+            _validate_rule(rule, metrics)
+            name = rule["name"]
+            if name in self._for:
+                raise InvalidAlertRuleError(f"duplicate alert rule '{name}'")
+            self._for[name] = max(int(rule.get("for", 1)), 1)
+            self._metrics[name] = rule["metric"]
+
+            key = _signal_key(rule)
+            if key not in signals:
+                parse = metrics.parser(key[1]) if key[1] in metrics else None
+                signals[key] = _Signal(key[1], key[2], key[3], parse)
+                self._signals[key[0]].append(signals[key])
+            signals[key].add_rule(name, rule)
+
+        # Number of consecutive sweeps each (rule, scope, key) has been matching for.
+        self._matching: Dict[Tuple[str, str, str], int] = {}
+        self._keys: Dict[str, set] = {SCOPE_INSTANCE: set(), SCOPE_SERVICE: set()}
+
+    def __len__(self) -> int:
+        return len(self._for)
+
+    @property
+    def tracked_keys(self) -> int:
+        """
+        The number of instances and services the engine keeps state for.
+        """
+        return sum(len(keys) for keys in self._keys.values())
+
+    def _evaluate_scope(
+        self,
+        scope: str,
+        items: List[Dict[str, Dict[str, Any]]],
+        matching: Dict[Tuple[str, str, str], Tuple[int, Any]],
+    ) -> None:
+        signals = self._signals[scope]
+        if not signals:
+            return
+
+        keys = set()
+        for item in items:
+            for key, stats in item.items():
+                keys.add(key)
+                for signal in signals:
+                    raw = stats.get(signal.metric)
+                    if raw is None:
+                        # Not reported by this instance, or not estimated for this service.
+                        continue
+                    value = signal.value(key, raw)
+                    if value is None:
+                        continue
+                    for name in signal.matches(value):
+                        state = (name, scope, key)
+                        matching[state] = (self._matching.get(state, 0) + 1, value)
+
+        gone = self._keys[scope] - keys
+        if gone:
+            for signal in signals:
+                signal.forget(gone)
+        self._keys[scope] = keys
+
+    def evaluate(
+        self,
+        instances: List[Dict[str, Dict[str, str]]],
+        services: Optional[List[Dict[str, Dict[str, Any]]]] = None,
+        timestamp: Optional[float] = None,
+    ) -> List[Alert]:
+        """
+        Evaluates the rules against a sweep and dispatches the resulting alerts to the sinks.
+
+        Args:
+            instances (List[Dict[str, Dict[str, str]]]): The result of CPXMonitor.get_stats.
+            services (List[Dict[str, Dict[str, Any]]], optional): The result of CPXMonitor.get_services.
+            timestamp (float, optional): When the sweep happened. Defaults to now.
+
+        Returns:
+            The alerts that started firing or resolved with this sweep.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+
+        matching: Dict[Tuple[str, str, str], Tuple[int, Any]] = {}
+        self._evaluate_scope(SCOPE_INSTANCE, instances, matching)
+        self._evaluate_scope(SCOPE_SERVICE, services or [], matching)
+
+        alerts = []
+        for (name, scope, key), (count, value) in matching.items():
+            if count == self._for[name]:
+                alerts.append(
+                    Alert(name, scope, key, self._metrics[name], value, STATE_FIRING, timestamp)
+                )
+        for (name, scope, key), count in self._matching.items():
+            if (name, scope, key) not in matching and count >= self._for[name]:
+                alerts.append(
+                    Alert(name, scope, key, self._metrics[name], None, STATE_RESOLVED, timestamp)
+                )
+
+        self._matching = {state: count for state, (count, _) in matching.items()}
+
+        for alert in alerts:
+            for sink in self._sinks:
+                try:
+                    sink(alert)
+                except Exception:
+                    LOG.exception("failed to dispatch alert %s", alert)
+
+        return alerts
+
+
+class StdoutSink:
+    def __call__(self, alert: Alert) -> None:
+        click.echo(str(alert))
+
+
+class FileSink:
+    """
+    Appends alerts to a file, one JSON document per line.
+    """
+
+    def __init__(self, path: str) -> None:
+        self._path = path
+
+    def __call__(self, alert: Alert) -> None:
+        with open(self._path, "at") as f:
+            f.write(json.dumps(alert.to_dict()) + "\n")
+
+
+class WebhookSink:
+    """
+    POSTs alerts as JSON documents to a webhook.
+    """
+
+    def __init__(self, url: str, timeout: float = 5.0) -> None:
+        self._url = url
+        self._timeout = timeout
+
+    def __call__(self, alert: Alert) -> None:
+        response = requests.post(self._url, json=alert.to_dict(), timeout=self._timeout)
+        response.raise_for_status()
+
+
+_SINKS = {
+    "stdout": lambda config: StdoutSink(),
+    "file": lambda config: FileSink(config["path"]),
+    "webhook": lambda config: WebhookSink(config["url"], config.get("timeout", 5.0)),
+}
+
+
+def build_alert_engine(config: Dict[str, Any], metrics: Optional[MetricSchema] = None) -> AlertEngine:
+    """
+    Builds an alert engine from the alerts section of the config.
+
+    Args:
+        config (Dict[str, Any]): The alerts section of the config.
+        metrics (MetricSchema, optional): The metrics rules can test, e.g. CPXMonitor.metrics.
+
+    Returns:
+        The alert engine.
+    """
+    sinks = []
+    for sink in config.get("sinks", []):
+        factory = _SINKS.get(sink.get("type"))
+        if factory is None:
+            raise InvalidAlertRuleError(f"invalid alert sink type '{sink.get('type')}'")
+        sinks.append(factory(sink))
+
+    return AlertEngine(config.get("rules", []), sinks, metrics)
@@ -0,0 +1,385 @@
+import asyncio
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, NamedTuple, Optional
+
+from cpx_health_monitor.classmodules import CPXMonitor, _parse_percentage
+from cpx_health_monitor.config import get_config
+from cpx_health_monitor.events import ChangeEvent, iter_events
+from cpx_health_monitor.exceptions import CPXHealthMonitorException
+from cpx_health_monitor.metrics import MetricSchema
+
+
+class MonitorClosedError(CPXHealthMonitorException, RuntimeError):
+    pass
+
+
+class InstanceStats(NamedTuple):
+    ip: str
+    service: str
+    cpu: int
+    memory: int
+    status: str
+    # The metrics declared besides CPU and memory usage (see monitor.metrics), by name.
+    # Not mutated, so the default can be shared.
+    extra: Dict[str, float] = {}
+
+    @property
+    def healthy(self) -> bool:
+        return self.status == "Healthy"
+
+    @classmethod
+    def from_dict(cls, ip: str, stats: Dict[str, str], metrics: Optional[MetricSchema] = None) -> "InstanceStats":
+        return cls(
+            ip,
+            stats["service"],
+            _parse_percentage(stats["cpu"]),
+            _parse_percentage(stats["memory"]),
+            stats["status"],
+            metrics.extra_values(stats) if metrics is not None and metrics.extra else {},
+        )
+
+
+class ServiceStats(NamedTuple):
+    name: str
+    cpu: int
+    memory: int
+    status: str
+    total_instances: int
+    healthy_instances: int
+    unhealthy_instances: int
+    # Only set for estimates from a sample of the fleet, see CPXMonitor.iter_service_estimates.
+    cpu_margin: Optional[float] = None
+    memory_margin: Optional[float] = None
+    sampled_instances: Optional[int] = None
+    estimated: bool = False
+    # The aggregates of the metrics declared besides CPU and memory usage, by name.
+    extra: Dict[str, float] = {}
+
+    @property
+    def healthy(self) -> bool:
+        return self.status == "Healthy"
+
+    @classmethod
+    def from_dict(cls, name: str, stats: Dict[str, Any], metrics: Optional[MetricSchema] = None) -> "ServiceStats":
+        return cls(
+            name,
+            _parse_percentage(stats["cpu"]),
+            _parse_percentage(stats["memory"]),
+            stats["status"],
+            stats["total_instances"],
+            stats["healthy_instances"],
+            stats["unhealthy_instances"],
+            stats.get("cpu_margin"),
+            stats.get("memory_margin"),
+            stats.get("sampled_instances"),
+            stats.get("estimated", False),
+            metrics.extra_values(stats, aggregates=True) if metrics is not None and metrics.extra else {},
+        )
+
+
+class Snapshot(NamedTuple):
+    timestamp: float
+    instances: List[InstanceStats]
+    services: List[ServiceStats]
+
+    @classmethod
+    def from_stats(
+        cls,
+        timestamp: float,
+        instances: List[Dict[str, Dict[str, str]]],
+        services: List[Dict[str, Dict[str, Any]]],
+        metrics: Optional[MetricSchema] = None,
+    ) -> "Snapshot":
+        """
+        Creates a snapshot from the results of CPXMonitor.get_stats and CPXMonitor.get_services,
+        with the extra metrics of the schema, e.g. CPXMonitor.metrics.
+        """
+        return cls(timestamp, _instances(instances, metrics), _services(services, metrics))
+
+
+def _instances(stats: List[Dict[str, Dict[str, str]]], metrics: Optional[MetricSchema] = None) -> List[InstanceStats]:
+    return [
+        InstanceStats.from_dict(ip, instance, metrics)
+        for instance_stats in stats
+        for ip, instance in instance_stats.items()
+    ]
+
+
+def _services(stats: List[Dict[str, Dict[str, Any]]], metrics: Optional[MetricSchema] = None) -> List[ServiceStats]:
+    return sorted(
+        (
+            ServiceStats.from_dict(name, service, metrics)
+            for service_stats in stats
+            for name, service in service_stats.items()
+        ),
+        key=lambda service: service.name,
+    )
+
+
+class Monitor:
+    """
+    Polls the CPX API in-process and returns typed results, for services embedding
+    the health monitor instead of running the cpxstat CLI.
+
+    The monitor owns the connection and thread pools of the underlying CPXMonitor,
+    and releases them when closed, e.g. when leaving a with block:
+
+        with Monitor.from_config() as monitor:
+            for service in monitor.services():
+                print(service.name, service.status)
+
+    Methods:
+        instances(service: str=None, status: str=None) -> List[InstanceStats]: Sweeps the fleet.
+        instance(ip: str) -> InstanceStats: Retrieves the statistics of a single instance.
+        services(sample: float=None) -> List[ServiceStats]: Sweeps the fleet and aggregates it by service.
+        snapshot() -> Snapshot: Sweeps the fleet once for both instance and service statistics.
+        watch(interval: float=1.0, count: int=None) -> Iterator[Snapshot]: Snapshots the fleet periodically.
+        events(interval: float=1.0) -> Iterator[ChangeEvent]: Streams the changes between sweeps.
+        close() -> None: Releases the connection and thread pools.
+    """
+
+    def __init__(self, cpx_monitor: Optional[CPXMonitor] = None, **kwargs) -> None:
+        """
+        Initializes a new instance of the Monitor class.
+
+        Args:
+            cpx_monitor (CPXMonitor, optional): The monitor to poll with, e.g. a ReplayMonitor.
+                The Monitor takes ownership of it and closes it when closed.
+            **kwargs: Arguments of the CPXMonitor created when cpx_monitor isn't given.
+        """
+        self._cpx = cpx_monitor if cpx_monitor is not None else CPXMonitor(**kwargs)
+        self._closed = False
+
+    @classmethod
+    def from_config(
+        cls, file_path: Optional[str] = None, overrides: Optional[Dict] = None, **kwargs
+    ) -> "Monitor":
+        """
+        Creates a new instance of the Monitor class from the monitor section of the config,
+        layered the same way as for the CLI.
+
+        Args:
+            file_path (str, optional): The YAML config file.
+            overrides (Dict, optional): Values overriding the file and the environment,
+                e.g. {"monitor": {"port": 8086}}.
+            **kwargs: Extra arguments passed to the CPXMonitor constructor.
+
+        Returns:
+            The new instance.
+        """
+        config = get_config(file_path=file_path, overrides=overrides)
+        return cls(CPXMonitor.from_config(config["monitor"], **kwargs))
+
+    @property
+    def cpx_monitor(self) -> CPXMonitor:
+        return self._cpx
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def _check_open(self) -> None:
+        if self._closed:
+            raise MonitorClosedError("the monitor is closed")
+
+    def instances(self, service: Optional[str] = None, status: Optional[str] = None) -> List[InstanceStats]:
+        """
+        Sweeps the fleet.
+
+        Args:
+            service (str, optional): Only return instances of this service.
+            status (str, optional): Only return instances with this status.
+
+        Returns:
+            The statistics of the matching instances.
+        """
+        self._check_open()
+        return [
+            instance
+            for instance in _instances(self._cpx.get_stats(), self._cpx.metrics)
+            if (service is None or instance.service.lower() == service.lower())
+            and (status is None or instance.status.lower() == status.lower())
+        ]
+
+    def instance(self, ip: str) -> InstanceStats:
+        """
+        Retrieves the statistics of a single instance, ahead of sweeps if requests are rate limited.
+
+        Args:
+            ip (str): The IP address of the instance.
+
+        Returns:
+            The statistics of the instance.
+        """
+        self._check_open()
+        return _instances(self._cpx.get_stats(ip), self._cpx.metrics)[0]
+
+    def services(self, sample: Optional[float] = None, confidence: float = 0.95) -> List[ServiceStats]:
+        """
+        Sweeps the fleet and aggregates it by service.
+
+        Args:
+            sample (float, optional): Only poll this fraction of each service and return estimates.
+            confidence (float): The confidence level of the estimates when sampling.
+
+        Returns:
+            The statistics of every service, by name.
+        """
+        self._check_open()
+        return _services(self._cpx.get_services(sample=sample, confidence=confidence), self._cpx.metrics)
+
+    def service(self, name: str, max_age: float = 0.0) -> Optional[ServiceStats]:
+        """
+        Aggregates the instances of a service, only querying the instances of the
+        service once their services are known, see CPXMonitor.get_service_stats.
+
+        Args:
+            name (str): The name of the service, case-insensitive.
+            max_age (float): The age (in seconds) up to which instance statistics are reused.
+
+        Returns:
+            The statistics of the service, or None if it has no instances.
+        """
+        self._check_open()
+        stats = self._cpx.get_service_stats(name, max_age=max_age)
+        for service in _services(self._cpx.get_services(stats), self._cpx.metrics):
+            if service.name.lower() == name.lower():
+                return service
+        return None
+
+    def snapshot(self) -> Snapshot:
+        """
+        Sweeps the fleet once for both instance and service statistics.
+
+        Returns:
+            The snapshot.
+        """
+        self._check_open()
+        timestamp = time.time()
+        stats = self._cpx.get_stats()
+        return Snapshot.from_stats(timestamp, stats, self._cpx.get_services(stats), self._cpx.metrics)
+
+    def watch(self, interval: float = 1.0, count: Optional[int] = None) -> Iterator[Snapshot]:
+        """
+        Snapshots the fleet every interval seconds.
+
+        Args:
+            interval (float): The number of seconds between the start of two sweeps.
+            count (int, optional): Stop after this many snapshots. Defaults to never stopping.
+
+        Yields:
+            The snapshots.
+        """
+        snapshots = 0
+        while count is None or snapshots < count:
+            started = time.monotonic()
+            yield self.snapshot()
+            snapshots += 1
+            if count is None or snapshots < count:
+                time.sleep(max(interval - (time.monotonic() - started), 0))
+
+    def events(
+        self,
+        interval: float = 1.0,
+        cpu_delta: int = 10,
+        memory_delta: int = 10,
+        initial: bool = False,
+        count: Optional[int] = None,
+    ) -> Iterator[ChangeEvent]:
+        """
+        Sweeps the fleet every interval seconds and yields the changes between consecutive sweeps,
+        see cpx_health_monitor.events.iter_events.
+        """
+        self._check_open()
+        return iter_events(
+            self._cpx,
+            interval=interval,
+            cpu_delta=cpu_delta,
+            memory_delta=memory_delta,
+            initial=initial,
+            count=count,
+        )
+
+    def close(self) -> None:
+        if not self._closed:
+            self._closed = True
+            self._cpx.close()
+
+    def __enter__(self) -> "Monitor":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+class AsyncMonitor:
+    """
+    asyncio counterpart of Monitor.
+
+    Sweeps are blocking, so they run one at a time on a thread dedicated to the monitor
+    and the event loop is never blocked:
+
+        async with AsyncMonitor(Monitor.from_config()) as monitor:
+            async for snapshot in monitor.watch(interval=5):
+                ...
+    """
+
+    def __init__(self, monitor: Optional[Monitor] = None, **kwargs) -> None:
+        """
+        Initializes a new instance of the AsyncMonitor class.
+
+        Args:
+            monitor (Monitor, optional): The monitor to poll with. The AsyncMonitor
+                takes ownership of it and closes it when closed.
+            **kwargs: Arguments of the Monitor created when monitor isn't given.
+        """
+        self._monitor = monitor if monitor is not None else Monitor(**kwargs)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cpx-monitor")
+
+    @property
+    def monitor(self) -> Monitor:
+        return self._monitor
+
+    async def _call(self, function: Callable, *args, **kwargs) -> Any:
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, lambda: function(*args, **kwargs))
+
+    async def instances(self, service: Optional[str] = None, status: Optional[str] = None) -> List[InstanceStats]:
+        return await self._call(self._monitor.instances, service=service, status=status)
+
+    async def instance(self, ip: str) -> InstanceStats:
+        return await self._call(self._monitor.instance, ip)
+
+    async def services(self, sample: Optional[float] = None, confidence: float = 0.95) -> List[ServiceStats]:
+        return await self._call(self._monitor.services, sample=sample, confidence=confidence)
+
+    async def service(self, name: str, max_age: float = 0.0) -> Optional[ServiceStats]:
+        return await self._call(self._monitor.service, name, max_age=max_age)
+
+    async def snapshot(self) -> Snapshot:
+        return await self._call(self._monitor.snapshot)
+
+    async def watch(self, interval: float = 1.0, count: Optional[int] = None) -> AsyncIterator[Snapshot]:
+        """
+        Snapshots the fleet every interval seconds, see Monitor.watch.
+        """
+        loop = asyncio.get_event_loop()
+        snapshots = 0
+        while count is None or snapshots < count:
+            started = loop.time()
+            yield await self.snapshot()
+            snapshots += 1
+            if count is None or snapshots < count:
+                await asyncio.sleep(max(interval - (loop.time() - started), 0))
+
+    async def aclose(self) -> None:
+        await self._call(self._monitor.close)
+        self._executor.shutdown(wait=False)
+
+    async def __aenter__(self) -> "AsyncMonitor":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.aclose()
@@ -1,7 +1,150 @@
+import heapq
+import logging
+import math
+import random
+import sys
+import time
+import warnings
 import requests
-from typing import List, Dict, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable, Iterator, List, Dict, Optional, Set, Tuple
 from collections import defaultdict
-from rich.table import Table
+from itertools import repeat
+
+from cpx_health_monitor.hedging import Hedger
+from cpx_health_monitor.memory import LRUCache, PersistedState, StateFile
+from cpx_health_monitor.metrics import _PERCENTAGES, Metric, MetricSchema, _parse_percentage, default_metrics
+from cpx_health_monitor.ratelimit import PRIORITY_INTERACTIVE, PRIORITY_SWEEP, build_rate_limiter
+from cpx_health_monitor.utils import json_loads
+
+LOG = logging.getLogger(__name__)
+
+
+# Shared by the statistics of every instance, see _decode_instance.
+_CANONICAL_PERCENTAGES = {value: value for value in _PERCENTAGES}
+
+
+def _decode_instance(raw: bytes) -> Dict[str, str]:
+    """
+    Decodes the raw response of the CPX API for an instance.
+
+    Service names are interned and percentages are replaced by canonical strings,
+    so that the statistics of a large fleet share string objects instead of
+    allocating new ones for every instance and every sweep.
+
+    Args:
+        raw (bytes): The body of the response.
+
+    Returns:
+        The decoded statistics of the instance.
+    """
+    instance = json_loads(raw)
+    service = instance.get("service")
+    if isinstance(service, str):
+        instance["service"] = sys.intern(service)
+    for key in ("cpu", "memory"):
+        if key in instance:
+            instance[key] = _CANONICAL_PERCENTAGES.get(instance[key], instance[key])
+    return instance
+
+
+# Two-sided z values, for Python versions without statistics.NormalDist.
+_Z_SCORES = {0.8: 1.2816, 0.9: 1.6449, 0.95: 1.96, 0.98: 2.3263, 0.99: 2.5758}
+
+
+def _z_score(confidence: float) -> float:
+    """
+    Returns the two-sided z value of a normal confidence interval, e.g. 1.96 for 0.95.
+    """
+    try:
+        from statistics import NormalDist
+    except ImportError:  # pragma: no cover - Python < 3.8
+        return _Z_SCORES.get(round(confidence, 2), 1.96)
+    return NormalDist().inv_cdf((1 + confidence) / 2)
+
+
+INSTANCE_COLUMNS = (
+    ("Instance", "left"),
+    ("Service", "left"),
+    ("CPU Usage", "right"),
+    ("Memory Usage", "right"),
+    ("Status", "center"),
+)
+# Filled in by a TrendTracker, see cpx_health_monitor.trends.
+TREND_COLUMNS = (
+    ("CPU z", "right"),
+    ("Memory z", "right"),
+    ("CPU Trend", "right"),
+    ("Memory Trend", "right"),
+    ("Anomaly", "left"),
+)
+SERVICE_COLUMNS = (
+    ("Service", "left"),
+    ("CPU Usage", "right"),
+    ("Memory Usage", "right"),
+    ("Status", "center"),
+    ("Healthy Instances", "right"),
+    ("Unhealthy Instances", "right"),
+    ("Total Instances", "right"),
+)
+# Percentiles of the instances of a service shown by services show.
+SERVICE_PERCENTILES = (50, 90, 99)
+PERCENTILE_COLUMNS = (("Metric", "left"),) + tuple(
+    (f"p{p}", "right") for p in SERVICE_PERCENTILES
+) + (("Max", "right"),)
+
+
+def _percentile(ordered: List[int], percentile: float) -> int:
+    # Nearest-rank percentile of sorted values, as for alert rules.
+    return ordered[max(math.ceil(percentile / 100 * len(ordered)) - 1, 0)]
+
+
+def rich_table(title: str, columns: Iterable[Tuple[str, str]], rows: Iterable[List[str]], caption: Optional[str] = None):
+    """
+    Renders rows as a rich Table, the default renderer of CPXMonitorPrinter.
+
+    Args:
+        title (str): The title of the table.
+        columns (Iterable[Tuple[str, str]]): The name and justification of each column.
+        rows (Iterable[List[str]]): The cells of each row.
+        caption (str, optional): The caption of the table.
+
+    Returns:
+        The rich Table.
+    """
+    from rich.table import Table
+
+    table = Table(title=title, caption=caption)
+    for name, justify in columns:
+        table.add_column(name, justify=justify)
+    for row in rows:
+        table.add_row(*row)
+    return table
+
+
+def _format_margin(margin: Optional[float]) -> str:
+    return " ±?" if margin is None else f" ±{margin:.0f}%"
+
+
+class InstanceState:
+    """
+    State kept for a member of the fleet across sweeps, created when it joins and
+    dropped when it leaves, rather than rebuilt on every sweep.
+
+    Attributes:
+        url (str): The URL of the instance statistics.
+        service (str): The service of the instance, once known.
+        last (dict): The statistics of the instance from the last sweep, once known.
+        last_seen (float): When the statistics were retrieved, as a time.monotonic() value.
+    """
+
+    __slots__ = ("url", "service", "last", "last_seen")
+
+    def __init__(self, url: str) -> None:
+        self.url = url
+        self.service: Optional[str] = None
+        self.last: Optional[Dict[str, str]] = None
+        self.last_seen: Optional[float] = None
 
 
 class CPXMonitor:
@@ -15,17 +158,48 @@ class CPXMonitor:
         _health_threshold (int):
             The maximum number of unhealthy instances that can exist,
             before a service is marked as unhealthy.
+        _cpu_threshold (int): The CPU usage (%) from which an instance is unhealthy.
+        _memory_threshold (int): The memory usage (%) from which an instance is unhealthy.
+        _concurrency (int): The number of instances queried in parallel during a sweep.
+        _timeout (float): The number of seconds to wait for each response of the CPX API.
+        _servers_ttl (float): The number of seconds the list of instances is reused for.
+        _rate_limiter (TokenBucket): Bounds the rate of requests issued to the CPX API.
+        _state_ttl (float): The number of seconds the statistics of unresponsive instances are kept for.
+        _metrics (MetricSchema): The metrics of the instances, with their thresholds.
+        _state_file (StateFile): Keeps the state of the members between runs.
 
     Methods:
         _get_instances() -> List[str]: Retrieves a list of all instances being monitored.
         _get_health(instance: dict) -> str: Determines the health status of a given instance.
         get_stats(ip: str=None) -> List[Dict[str, Dict[str, Any]]]:
             Retrieves performance statistics for a specified IP address or all monitored instances.
-        get_services(instances: List[Dict[str, Dict[str, str]]]=None) -> List[Dict[str, Dict[str, Any]]]:
-            Retrieves statistics for all monitored services.
+        get_service_stats(service: str, max_age: float=0.0) -> List[Dict[str, Dict[str, Any]]]:
+            Retrieves performance statistics for the instances of a single service.
+        get_services(instances: List[Dict[str, Dict[str, str]]]=None, sample: float=None)
+            -> List[Dict[str, Dict[str, Any]]]: Retrieves statistics for all monitored services.
+        iter_service_estimates(fraction: float=0.1) -> Iterator[List[Dict[str, Dict[str, Any]]]]:
+            Estimates the statistics of all services from progressively larger samples.
+        close() -> None: Releases the connection and thread pools of the monitor, and its rate limiter.
     """
 
-    def __init__(self, host="localhost", port=8085, protocol="http") -> None:
+    def __init__(
+        self,
+        host="localhost",
+        port=8085,
+        protocol="http",
+        recorder=None,
+        concurrency=1,
+        timeout=None,
+        servers_ttl=0,
+        health_threshold=2,
+        cpu_threshold=80,
+        memory_threshold=80,
+        rate_limiter=None,
+        state_ttl=None,
+        hedger=None,
+        metrics=None,
+        state_file=None,
+    ) -> None:
         """
         Initializes a new instance of the CPXMonitor class.
 
@@ -33,30 +207,285 @@ class CPXMonitor:
             host (str): The hostname or IP address of the server to monitor.
             port (int): The port number on which to access the server.
             protocol (str): The protocol to use for accessing the server (e.g. "http").
+            recorder (SweepRecorder, optional):
+                If given, the raw responses of every fleet-wide sweep are recorded to it.
+            concurrency (int): The number of instances queried in parallel during a sweep.
+            timeout (float, optional): The number of seconds to wait for each response.
+            servers_ttl (float): The number of seconds the list of instances is reused for.
+            health_threshold (int): The maximum number of unhealthy instances of a healthy service.
+            cpu_threshold (int): The CPU usage (%) from which an instance is unhealthy.
+            memory_threshold (int): The memory usage (%) from which an instance is unhealthy.
+            rate_limiter (TokenBucket, optional):
+                If given, every request to the CPX API first takes a token from it.
+            state_ttl (float, optional): The number of seconds the last statistics of an
+                instance are kept for once it stops responding. Defaults to keeping them.
+            hedger (Hedger, optional): If given, the requests of sweeps are hedged with it:
+                slow requests are duplicated and the first response is used.
+            metrics (Iterable[Metric], optional): Metrics reported by the CPX API besides
+                CPU and memory usage, evaluated, aggregated and printed along with them.
+            state_file (StateFile, optional): If given, the services of the members, and the
+                statistics of the instances of the services drilled into, are restored from it
+                when they join and saved to it after every drill-down.
         """
 
         self._port = port
         self._host = host
         self._protocol = protocol
-        self._health_threshold = 2
+        self._health_threshold = health_threshold
+        self._cpu_threshold = cpu_threshold
+        self._memory_threshold = memory_threshold
+        self._concurrency = concurrency
+        self._timeout = timeout
+        self._servers_ttl = servers_ttl
         self._endpoint = f"{self._protocol}://{self._host}:{self._port}"
         self._servers_endpoint = f"{self._endpoint}/servers"
+        self._recorder = recorder
+        self._rate_limiter = rate_limiter
+        self._instances: Optional[List[str]] = None
+        self._instances_expiry = 0.0
+        # Members of the fleet, in listing order, with their state.
+        self._members: Dict[str, InstanceState] = {}
+        self._servers_version: Optional[str] = None
+        self._membership_listeners: List[Callable[[List[str], List[str]], None]] = []
+        self._state_ttl = state_ttl
+        self._states_expiry = 0.0
+        self._hedger = hedger
+        self._metrics = MetricSchema(default_metrics(cpu_threshold, memory_threshold) + tuple(metrics or ()))
+        self._state_file = state_file
+        self._persisted: Dict[str, PersistedState] = {}
+        # Services whose instance statistics are kept in the state file, lowercased.
+        self._drilled: Set[str] = set()
+        if state_file is not None:
+            self._persisted = state_file.load(self._endpoint)
+            self._drilled = {service.lower() for service, _, stats in self._persisted.values() if stats is not None}
+
+        self._session = requests.Session()
+        # Hedged sweeps may have a duplicate request in flight for every instance queried.
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=max(concurrency * (2 if hedger else 1), 10)
+        )
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self._executor = (
+            ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="cpx-sweep")
+            if concurrency > 1
+            else None
+        )
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any], **kwargs) -> "CPXMonitor":
+        """
+        Creates a new instance of the CPXMonitor class from the monitor section of the config.
+
+        Args:
+            config (Dict[str, Any]): The monitor section of the config.
+            **kwargs: Extra arguments passed to the constructor.
+
+        Returns:
+            The new instance.
+        """
+        health = config.get("health", {})
+        kwargs.setdefault("rate_limiter", build_rate_limiter(config.get("rate_limit")))
+        kwargs.setdefault("state_ttl", config.get("memory", {}).get("state_ttl"))
+        if "hedger" not in kwargs:
+            kwargs["hedger"] = Hedger.from_config(config.get("hedging"), config.get("concurrency", 1))
+        kwargs.setdefault("metrics", MetricSchema.from_config(config).extra)
+        kwargs.setdefault("state_file", StateFile.from_config(config.get("memory", {})))
+        return cls(
+            host=config["host"],
+            port=config["port"],
+            protocol=config["protocol"],
+            concurrency=config.get("concurrency", 1),
+            timeout=config.get("timeout"),
+            servers_ttl=config.get("servers_ttl", 0),
+            health_threshold=health.get("unhealthy_instances", 2),
+            cpu_threshold=health.get("cpu", 80),
+            memory_threshold=health.get("memory", 80),
+            **kwargs,
+        )
+
+    def close(self) -> None:
+        """
+        Releases the connection and thread pools of the monitor, and its rate limiter.
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        if self._hedger is not None:
+            self._hedger.close()
+        if self._rate_limiter is not None:
+            self._rate_limiter.close()
+        self._session.close()
+
+    @property
+    def hedger(self) -> Optional[Hedger]:
+        """
+        The hedger of the requests of sweeps, if they are hedged.
+        """
+        return self._hedger
+
+    @property
+    def metrics(self) -> MetricSchema:
+        """
+        The metrics of the instances, with their thresholds.
+        """
+        return self._metrics
+
+    @property
+    def members(self) -> Dict[str, InstanceState]:
+        """
+        The members of the fleet as of the last listing, with their state, by IP.
+        """
+        return self._members
+
+    def add_membership_listener(self, listener: Callable[[List[str], List[str]], None]) -> None:
+        """
+        Registers a callable to be called with the (added, removed) IPs on every membership change.
+
+        Args:
+            listener (Callable[[List[str], List[str]], None]): The callable.
+        """
+        self._membership_listeners.append(listener)
+
+    def _update_members(self, added: Iterable[str], removed: Iterable[str]) -> None:
+        added = [ip for ip in added if ip not in self._members]
+        removed = [ip for ip in removed if ip in self._members]
+        for ip in removed:
+            del self._members[ip]
+        for ip in added:
+            state = self._members[ip] = InstanceState(f"{self._endpoint}/{ip}")
+            persisted = self._persisted.pop(ip, None)
+            if persisted is not None:
+                self._restore_state(state, persisted)
+
+        if added or removed:
+            LOG.debug("membership changed: %d added, %d removed", len(added), len(removed))
+            self._instances = list(self._members)
+            for listener in self._membership_listeners:
+                listener(added, removed)
+        elif self._instances is None:
+            self._instances = list(self._members)
+
+    def _restore_state(self, state: InstanceState, persisted: PersistedState) -> None:
+        service, seen, stats = persisted
+        state.service = service
+        # Wall-clock times survive restarts, monotonic ones don't.
+        state.last_seen = time.monotonic() - (time.time() - seen)
+        if stats is not None:
+            stats["status"] = self._get_health(instance=stats)
+            state.last = stats
+
+    def _save_state(self) -> None:
+        now = time.monotonic()
+        wall = time.time()
+        drilled = self._drilled
+        states = {}
+        for ip, state in self._members.items():
+            if state.service is None:
+                continue
+            last = state.last if state.service.lower() in drilled else None
+            states[ip] = (state.service, wall - (now - state.last_seen), last)
+        self._state_file.save(self._endpoint, states)
+
+    def _replace_members(self, servers: List[str]) -> None:
+        current = set(servers)
+        self._update_members(
+            servers, [ip for ip in self._members if ip not in current]
+        )
+
+    def _acquire(self, priority: int) -> None:
+        if self._rate_limiter is not None:
+            self._rate_limiter.acquire(priority)
 
     def _get_instances(self) -> List[str]:
         """
         Retrieves a list of all instances being monitored.
 
+        The list is reused for servers_ttl seconds before being fetched again.
+        When the CPX API versions the list (X-Servers-Version header), only the
+        instances added or removed since the last version are fetched and processed.
+
         Returns:
             A list of IP addresses for all instances being monitored.
         """
 
-        response = requests.get(self._servers_endpoint)
+        now = time.monotonic()
+        if self._instances is not None and now < self._instances_expiry:
+            return self._instances
+
+        self._acquire(PRIORITY_SWEEP)
+        if self._servers_version is None:
+            response = self._session.get(self._servers_endpoint, timeout=self._timeout)
+            LOG.debug("GET %s: %s", self._servers_endpoint, response.status_code)
+            response.raise_for_status()
+            self._replace_members(response.json())
+            self._servers_version = response.headers.get("X-Servers-Version")
+        else:
+            response = self._session.get(
+                self._servers_endpoint,
+                params={"since": self._servers_version},
+                timeout=self._timeout,
+            )
+            LOG.debug(
+                "GET %s?since=%s: %s",
+                self._servers_endpoint,
+                self._servers_version,
+                response.status_code,
+            )
+            response.raise_for_status()
+            delta = response.json()
+            if delta.get("reset"):
+                self._replace_members(delta["servers"])
+            else:
+                self._update_members(delta["added"], delta["removed"])
+            self._servers_version = str(delta["version"])
+
+        self._instances_expiry = now + self._servers_ttl
+        return self._instances
+
+    def _get_stat(self, instance_ip: str, priority: int = PRIORITY_SWEEP) -> Dict[str, str]:
+        """
+        Retrieves the raw performance statistics of a single instance.
+
+        Args:
+            instance_ip (str): The IP address of the instance.
+            priority (int): The priority of the request for the rate limiter.
+
+        Returns:
+            The decoded response of the CPX API for the instance.
+        """
+
+        state = self._members.get(instance_ip)
+        url = state.url if state is not None else f"{self._endpoint}/{instance_ip}"
+        if self._hedger is not None and priority == PRIORITY_SWEEP:
+            content = self._hedger.call(lambda: self._request_stat(instance_ip, url, priority))
+        else:
+            content = self._request_stat(instance_ip, url, priority)
+        return _decode_instance(content)
+
+    def _request_stat(self, instance_ip: str, url: str, priority: int) -> bytes:
+        self._acquire(priority)
+        response = self._session.get(url, timeout=self._timeout)
+        LOG.debug("GET /%s: %s", instance_ip, response.status_code)
         response.raise_for_status()
-        return response.json()
+        return response.content
+
+    def _get_member_stat(self, instance_ip: str, priority: int = PRIORITY_SWEEP) -> Optional[Dict[str, str]]:
+        """
+        Same as _get_stat, but returns None if the instance left the fleet since it was listed.
+        """
+
+        try:
+            return self._get_stat(instance_ip, priority=priority)
+        except requests.HTTPError as e:
+            if e.response is not None and e.response.status_code in (400, 404):
+                LOG.debug("%s left the fleet during the sweep", instance_ip)
+                return None
+            raise
 
     def _get_health(self, instance: Dict[str, str]) -> str:
         """
-        Determines the health status of a given instance.
+        Determines the health status of a given instance from the thresholds of the metrics.
 
         Args:
             instance (dict): A dictionary containing performance statistics for the instance.
@@ -65,12 +494,65 @@ class CPXMonitor:
             A string indicating the health status of the instance ("Healthy" or "Unhealthy").
         """
 
-        cpu = int(instance["cpu"].replace("%", ""))
-        memory = int(instance["memory"].replace("%", ""))
+        if self._metrics.is_healthy(instance):
+            return "Healthy"
+        return "Unhealthy"
+
+    def _fetch_stats(
+        self,
+        instances: List[str],
+        responses: Optional[Dict[str, Dict[str, str]]] = None,
+        priority: int = PRIORITY_SWEEP,
+    ) -> List[Dict[str, Dict[str, str]]]:
+        """
+        Retrieves performance statistics for the given members of the fleet,
+        in parallel when concurrency allows, and updates their state.
+
+        Args:
+            instances (List[str]): The IP addresses of the instances.
+            responses (Dict[str, Dict[str, str]], optional):
+                If given, the raw response of each instance is stored in it, by IP.
+            priority (int): The priority of the requests, PRIORITY_SWEEP unless a user is waiting.
+
+        Returns:
+            A list of dictionaries containing performance statistics for each instance
+            that is still a member of the fleet.
+        """
+
+        if self._executor is not None:
+            stats = self._executor.map(self._get_member_stat, instances, repeat(priority))
+        else:
+            stats = map(self._get_member_stat, instances, repeat(priority))
+
+        temp_list = []
+        members = self._members
+        now = time.monotonic()
+        for instance, temp in zip(instances, stats):
+            if temp is None:
+                continue
+            if responses is not None:
+                responses[instance] = dict(temp)
+            temp["status"] = self._get_health(instance=temp)
+            temp_list.append({instance: temp})
+            state = members.get(instance)
+            if state is not None:
+                state.service = temp.get("service")
+                state.last = temp
+                state.last_seen = now
+
+        if self._state_ttl is not None and now >= self._states_expiry:
+            self._expire_states(now)
+
+        return temp_list
 
-        if cpu >= 80 or memory >= 80:
-            return "Unhealthy"
-        return "Healthy"
+    def _expire_states(self, now: float) -> None:
+        # Instances that stopped responding stay members until they leave the fleet,
+        # but their last statistics are only kept for state_ttl seconds.
+        deadline = now - self._state_ttl
+        for state in self._members.values():
+            if state.last is not None and state.last_seen < deadline:
+                state.last = None
+        self._states_expiry = now + self._state_ttl / 2
 
     def get_stats(self, ip: str = None) -> List[Dict[str, Dict[str, str]]]:
         """
@@ -84,30 +566,73 @@ class CPXMonitor:
             A list of dictionaries containing performance statistics for each instance.
         """
 
-        def get_stat(instance_ip: str) -> Dict[str, Dict[str, str]]:
-            response = requests.get(f"{self._endpoint}/{instance_ip}")
-            response.raise_for_status()
-            return response.json()
-
         if ip is None:
-            temp_list = []
             instances = self._get_instances()
+            responses = {} if self._recorder is not None else None
+            temp_list = self._fetch_stats(instances, responses)
 
-            for instance in instances:
-                temp = get_stat(instance_ip=instance)
-                temp["status"] = self._get_health(instance=temp)
-                temp_list.append({instance: temp})
+            if responses is not None:
+                self._recorder.record(
+                    [instance for instance in instances if instance in responses],
+                    responses,
+                )
 
             return temp_list
         else:
-            temp = get_stat(instance_ip=ip)
+            temp = self._get_stat(instance_ip=ip, priority=PRIORITY_INTERACTIVE)
             temp["status"] = self._get_health(instance=temp)
             return [
                 {ip: temp},
             ]
 
+    def get_service_stats(self, service: str, max_age: float = 0.0) -> List[Dict[str, Dict[str, str]]]:
+        """
+        Retrieves performance statistics for the instances of a single service.
+
+        Only the members of the fleet known to run the service, and those whose service
+        isn't known yet (e.g. before the first sweep), are queried, in parallel when
+        concurrency allows and ahead of sweeps when requests are rate limited. Statistics
+        retrieved at most max_age seconds ago are reused instead of being queried again,
+        including those restored from the state file by a previous run.
+
+        Args:
+            service (str): The name of the service, case-insensitive.
+            max_age (float): The age (in seconds) up to which statistics are reused.
+
+        Returns:
+            A list of dictionaries containing performance statistics for each instance of the service.
+        """
+        service = service.lower()
+        instances = self._get_instances()
+        now = time.monotonic()
+        temp_list = []
+        queried = []
+        for instance in instances:
+            state = self._members.get(instance)
+            if state is None or state.service is None:
+                queried.append(instance)
+            elif state.service.lower() != service:
+                continue
+            elif state.last is not None and now - state.last_seen <= max_age:
+                temp_list.append({instance: state.last})
+            else:
+                queried.append(instance)
+
+        for instance_stats in self._fetch_stats(queried, priority=PRIORITY_INTERACTIVE):
+            for stats in instance_stats.values():
+                if stats["service"].lower() == service:
+                    temp_list.append(instance_stats)
+
+        if self._state_file is not None:
+            self._drilled.add(service)
+            self._save_state()
+        return temp_list
+
     def get_services(
-        self, instances: List[Dict[str, Dict[str, str]]] = None
+        self,
+        instances: List[Dict[str, Dict[str, str]]] = None,
+        sample: Optional[float] = None,
+        confidence: float = 0.95,
     ) -> List[Dict[str, Dict[str, str]]]:
         """
         Get statistics for all services running on the monitored hosts.
@@ -115,52 +640,49 @@ class CPXMonitor:
         Args:
             instances (List[Dict[str, Dict[str, str]]], optional):
                 List of instance information dictionaries. Defaults to None.
+            sample (float, optional):
+                If given (and instances isn't), only poll this fraction of each service
+                and return estimates, see iter_service_estimates.
+            confidence (float): The confidence level of the estimates when sampling.
 
         Returns:
             List[Dict[str, Dict[str, str]]]:
-                List of service statistics dictionaries with average CPU and memory usage,
-                and number of healthy, unhealthy, and total instances for each service.
+                List of service statistics dictionaries with the aggregate of each metric
+                (e.g. average CPU and memory usage), and number of healthy, unhealthy,
+                and total instances for each service.
         """
         if instances is None:
+            if sample is not None:
+                return next(self.iter_service_estimates(sample, confidence=confidence))
             instances = self.get_stats()
 
-        service_stats = defaultdict(
-            lambda: {"cpu": [], "memory": [],
-                     "healthy": 0, "unhealthy": 0, "total": 0}
-        )
-
+        service_instances = defaultdict(list)
+        service_unhealthy = defaultdict(int)
         for instance in instances:
             for ip, stats in instance.items():
                 service = stats["service"]
-                service_stats[service]["total"] += 1
+                service_instances[service].append(stats)
                 if stats["status"] == "Unhealthy":
-                    service_stats[service]["unhealthy"] += 1
-                else:
-                    service_stats[service]["healthy"] += 1
-                service_stats[service]["cpu"].append(
-                    int(stats["cpu"].replace("%", "")))
-                service_stats[service]["memory"].append(
-                    int(stats["memory"].replace("%", ""))
-                )
+                    service_unhealthy[service] += 1
 
         result = []
-        for service, stats in service_stats.items():
-            avg_cpu = sum(stats["cpu"]) / len(stats["cpu"])
-            avg_memory = sum(stats["memory"]) / len(stats["memory"])
+        for service, stats in service_instances.items():
+            unhealthy = service_unhealthy[service]
             status = (
                 "Healthy"
-                if stats["unhealthy"] <= self._health_threshold
+                if unhealthy <= self._health_threshold
                 else "Unhealthy"
             )
 
-            temp = {
-                "cpu": f"{int(avg_cpu)}%",
-                "memory": f"{int(avg_memory)}%",
-                "status": status,
-                "total_instances": stats["total"],
-                "healthy_instances": stats["healthy"],
-                "unhealthy_instances": stats["unhealthy"],
-            }
+            temp = self._metrics.aggregate(stats)
+            temp.update(
+                {
+                    "status": status,
+                    "total_instances": len(stats),
+                    "healthy_instances": len(stats) - unhealthy,
+                    "unhealthy_instances": unhealthy,
+                }
+            )
 
             result.append({service: temp})
 
@@ -175,6 +697,8 @@ class CPXMonitor:
         Get statistics for all services running on the monitored hosts,
         or a single service if specified.
 
+        Deprecated, use get_services instead.
+
         Args:
             service (str, optional):
                 Name of the service to retrieve statistics for. Defaults to None.
@@ -182,92 +706,483 @@ class CPXMonitor:
                 List of instance information dictionaries. Defaults to None.
 
         Returns:
-            List[Dict[str, Dict[str, str]]]:
-                List of service statistics dictionaries with average CPU and memory usage,
-                and number of healthy, unhealthy, and total instances for each service.
+            List[Dict[str, Dict[str, str]]]: The statistics of the services, as for get_services.
         """
-        if instances is None:
-            instances = self.get_stats()
+        warnings.warn("get_services_new is deprecated, use get_services", DeprecationWarning, stacklevel=2)
+        result = self.get_services(instances)
+        if service is not None:
+            result = [stats for stats in result if service in stats]
+        return result
 
-        service_stats = defaultdict(
-            lambda: {"cpu": [], "memory": [],
-                     "healthy": 0, "unhealthy": 0, "total": 0}
-        )
+    def iter_service_estimates(
+        self,
+        fraction: float = 0.1,
+        min_per_service: int = 5,
+        confidence: float = 0.95,
+        seed: Optional[int] = None,
+    ) -> Iterator[List[Dict[str, Dict[str, Any]]]]:
+        """
+        Estimates the statistics of every service from a stratified random sample of
+        the fleet, refining the estimates with every round until the whole fleet is polled.
 
-        for instance in instances:
-            for ip, stats in instance.items():
-                service_name = stats["service"]
-                service_stats[service_name]["total"] += 1
-                if stats["status"] == "Unhealthy":
-                    service_stats[service_name]["unhealthy"] += 1
-                else:
-                    service_stats[service_name]["healthy"] += 1
-                service_stats[service_name]["cpu"].append(
-                    int(stats["cpu"].replace("%", ""))
-                )
-                service_stats[service_name]["memory"].append(
-                    int(stats["memory"].replace("%", ""))
-                )
+        Instances are grouped by the service they reported last (instances that never
+        reported form a stratum of their own), and every round polls a further fraction
+        of each group, at least min_per_service instances, so small services are as well
+        covered as large ones. Until the monitor has swept the fleet once, this is a simple
+        random sample of the fleet. The last round is exact.
 
-        result = []
+        Args:
+            fraction (float): The fraction of each service polled per round.
+            min_per_service (int): The minimum number of instances polled per service.
+            confidence (float): The confidence level of the reported margins.
+            seed (int, optional): Seeds the random sampling, for reproducible results.
 
-        if service is not None:
-            if service in service_stats:
-                stats = service_stats[service]
-                avg_cpu = sum(stats["cpu"]) / len(stats["cpu"])
-                avg_memory = sum(stats["memory"]) / len(stats["memory"])
-                status = (
-                    "Healthy"
-                    if stats["unhealthy"] <= self._health_threshold
-                    else "Unhealthy"
-                )
-                temp = {
-                    "cpu": f"{int(avg_cpu)}%",
-                    "memory": f"{int(avg_memory)}%",
-                    "status": status,
-                    "total_instances": stats["total"],
-                    "healthy_instances": stats["healthy"],
-                    "unhealthy_instances": stats["unhealthy"],
-                }
-                result.append({service: temp})
-            return result
+        Yields:
+            Service statistics as returned by get_services, with the additional keys
+            cpu_margin and memory_margin (half-width of the confidence interval, in %,
+            None when a single instance of the service was polled), sampled_instances, and estimated (False once the whole fleet was polled).
+        """
+        if not 0 < fraction <= 1:
+            raise ValueError("fraction must be in (0, 1]")
 
-        for service_name, stats in service_stats.items():
-            avg_cpu = sum(stats["cpu"]) / len(stats["cpu"])
-            avg_memory = sum(stats["memory"]) / len(stats["memory"])
-            status = (
-                "Healthy"
-                if stats["unhealthy"] <= self._health_threshold
-                else "Unhealthy"
+        members = self._members
+        strata: Dict[Optional[str], List[str]] = defaultdict(list)
+        for ip in self._get_instances():
+            state = members.get(ip)
+            strata[state.service if state is not None else None].append(ip)
+
+        rng = random.Random(seed)
+        for ips in strata.values():
+            rng.shuffle(ips)
+
+        z = _z_score(confidence)
+        taken = dict.fromkeys(strata, 0)
+        missing = dict.fromkeys(strata, 0)
+        # Running sums by (stratum, service): n, cpu, cpu², memory, memory², unhealthy.
+        sums: Dict[Tuple[Optional[str], str], List[float]] = defaultdict(lambda: [0, 0, 0, 0, 0, 0])
+        rounds = 0
+
+        while True:
+            rounds += 1
+            batch = []
+            origin = {}
+            for stratum, ips in strata.items():
+                n = min(len(ips), max(min_per_service, math.ceil(fraction * rounds * len(ips))))
+                for ip in ips[taken[stratum]:n]:
+                    origin[ip] = stratum
+                    batch.append(ip)
+                taken[stratum] = n
+
+            fetched = self._fetch_stats(batch)
+            missing_now = dict.fromkeys(strata, 0)
+            for ip in batch:
+                missing_now[origin[ip]] += 1
+            for item in fetched:
+                for ip, stats in item.items():
+                    stratum = origin[ip]
+                    missing_now[stratum] -= 1
+                    cpu = _parse_percentage(stats["cpu"])
+                    memory = _parse_percentage(stats["memory"])
+                    acc = sums[(stratum, stats["service"])]
+                    acc[0] += 1
+                    acc[1] += cpu
+                    acc[2] += cpu * cpu
+                    acc[3] += memory
+                    acc[4] += memory * memory
+                    acc[5] += stats["status"] == "Unhealthy"
+            for stratum, count in missing_now.items():
+                missing[stratum] += count
+
+            complete = all(taken[stratum] == len(ips) for stratum, ips in strata.items())
+            yield self._estimate_services(strata, taken, missing, sums, z, complete)
+            if complete:
+                return
+
+    def _estimate_services(
+        self,
+        strata: Dict[Optional[str], List[str]],
+        taken: Dict[Optional[str], int],
+        missing: Dict[Optional[str], int],
+        sums: Dict[Tuple[Optional[str], str], List[float]],
+        z: float,
+        complete: bool,
+    ) -> List[Dict[str, Dict[str, Any]]]:
+        # Each polled instance stands for population / sample instances of its stratum.
+        weights = {}
+        for stratum, ips in strata.items():
+            polled = taken[stratum] - missing[stratum]
+            if polled > 0:
+                weights[stratum] = (len(ips) - missing[stratum]) / polled
+
+        # Weighted by service: population, n, cpu, cpu², memory, memory², unhealthy.
+        services: Dict[str, List[float]] = defaultdict(lambda: [0.0, 0, 0.0, 0.0, 0.0, 0.0, 0.0])
+        for (stratum, service), (n, cpu, cpu_sq, memory, memory_sq, unhealthy) in sums.items():
+            weight = weights[stratum]
+            acc = services[service]
+            acc[0] += weight * n
+            acc[1] += n
+            acc[2] += weight * cpu
+            acc[3] += weight * cpu_sq
+            acc[4] += weight * memory
+            acc[5] += weight * memory_sq
+            acc[6] += weight * unhealthy
+
+        def margin(total: float, square: float, population: float, n: int) -> Optional[float]:
+            if complete or population <= 1:
+                return 0.0
+            if n < 2:
+                return None
+            mean = total / population
+            variance = max(square / population - mean * mean, 0.0) * n / (n - 1)
+            fpc = max(population - n, 0) / (population - 1)
+            return round(z * math.sqrt(variance / n * fpc), 1)
+
+        result = []
+        for service, (population, n, cpu, cpu_sq, memory, memory_sq, unhealthy) in services.items():
+            total = max(int(round(population)), n)
+            unhealthy = int(round(unhealthy))
+            result.append(
+                {
+                    service: {
+                        "cpu": f"{int(cpu / population)}%",
+                        "memory": f"{int(memory / population)}%",
+                        "status": "Healthy" if unhealthy <= self._health_threshold else "Unhealthy",
+                        "total_instances": total,
+                        "healthy_instances": total - unhealthy,
+                        "unhealthy_instances": unhealthy,
+                        "cpu_margin": margin(cpu, cpu_sq, population, n),
+                        "memory_margin": margin(memory, memory_sq, population, n),
+                        "sampled_instances": n,
+                        "estimated": not complete,
+                    }
+                }
             )
-            temp = {
-                "cpu": f"{int(avg_cpu)}%",
-                "memory": f"{int(avg_memory)}%",
-                "status": status,
-                "total_instances": stats["total"],
-                "healthy_instances": stats["healthy"],
-                "unhealthy_instances": stats["unhealthy"],
-            }
-            result.append({service_name: temp})
 
         return result
 
 
+class InstanceIndex:
+    """
+    Maintained indexes over the latest instance statistics, so that filtering
+    and sorting don't require scanning and re-sorting the whole fleet on every refresh.
+
+    Rows are kept per instance IP and indexed by service, by status and by numeric
+    CPU and memory usage. Bucket keys are lower-cased so that filters are case-insensitive.
+    The cells of extra metrics, if any, follow the status in rows.
+
+    Methods:
+        update(stats: List[Dict[str, Dict[str, str]]], replace: bool=True) -> None:
+            Updates the indexes with the result of CPXMonitor.get_stats.
+        select(service: str=None, status: str=None, sort: str=None, top: int=None, limit: int=None)
+            -> List[Tuple[str, str, str, str, str]]:
+            Returns the matching rows in the requested order.
+    """
+
+    SORT_KEYS = ("instance", "service", "cpu", "memory", "status")
+    DEFAULT_SORT_KEY = "instance"
+    TOP_SORT_KEY = "cpu"
+
+    def __init__(self, search_cache: int = 32, metrics: Iterable[Metric] = ()) -> None:
+        """
+        Initializes a new, empty instance of the InstanceIndex class.
+
+        Args:
+            search_cache (int): The number of search results kept until the rows change.
+            metrics (Iterable[Metric]): Extra metrics whose cells are added to the rows,
+                e.g. CPXMonitor.metrics.extra.
+        """
+        self._metrics = tuple(metrics)
+        self._columns = INSTANCE_COLUMNS + tuple((metric.title, "right") for metric in self._metrics)
+        self._search_cache = LRUCache(search_cache)
+        self._rows: Dict[str, Tuple[str, ...]] = {}
+        self._cpu: Dict[str, int] = {}
+        self._memory: Dict[str, int] = {}
+        self._by_service: Dict[str, Set[str]] = defaultdict(set)
+        self._by_status: Dict[str, Set[str]] = defaultdict(set)
+        self._sorted_ips: Optional[List[str]] = []
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    @property
+    def columns(self) -> Tuple[Tuple[str, str], ...]:
+        """
+        The name and justification of the columns of the rows.
+        """
+        return self._columns
+
+    @property
+    def search_cache(self) -> LRUCache:
+        """
+        The search results cached until the rows change.
+        """
+        return self._search_cache
+
+    def _add(self, ip: str, row: Tuple[str, ...]) -> None:
+        self._rows[ip] = row
+        self._cpu[ip] = _parse_percentage(row[2])
+        self._memory[ip] = _parse_percentage(row[3])
+        self._by_service[row[1].lower()].add(ip)
+        self._by_status[row[4].lower()].add(ip)
+
+    def _remove(self, ip: str) -> None:
+        row = self._rows.pop(ip)
+        del self._cpu[ip]
+        del self._memory[ip]
+        for bucket, key in (
+            (self._by_service, row[1].lower()),
+            (self._by_status, row[4].lower()),
+        ):
+            bucket[key].discard(ip)
+            if not bucket[key]:
+                del bucket[key]
+
+    def update(self, stats: List[Dict[str, Dict[str, str]]], replace: bool = True) -> None:
+        """
+        Updates the indexes with a list of instance statistics.
+
+        Only instances whose statistics changed are re-indexed.
+
+        Args:
+            stats (List[Dict[str, Dict[str, str]]]): The result of CPXMonitor.get_stats.
+            replace (bool): Whether the statistics describe the whole fleet,
+                in which case instances that are missing from them are dropped.
+        """
+        seen = set()
+        changed = False
+        metrics = self._metrics
+
+        for instance_stats in stats:
+            for ip, instance in instance_stats.items():
+                seen.add(ip)
+                row = (
+                    ip,
+                    instance["service"],
+                    instance["cpu"],
+                    instance["memory"],
+                    instance["status"],
+                )
+                if metrics:
+                    row += tuple(metric.cell(instance.get(metric.field)) for metric in metrics)
+                current = self._rows.get(ip)
+                if current == row:
+                    continue
+                changed = True
+                if current is not None:
+                    self._remove(ip)
+                else:
+                    self._sorted_ips = None
+                self._add(ip, row)
+
+        if replace and len(seen) != len(self._rows):
+            for ip in [ip for ip in self._rows if ip not in seen]:
+                self._remove(ip)
+            self._sorted_ips = None
+            changed = True
+
+        if changed:
+            self._search_cache.clear()
+
+    def _matches(self, term: str) -> Set[str]:
+        term = term.lower()
+        matches = self._search_cache.get(term)
+        if matches is None:
+            matches = {ip for ip in self._rows if term in ip}
+            for service, ips in self._by_service.items():
+                if term in service:
+                    matches.update(ips)
+            matches = self._search_cache[term] = frozenset(matches)
+        return matches
+
+    def _candidates(
+        self,
+        service: Optional[str],
+        status: Optional[str],
+        search: Optional[str] = None,
+        ips: Optional[Set[str]] = None,
+    ) -> Optional[Set[str]]:
+        buckets = []
+        if ips is not None:
+            buckets.append({ip for ip in ips if ip in self._rows})
+        if service is not None:
+            buckets.append(self._by_service.get(service.lower(), set()))
+        if status is not None:
+            buckets.append(self._by_status.get(status.lower(), set()))
+        if search:
+            buckets.append(self._matches(search))
+        if not buckets:
+            return None
+
+        buckets.sort(key=len)
+        return buckets[0].intersection(*buckets[1:])
+
+    def count(
+        self,
+        service: Optional[str] = None,
+        status: Optional[str] = None,
+        search: Optional[str] = None,
+        ips: Optional[Set[str]] = None,
+    ) -> int:
+        """
+        Returns the number of rows matching the filters, without materializing them.
+
+        Args:
+            service (str, optional): Only count instances of this service.
+            status (str, optional): Only count instances with this status.
+            search (str, optional): Only count instances whose IP or service contains this term.
+            ips (Set[str], optional): Only count these instances.
+
+        Returns:
+            The number of matching rows.
+        """
+        candidates = self._candidates(service, status, search, ips)
+        return len(self._rows) if candidates is None else len(candidates)
+
+    def select(
+        self,
+        service: Optional[str] = None,
+        status: Optional[str] = None,
+        sort: Optional[str] = None,
+        top: Optional[int] = None,
+        limit: Optional[int] = None,
+        offset: int = 0,
+        search: Optional[str] = None,
+        ips: Optional[Set[str]] = None,
+    ) -> List[Tuple[str, str, str, str, str]]:
+        """
+        Returns the rows matching the filters, in the requested order.
+
+        CPU and memory are sorted numerically in descending order (hottest first),
+        everything else in ascending order, with the instance IP as a tie-breaker.
+        When a row count is requested, only offset + count rows are selected using a heap.
+
+        Args:
+            service (str, optional): Only return instances of this service.
+            status (str, optional): Only return instances with this status.
+            sort (str, optional): One of SORT_KEYS. Defaults to "instance",
+                or to "cpu" when top is given.
+            top (int, optional): Only return the N highest ranked rows.
+            limit (int, optional): Return at most N rows.
+            offset (int): Skip the first N rows of the ordering.
+            search (str, optional): Only return instances whose IP or service contains this term.
+            ips (Set[str], optional): Only return these instances, e.g. the anomalous ones.
+
+        Returns:
+            A list of (instance, service, cpu, memory, status) rows.
+        """
+        if sort is None:
+            sort = self.TOP_SORT_KEY if top is not None else self.DEFAULT_SORT_KEY
+        if sort not in self.SORT_KEYS:
+            raise ValueError(f"Invalid sort key '{sort}', expected one of {self.SORT_KEYS}")
+
+        counts = [n for n in (top, limit) if n is not None]
+        count = min(counts) if counts else None
+        end = None if count is None else offset + count
+        candidates = self._candidates(service, status, search, ips)
+
+        if sort == "instance":
+            if candidates is not None and end is not None:
+                ips = heapq.nsmallest(end, candidates)
+            else:
+                if self._sorted_ips is None:
+                    self._sorted_ips = sorted(self._rows)
+                ips = self._sorted_ips
+                if candidates is not None:
+                    ips = [ip for ip in ips if ip in candidates]
+            return [self._rows[ip] for ip in ips[offset:end]]
+
+        ips = self._rows.keys() if candidates is None else candidates
+        if sort in ("cpu", "memory"):
+            values = self._cpu if sort == "cpu" else self._memory
+            key = lambda ip: (-values[ip], ip)  # noqa: E731
+        else:
+            column = self.SORT_KEYS.index(sort)
+            key = lambda ip: (self._rows[ip][column], ip)  # noqa: E731
+
+        if end is not None:
+            ips = heapq.nsmallest(end, ips, key=key)
+        else:
+            ips = sorted(ips, key=key)
+        return [self._rows[ip] for ip in ips[offset:end]]
+
+
 class CPXMonitorPrinter:
     """
     Class for printing the result of the CPXMonitor methods in a table format.
+
+    Tables are built by the renderer, a callable taking a title, the columns as
+    (name, justification) pairs, the rows and an optional caption; rich_table by default.
     """
 
-    def __init__(self, cpx_monitor):
+    def __init__(self, cpx_monitor, search_cache=32, renderer=rich_table, trends=None):
         """
         Initializes a new instance of the CPXMonitorPrinter class.
 
         Args:
             cpx_monitor (CPXMonitor): An instance of the CPXMonitor class.
+            search_cache (int): The number of search results cached by the index.
+            renderer (Callable): Builds the tables, rich_table by default.
+            trends (TrendTracker, optional): Updated with every sweep, for the trend columns.
         """
         self.cpx_monitor = cpx_monitor
+        self._metrics = cpx_monitor.metrics
+        self._index = InstanceIndex(search_cache=search_cache, metrics=self._metrics.extra)
+        self._renderer = renderer
+        self._trends = trends
 
-    def get_stats(self, ip=None, service=None, status=None):
+    @property
+    def index(self) -> InstanceIndex:
+        """
+        The index over the statistics of the last fleet-wide sweep.
+        """
+        return self._index
+
+    @property
+    def trends(self):
+        """
+        The trends of the instances over the sweeps so far, if tracked.
+        """
+        return self._trends
+
+    def refresh(self) -> InstanceIndex:
+        """
+        Retrieves performance statistics for all monitored instances and updates the index,
+        and the trends if tracked.
+
+        Returns:
+            The updated index.
+        """
+        stats = self.cpx_monitor.get_stats()
+        self._index.update(stats, replace=True)
+        if self._trends is not None:
+            self._trends.update(stats, replace=True)
+        return self._index
+
+    def _instance_rows(self, rows, trends=False, columns=None):
+        """
+        Appends the trend cells to index rows.
+
+        Args:
+            rows (List[Tuple[str, ...]]): Rows selected from the index.
+            trends (bool): Whether to append the trend cells.
+            columns (Tuple[Tuple[str, str], ...], optional): The columns of the rows,
+                those of the index by default.
+
+        Returns:
+            The columns and the rows.
+        """
+        if columns is None:
+            columns = self._index.columns
+        if not trends:
+            return columns, rows
+        if self._trends is None:
+            raise ValueError("trends are not tracked by this printer")
+        cells = self._trends.cells
+        return columns + TREND_COLUMNS, [list(row) + cells(row[0]) for row in rows]
+
+    def get_stats(
+        self, ip=None, service=None, status=None, sort=None, top=None, limit=None, trends=False, anomalous=False
+    ):
         """
         Retrieves performance statistics for a specified IP address,
         or all monitored instances and prints them in a table format.
@@ -281,38 +1196,54 @@ class CPXMonitorPrinter:
 
             status (str): The status of the instances to retrieve statistics for.
             If None, statistics for all instances will be retrieved.
+
+            sort (str): The column to sort instances by, one of InstanceIndex.SORT_KEYS.
+
+            top (int): Only print the N highest ranked instances according to sort,
+            sorting by CPU usage if sort is not specified.
+
+            limit (int): Print at most N instances.
+
+            trends (bool): Add the trend columns.
+
+            anomalous (bool): Only print anomalous instances, implies trends.
         """
-        stats = self.cpx_monitor.get_stats(ip)
+        if ip is None:
+            index = self.refresh()
+        else:
+            index = InstanceIndex(metrics=self._metrics.extra)
+            index.update(self.cpx_monitor.get_stats(ip))
+            trends = anomalous = False
 
-        table = Table(title="Instance Statistics")
-        table.add_column("Instance", justify="left")
-        table.add_column("Service", justify="left")
-        table.add_column("CPU Usage", justify="right")
-        table.add_column("Memory Usage", justify="right")
-        table.add_column("Status", justify="center")
+        if anomalous and self._trends is None:
+            raise ValueError("trends are not tracked by this printer")
 
-        temp = []
+        rows = index.select(
+            service=service,
+            status=status,
+            sort=sort,
+            top=top,
+            limit=limit,
+            ips=self._trends.anomalous if anomalous else None,
+        )
 
-        for instance_stats in stats:
-            for instance_ip, stats in instance_stats.items():
-                if service is not None and stats["service"].lower() != service.lower():
-                    continue
-                if status is not None and stats["status"].lower() != status.lower():
-                    continue
-                temp.append(
-                    [
-                        instance_ip,
-                        stats["service"],
-                        stats["cpu"],
-                        stats["memory"],
-                        stats["status"],
-                    ]
-                )
+        return self.render_instances(rows, trends=trends or anomalous)
+
+    def render_instances(self, rows, trends=False, metrics=True):
+        """
+        Prints instance rows in a table format.
 
-        [table.add_row(*row) for row in sorted(temp)]
-        return table
+        Args:
+            rows (List[Tuple[str, ...]]):
+                (instance, service, cpu, memory, status) rows, e.g. from InstanceIndex.select,
+                followed by the cells of the extra metrics.
+            trends (bool): Add the trend columns.
+            metrics (bool): Whether the rows have the cells of the extra metrics.
+        """
+        columns, rows = self._instance_rows(rows, trends=trends, columns=None if metrics else INSTANCE_COLUMNS)
+        return self._renderer("Instance Statistics", columns, rows)
 
-    def get_services(self, instances=None, service=None, status=None):
+    def get_services(self, instances=None, service=None, status=None, sample=None, confidence=0.95):
         """
         Retrieves statistics for all services running on the monitored hosts,
         and prints them in a table format.
@@ -324,17 +1255,93 @@ class CPXMonitorPrinter:
                 The name of the service to print the statistics for. Defaults to None.
             status (str, optional):
             The status of the instances to print the statistics for. Defaults to None.
+            sample (float, optional):
+                Only poll this fraction of each service and print estimates. Defaults to None.
+            confidence (float): The confidence level of the estimates when sampling.
+        """
+        if instances is None and sample is None and service is not None:
+            # Only the instances of the service are needed.
+            instances = self.cpx_monitor.get_service_stats(service)
+        stats = self.cpx_monitor.get_services(instances, sample=sample, confidence=confidence)
+        return self.render_services(stats, service=service, status=status)
+
+    def get_service(self, service, worst=5, max_age=0.0):
+        """
+        Retrieves the statistics of the instances of a single service, and prints the
+        service statistics, the percentiles of the instance statistics and the worst
+        instances in table format.
+
+        Args:
+            service (str): The name of the service, case-insensitive.
+            worst (int): The number of instances with the highest CPU or memory usage to print.
+            max_age (float): The age (in seconds) up to which instance statistics are reused,
+                see CPXMonitor.get_service_stats.
+
+        Returns:
+            The tables, none if the service has no instances.
+        """
+        stats = self.cpx_monitor.get_service_stats(service, max_age=max_age)
+        if not stats:
+            return []
+
+        index = InstanceIndex(metrics=self._metrics.extra)
+        index.update(stats)
+        rows = index.select()
+        # CPU and memory usage are parsed once, for both the percentiles and the worst instances.
+        cpu = [_parse_percentage(row[2]) for row in rows]
+        memory = [_parse_percentage(row[3]) for row in rows]
+        instances = [instance for instance_stats in stats for instance in instance_stats.values()]
+        percentiles = []
+        for metric in self._metrics.metrics:
+            if metric.name == "cpu":
+                ordered = sorted(cpu)
+            elif metric.name == "memory":
+                ordered = sorted(memory)
+            else:
+                ordered = sorted(self._metrics.values(metric, instances))
+            if not ordered:
+                continue
+            percentiles.append(
+                [metric.title]
+                + [metric.format(_percentile(ordered, p)) for p in SERVICE_PERCENTILES]
+                + [metric.format(ordered[-1])]
+            )
+        worst_rows = [
+            rows[i]
+            for i in heapq.nsmallest(
+                worst,
+                range(len(rows)),
+                key=lambda i: (-max(cpu[i], memory[i]), -cpu[i], rows[i][0]),
+            )
+        ]
+        return [
+            self.render_services(self.cpx_monitor.get_services(stats)),
+            self._renderer("Instance Percentiles", PERCENTILE_COLUMNS, percentiles),
+            self._renderer(f"Worst {len(worst_rows)} Instances", index.columns, worst_rows),
+        ]
+
+    def render_services(self, stats, service=None, status=None):
+        """
+        Prints service statistics in a table format.
+
+        Args:
+            stats (List[Dict[str, Dict[str, Any]]]):
+                The result of CPXMonitor.get_services or CPXMonitor.iter_service_estimates.
+            service (str, optional):
+                The name of the service to print the statistics for. Defaults to None.
+            status (str, optional):
+            The status of the instances to print the statistics for. Defaults to None.
         """
-        stats = self.cpx_monitor.get_services(instances)
+        estimated = any(
+            service_stats.get("estimated")
+            for item in stats
+            for service_stats in item.values()
+        )
 
-        table = Table(title="Service Statistics")
-        table.add_column("Service", justify="left")
-        table.add_column("CPU Usage", justify="right")
-        table.add_column("Memory Usage", justify="right")
-        table.add_column("Status", justify="center")
-        table.add_column("Healthy Instances", justify="right")
-        table.add_column("Unhealthy Instances", justify="right")
-        table.add_column("Total Instances", justify="right")
+        extra = self._metrics.extra
+        columns = SERVICE_COLUMNS + tuple((metric.title, "right") for metric in extra)
+        if estimated:
+            columns += (("Sampled", "right"),)
 
         temp = []
 
@@ -344,17 +1351,25 @@ class CPXMonitorPrinter:
                     continue
                 if status is not None and stats["status"].lower() != status.lower():
                     continue
-                temp.append(
-                    [
-                        service_name,
-                        stats["cpu"],
-                        stats["memory"],
-                        stats["status"],
-                        str(stats["healthy_instances"]),
-                        str(stats["unhealthy_instances"]),
-                        str(stats["total_instances"]),
-                    ]
-                )
+                row = [
+                    service_name,
+                    stats["cpu"],
+                    stats["memory"],
+                    stats["status"],
+                    str(stats["healthy_instances"]),
+                    str(stats["unhealthy_instances"]),
+                    str(stats["total_instances"]),
+                ]
+                # Estimates don't cover the extra metrics.
+                row.extend(stats.get(metric.name, "") for metric in extra)
+                if estimated:
+                    row[1] += _format_margin(stats["cpu_margin"])
+                    row[2] += _format_margin(stats["memory_margin"])
+                    row.append(str(stats["sampled_instances"]))
+                temp.append(row)
 
-        [table.add_row(*row) for row in sorted(temp)]
-        return table
+        return self._renderer(
+            "Service Statistics (estimated)" if estimated else "Service Statistics",
+            columns,
+            sorted(temp),
+        )
@@ -1,11 +1,13 @@
 import copy
+import json
 import os
 
-from typing import Dict
+from typing import Any, Callable, Dict, Tuple
 from typing import Optional
 
 import yaml
 
+from jsonschema import ValidationError
 from jsonschema import validate
 
 from cpx_health_monitor.exceptions import CPXHealthMonitorException
@@ -20,6 +22,10 @@ class InvalidConfigFilePathError(ConfigLoadingException, ValueError):
     pass
 
 
+class InvalidConfigValueError(ConfigLoadingException, ValueError):
+    pass
+
+
 _CONFIG_SCHEMA = {
     "type": "object",
     "required": [
@@ -29,6 +35,143 @@ _CONFIG_SCHEMA = {
         "logging": {
             "type": "object",
         },
+        "monitor": {
+            "type": "object",
+            "required": ["protocol", "host", "port"],
+            "properties": {
+                "protocol": {"enum": ["http", "https"]},
+                "host": {"type": "string", "minLength": 1},
+                "port": {"type": "integer", "minimum": 1, "maximum": 65535},
+                "concurrency": {"type": "integer", "minimum": 1},
+                "timeout": {"type": ["number", "null"], "exclusiveMinimum": 0},
+                "poll_interval": {"type": "number", "minimum": 0},
+                "servers_ttl": {"type": "number", "minimum": 0},
+                "rate_limit": {
+                    "type": "object",
+                    "properties": {
+                        "rate": {"type": ["number", "null"], "exclusiveMinimum": 0},
+                        "burst": {"type": ["number", "null"], "minimum": 1},
+                        "lock_file": {"type": ["string", "null"]},
+                    },
+                    "additionalProperties": False,
+                },
+                "health": {
+                    "type": "object",
+                    "properties": {
+                        "cpu": {"type": "integer", "minimum": 0, "maximum": 100},
+                        "memory": {"type": "integer", "minimum": 0, "maximum": 100},
+                        "unhealthy_instances": {"type": "integer", "minimum": 0},
+                    },
+                    "additionalProperties": False,
+                },
+                "trends": {
+                    "type": "object",
+                    "properties": {
+                        "alpha": {"type": "number", "exclusiveMinimum": 0, "maximum": 1},
+                        "z_threshold": {"type": "number", "exclusiveMinimum": 0},
+                        "warmup": {"type": "integer", "minimum": 1},
+                        "growth_sweeps": {"type": "integer", "minimum": 1},
+                        "growth_min": {"type": "integer", "minimum": 0},
+                    },
+                    "additionalProperties": False,
+                },
+                "memory": {
+                    "type": "object",
+                    "properties": {
+                        "state_ttl": {"type": ["number", "null"], "minimum": 0},
+                        "search_cache": {"type": "integer", "minimum": 0},
+                        "state_file": {"type": ["string", "null"]},
+                    },
+                    "additionalProperties": False,
+                },
+                "hedging": {
+                    "type": "object",
+                    "properties": {
+                        "enabled": {"type": "boolean"},
+                        "percentile": {"type": "number", "exclusiveMinimum": 0, "exclusiveMaximum": 100},
+                        "budget": {"type": "number", "minimum": 0},
+                        "min_samples": {"type": "integer", "minimum": 1},
+                        "window": {"type": "integer", "minimum": 1},
+                        "min_delay": {"type": "number", "minimum": 0},
+                    },
+                    "additionalProperties": False,
+                },
+                "metrics": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "required": ["name"],
+                        "properties": {
+                            "name": {"type": "string", "minLength": 1},
+                            "field": {"type": "string", "minLength": 1},
+                            "type": {"enum": ["percentage", "integer", "number"]},
+                            "label": {"type": "string"},
+                            "unit": {"type": "string"},
+                            "unhealthy_from": {"type": ["number", "null"]},
+                            "unhealthy_below": {"type": ["number", "null"]},
+                            "aggregate": {"enum": ["mean", "max", "sum"]},
+                        },
+                        "additionalProperties": False,
+                    },
+                },
+                "output": {
+                    "type": "object",
+                    "properties": {
+                        "sort": {
+                            "enum": [None, "instance", "service", "cpu", "memory", "status"],
+                        },
+                        "limit": {"type": ["integer", "null"], "minimum": 1},
+                    },
+                    "additionalProperties": False,
+                },
+            },
+            "additionalProperties": False,
+        },
+        "alerts": {
+            "type": "object",
+            "properties": {
+                "rules": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "required": ["name", "metric"],
+                        "properties": {
+                            "name": {"type": "string"},
+                            "scope": {"enum": ["instance", "service"]},
+                            "metric": {"type": "string"},
+                            "above": {"type": "number"},
+                            "below": {"type": "number"},
+                            "equals": {"type": ["string", "number"]},
+                            "for": {"type": "integer", "minimum": 1},
+                            "window": {"type": "integer", "minimum": 1},
+                            "percentile": {"type": "number", "minimum": 0, "maximum": 100},
+                        },
+                        "additionalProperties": False,
+                    },
+                },
+                "sinks": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "required": ["type"],
+                        "properties": {
+                            "type": {"enum": ["stdout", "file", "webhook"]},
+                            "path": {"type": "string"},
+                            "url": {"type": "string"},
+                            "timeout": {"type": "number", "exclusiveMinimum": 0},
+                        },
+                    },
+                },
+            },
+        },
+        "serve": {
+            "type": "object",
+            "properties": {
+                "host": {"type": "string", "minLength": 1},
+                "port": {"type": "integer", "minimum": 0, "maximum": 65535},
+            },
+            "additionalProperties": False,
+        },
     },
 }
 
@@ -43,6 +186,10 @@ _CONFIG_DEFAULTS = {
                 "format": "%(asctime)s [%(levelname).1s] [%(hostname)s %(process)s %(threadName)s] %(message)s",
                 "datefmt": "%Y-%m-%d %H:%M:%S.%f %z",
             },
+            "json": {
+                "()": "cpx_health_monitor.logging.JsonLogRecordFormatter",
+                "datefmt": "%Y-%m-%dT%H:%M:%S.%f%z",
+            },
         },
         "filters": {
             "hostname_injector": {
@@ -53,24 +200,122 @@ _CONFIG_DEFAULTS = {
             "console": {
                 "level": "INFO",
                 "formatter": "generic",
-                "class": "logging.StreamHandler",
-                "stream": "ext://sys.stdout",
+                "class": "cpx_health_monitor.logging.StandardStreamHandler",
+                "stream_name": "stderr",
                 "filters": [
                     "hostname_injector",
                 ],
             },
+            # Formats and writes records of the handlers it refers to from a background
+            # thread. Handlers are configured alphabetically, so the names of the
+            # handlers it refers to must sort before "queue".
+            "queue": {
+                "()": "cpx_health_monitor.logging.QueueListenerHandler",
+                "handlers": ["cfg://handlers.console"],
+                "queue_size": 10000,
+            },
         },
         "loggers": {
             "": {
-                "handlers": ["console"],
+                "handlers": ["queue"],
                 "level": "INFO",
             },
         },
     },
+    "monitor": {
+        "protocol": "http",
+        "host": "localhost",
+        "port": 8085,
+        # Number of instances queried in parallel during a sweep.
+        "concurrency": 1,
+        # Seconds to wait for each CPX API response, null waits forever.
+        "timeout": 10.0,
+        # Seconds between two sweeps of the watch commands.
+        "poll_interval": 1.0,
+        # Seconds the /servers list is reused for before being fetched again.
+        "servers_ttl": 0,
+        "rate_limit": {
+            # Requests per second to the CPX API, null doesn't limit them.
+            "rate": None,
+            # Requests that can be issued at once, defaults to one second worth.
+            "burst": None,
+            # Shares the limit between all the processes using this file.
+            "lock_file": None,
+        },
+        "health": {
+            # Instances are unhealthy from this CPU or memory usage (%).
+            "cpu": 80,
+            "memory": 80,
+            # Services are unhealthy beyond this number of unhealthy instances.
+            "unhealthy_instances": 2,
+        },
+        "trends": {
+            # Weight of each new sweep in the per-instance baselines and slopes.
+            "alpha": 0.1,
+            # Instances are anomalous from this many standard deviations off their baseline,
+            "z_threshold": 3.0,
+            # once they have been seen for this many sweeps.
+            "warmup": 5,
+            # Memory growing by growth_min % over growth_sweeps sweeps without ever decreasing is a leak.
+            "growth_sweeps": 10,
+            "growth_min": 10,
+        },
+        "memory": {
+            # Seconds the last statistics of an instance are kept once it stops responding,
+            # null keeps them until it leaves the fleet.
+            "state_ttl": 300,
+            # Search results of the instances watch view kept until the next sweep.
+            "search_cache": 32,
+            # The services of the instances, and the statistics of those of the services shown,
+            # are kept in this file between runs (for state_ttl seconds), null disables it.
+            "state_file": "~/.cache/cpxstat/state.json",
+        },
+        "hedging": {
+            # Requests of sweeps slower than the percentile-th latency of the last window
+            # responses are duplicated, and the first response is used,
+            "enabled": False,
+            "percentile": 95,
+            "window": 1000,
+            # once min_samples responses were observed, and never before min_delay seconds.
+            "min_samples": 50,
+            "min_delay": 0.005,
+            # Duplicates are limited to this fraction of the requests.
+            "budget": 0.05,
+        },
+        # Metrics reported by the CPX API besides cpu and memory, e.g.
+        # {"name": "latency", "type": "number", "unit": "ms", "unhealthy_from": 500, "aggregate": "max"}.
+        "metrics": [],
+        "output": {
+            "sort": None,
+            "limit": None,
+        },
+    },
+    "alerts": {
+        "rules": [],
+        "sinks": [
+            {
+                "type": "stdout",
+            },
+        ],
+    },
+    "serve": {
+        # Where "cpxstat serve" listens for JSON and Prometheus scrapes.
+        "host": "127.0.0.1",
+        "port": 9185,
+    },
 }
 
 
 _CONFIG_ENV_VARS_MAP = {
+    "monitor": {
+        "protocol": "CPX_HEALTH_MONITOR_PROTOCOL",
+        "host": "CPX_HEALTH_MONITOR_HOST",
+        "port": "CPX_HEALTH_MONITOR_PORT",
+        "concurrency": "CPX_HEALTH_MONITOR_CONCURRENCY",
+        "timeout": "CPX_HEALTH_MONITOR_TIMEOUT",
+        "poll_interval": "CPX_HEALTH_MONITOR_POLL_INTERVAL",
+        "servers_ttl": "CPX_HEALTH_MONITOR_SERVERS_TTL",
+    },
     "logging": {
         "formatters": {
             "generic": {
@@ -78,6 +323,17 @@ _CONFIG_ENV_VARS_MAP = {
                 "datefmt": "CPX_HEALTH_MONITOR_GENERIC_LOG_DATE_FMT",
             },
         },
+        "handlers": {
+            "console": {
+                "formatter": "CPX_HEALTH_MONITOR_LOG_FORMATTER",
+                "level": "CPX_HEALTH_MONITOR_LOG_LEVEL",
+            },
+        },
+        "loggers": {
+            "": {
+                "level": "CPX_HEALTH_MONITOR_LOG_LEVEL",
+            },
+        },
     },
 }
 
@@ -121,23 +377,91 @@ def _maybe_override_log_date_format_from_env(config: Dict, formatter_name: str)
         config["logging"]["formatters"][formatter_name]["datefmt"] = value
 
 
+def _maybe_override_log_handler_from_env(config: Dict, handler_name: str) -> None:
+    for key, env_var in _CONFIG_ENV_VARS_MAP["logging"]["handlers"][handler_name].items():
+        value = os.environ.get(env_var)
+        if value:
+            config["logging"]["handlers"][handler_name][key] = value
+
+
+def _maybe_override_log_level_from_env(config: Dict, logger_name: str) -> None:
+    value = os.environ.get(
+        _CONFIG_ENV_VARS_MAP["logging"]["loggers"][logger_name]["level"]
+    )
+    if value:
+        config["logging"]["loggers"][logger_name]["level"] = value
+
+
 def _maybe_override_logging(config: Dict) -> None:
     _maybe_override_log_record_format_from_env(config, "generic")
     _maybe_override_log_date_format_from_env(config, "generic")
+    _maybe_override_log_handler_from_env(config, "console")
+    _maybe_override_log_level_from_env(config, "")
+
+
+_MONITOR_ENV_VARS_TYPES: Dict[str, Callable[[str], Any]] = {
+    "port": int,
+    "concurrency": int,
+    "timeout": float,
+    "poll_interval": float,
+    "servers_ttl": float,
+}
+
+
+def _maybe_override_monitor(config: Dict) -> None:
+    for key, env_var in _CONFIG_ENV_VARS_MAP["monitor"].items():
+        value = os.environ.get(env_var)
+        if not value:
+            continue
+        try:
+            config["monitor"][key] = _MONITOR_ENV_VARS_TYPES.get(key, str)(value)
+        except ValueError:
+            raise InvalidConfigValueError(f"invalid value for {env_var}: '{value}'") from None
 
 
 def _maybe_override_from_env(config: Dict) -> None:
     _maybe_override_logging(config)
+    _maybe_override_monitor(config)
+
+
+def _maybe_override_from_args(config: Dict, overrides: Optional[Dict] = None) -> None:
+    if overrides:
+        update_nested_dict(config, overrides)
 
 
 def try_to_load_config(
     file_path: Optional[str] = None,
     section_name: Optional[str] = None,
-    # extra params passed from CLI args
+    overrides: Optional[Dict] = None,
 ) -> Dict:
     config = copy.deepcopy(_CONFIG_DEFAULTS)
     _maybe_override_from_file(config, file_path, section_name)
     _maybe_override_from_env(config)
-    # override from CLI args if passed as extra params
-    validate(config, _CONFIG_SCHEMA)
+    _maybe_override_from_args(config, overrides)
+    try:
+        validate(config, _CONFIG_SCHEMA)
+    except ValidationError as e:
+        path = ".".join(str(p) for p in e.absolute_path)
+        raise InvalidConfigValueError(f"invalid config at '{path}': {e.message}") from None
+    return config
+
+
+_CONFIG_CACHE: Dict[Tuple[Optional[str], Optional[str], str], Dict] = {}
+
+
+def get_config(
+    file_path: Optional[str] = None,
+    section_name: Optional[str] = None,
+    overrides: Optional[Dict] = None,
+) -> Dict:
+    """
+    Same as try_to_load_config, but the config is loaded and validated only once
+    per set of arguments. The returned config is shared and must not be modified.
+    """
+    key = (file_path, section_name, json.dumps(overrides, sort_keys=True))
+    config = _CONFIG_CACHE.get(key)
+    if config is None:
+        config = _CONFIG_CACHE[key] = try_to_load_config(
+            file_path, section_name, overrides
+        )
     return config
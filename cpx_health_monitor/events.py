@@ -0,0 +1,200 @@
+import json
+import time
+
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from cpx_health_monitor.classmodules import CPXMonitor, _parse_percentage
+
+
+EVENT_ADDED = "added"
+EVENT_REMOVED = "removed"
+EVENT_STATUS = "status"
+EVENT_CPU = "cpu"
+EVENT_MEMORY = "memory"
+
+EVENT_KINDS = (EVENT_ADDED, EVENT_REMOVED, EVENT_STATUS, EVENT_CPU, EVENT_MEMORY)
+
+
+class ChangeEvent(NamedTuple):
+    kind: str
+    instance: str
+    service: str
+    old: Any
+    new: Any
+    timestamp: float
+
+    def to_dict(self) -> Dict[str, Any]:
+        return self._asdict()
+
+    def to_json(self) -> str:
+        return json.dumps(self._asdict())
+
+    def __str__(self) -> str:
+        if self.kind == EVENT_ADDED:
+            change = "added"
+        elif self.kind == EVENT_REMOVED:
+            change = "removed"
+        else:
+            change = f"{self.kind} {self.old} -> {self.new}"
+        return f"{self.instance} ({self.service}) {change}"
+
+
+def to_snapshot(stats: List[Dict[str, Dict[str, str]]]) -> Dict[str, Dict[str, str]]:
+    """
+    Converts the result of CPXMonitor.get_stats to a dictionary keyed by instance IP.
+
+    Args:
+        stats (List[Dict[str, Dict[str, str]]]): The result of CPXMonitor.get_stats.
+
+    Returns:
+        The statistics of each instance, by IP.
+    """
+    snapshot = {}
+    for instance_stats in stats:
+        snapshot.update(instance_stats)
+    return snapshot
+
+
+class ChangeTracker:
+    """
+    Computes change events between consecutive snapshots of the fleet.
+
+    Instances are compared by IP, so the cost of a diff is linear in the fleet size and
+    the number of events only depends on what changed. CPU and memory events are emitted
+    when the usage moved by at least the configured delta since it was last reported,
+    so that slow drifts are eventually reported too.
+
+    Methods:
+        update(stats: List[Dict[str, Dict[str, str]]], timestamp: float=None) -> List[ChangeEvent]:
+            Returns the changes since the previous snapshot.
+    """
+
+    def __init__(self, cpu_delta: int = 10, memory_delta: int = 10, initial: bool = False) -> None:
+        """
+        Initializes a new instance of the ChangeTracker class.
+
+        Args:
+            cpu_delta (int): The CPU usage change (%) that triggers an event.
+            memory_delta (int): The memory usage change (%) that triggers an event.
+            initial (bool): Whether the first snapshot emits an "added" event per instance.
+        """
+        self._cpu_delta = cpu_delta
+        self._memory_delta = memory_delta
+        self._initial = initial
+        self._snapshot: Optional[Dict[str, Dict[str, str]]] = None
+        # Last reported (cpu, memory) of each instance.
+        self._reported: Dict[str, Tuple[int, int]] = {}
+
+    def __len__(self) -> int:
+        return len(self._reported)
+
+    def update(
+        self, stats: List[Dict[str, Dict[str, str]]], timestamp: Optional[float] = None
+    ) -> List[ChangeEvent]:
+        """
+        Returns the changes between the previous snapshot and the given one.
+
+        Args:
+            stats (List[Dict[str, Dict[str, str]]]): The result of CPXMonitor.get_stats.
+            timestamp (float, optional): When the snapshot was taken. Defaults to now.
+
+        Returns:
+            The change events, in no particular order.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+
+        current = to_snapshot(stats)
+        previous = self._snapshot
+        self._snapshot = current
+        events = []
+
+        if previous is None:
+            for ip, instance in current.items():
+                self._reported[ip] = (
+                    _parse_percentage(instance["cpu"]),
+                    _parse_percentage(instance["memory"]),
+                )
+                if self._initial:
+                    events.append(
+                        ChangeEvent(EVENT_ADDED, ip, instance["service"], None, instance, timestamp)
+                    )
+            return events
+
+        added = 0
+        for ip, instance in current.items():
+            old = previous.get(ip)
+            cpu = _parse_percentage(instance["cpu"])
+            memory = _parse_percentage(instance["memory"])
+
+            if old is None:
+                self._reported[ip] = (cpu, memory)
+                added += 1
+                events.append(
+                    ChangeEvent(EVENT_ADDED, ip, instance["service"], None, instance, timestamp)
+                )
+                continue
+
+            if old["status"] != instance["status"]:
+                events.append(
+                    ChangeEvent(
+                        EVENT_STATUS, ip, instance["service"], old["status"], instance["status"], timestamp
+                    )
+                )
+
+            reported_cpu, reported_memory = self._reported[ip]
+            if abs(cpu - reported_cpu) >= self._cpu_delta:
+                events.append(
+                    ChangeEvent(EVENT_CPU, ip, instance["service"], reported_cpu, cpu, timestamp)
+                )
+                reported_cpu = cpu
+            if abs(memory - reported_memory) >= self._memory_delta:
+                events.append(
+                    ChangeEvent(EVENT_MEMORY, ip, instance["service"], reported_memory, memory, timestamp)
+                )
+                reported_memory = memory
+            self._reported[ip] = (reported_cpu, reported_memory)
+
+        # Every instance of the current snapshot that isn't new was in the previous one,
+        # so the previous snapshot only needs to be scanned if some of it is missing.
+        if len(previous) > len(current) - added:
+            for ip, instance in previous.items():
+                if ip not in current:
+                    del self._reported[ip]
+                    events.append(
+                        ChangeEvent(EVENT_REMOVED, ip, instance["service"], instance, None, timestamp)
+                    )
+
+        return events
+
+
+def iter_events(
+    monitor: CPXMonitor,
+    interval: float = 1.0,
+    cpu_delta: int = 10,
+    memory_delta: int = 10,
+    initial: bool = False,
+    count: Optional[int] = None,
+) -> Iterator[ChangeEvent]:
+    """
+    Sweeps the fleet every interval seconds and yields the changes between consecutive sweeps.
+
+    Args:
+        monitor (CPXMonitor): The monitor to sweep the fleet with.
+        interval (float): The number of seconds between the start of two sweeps.
+        cpu_delta (int): The CPU usage change (%) that triggers an event.
+        memory_delta (int): The memory usage change (%) that triggers an event.
+        initial (bool): Whether the first sweep yields an "added" event per instance.
+        count (int, optional): Stop after this many sweeps. Defaults to sweeping forever.
+
+    Yields:
+        The change events.
+    """
+    tracker = ChangeTracker(cpu_delta=cpu_delta, memory_delta=memory_delta, initial=initial)
+    sweeps = 0
+    while count is None or sweeps < count:
+        started = time.monotonic()
+        yield from tracker.update(monitor.get_stats())
+        sweeps += 1
+        if count is None or sweeps < count:
+            time.sleep(max(interval - (time.monotonic() - started), 0))
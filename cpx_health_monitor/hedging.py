@@ -0,0 +1,174 @@
+import threading
+import time
+
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Deque, Dict, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class Hedger:
+    """
+    Hedged requests: when a request takes longer than the observed pNN latency,
+    a duplicate is issued and whichever responds first is used, so that a sweep
+    is not held up by the slowest few instances.
+
+    Duplicates are limited to a fraction of the requests (the extra-load budget).
+    The losing request of a pair can't be cancelled and completes in the background.
+
+    Attributes:
+        requests (int): The number of hedged calls.
+        fired (int): The number of duplicates issued.
+        won (int): The number of duplicates that responded first.
+        skipped (int): The number of duplicates not issued because of the budget.
+    """
+
+    # The latency threshold is only recomputed every few samples.
+    _RECOMPUTE_EVERY = 32
+
+    def __init__(
+        self,
+        percentile: float = 95,
+        budget: float = 0.05,
+        min_samples: int = 50,
+        window: int = 1000,
+        min_delay: float = 0.005,
+        max_workers: int = 20,
+    ) -> None:
+        """
+        Initializes a new instance of the Hedger class.
+
+        Args:
+            percentile (float): The latency percentile after which a duplicate is issued.
+            budget (float): The maximum number of duplicates, as a fraction of the requests.
+            min_samples (int): The number of latencies observed before hedging starts.
+            window (int): The number of most recent latencies the percentile is computed over.
+            min_delay (float): The minimum number of seconds before a duplicate is issued.
+            max_workers (int): The number of threads requests and duplicates run on.
+        """
+        if not 0 < percentile < 100:
+            raise ValueError("percentile must be in (0, 100)")
+
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self._latencies: Deque[float] = deque(maxlen=window)
+        self._threshold: Optional[float] = None
+        self._since_recompute = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="cpx-hedge")
+        self.requests = 0
+        self.fired = 0
+        self.won = 0
+        self.skipped = 0
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any], concurrency: int = 1) -> Optional["Hedger"]:
+        """
+        Builds a hedger from the monitor.hedging section of the config.
+
+        Args:
+            config (Dict[str, Any]): The hedging section of the config.
+            concurrency (int): The number of instances queried in parallel during a sweep.
+
+        Returns:
+            The hedger, or None if requests are not hedged.
+        """
+        if not config or not config.get("enabled"):
+            return None
+        return cls(
+            percentile=config.get("percentile", 95),
+            budget=config.get("budget", 0.05),
+            min_samples=config.get("min_samples", 50),
+            window=config.get("window", 1000),
+            min_delay=config.get("min_delay", 0.005),
+            # Every sweep worker may wait on a request, a duplicate and a loser still running.
+            max_workers=max(3 * concurrency, 4),
+        )
+
+    @property
+    def threshold(self) -> Optional[float]:
+        """
+        The current pNN latency in seconds, None until enough latencies were observed.
+        """
+        return self._threshold
+
+    def _record(self, latency: float) -> None:
+        with self._lock:
+            self._latencies.append(latency)
+            self._since_recompute += 1
+            if len(self._latencies) < self.min_samples:
+                return
+            if self._threshold is None or self._since_recompute >= self._RECOMPUTE_EVERY:
+                ordered = sorted(self._latencies)
+                rank = min(int(len(ordered) * self.percentile / 100), len(ordered) - 1)
+                self._threshold = max(ordered[rank], self.min_delay)
+                self._since_recompute = 0
+
+    def _timed(self, function: Callable[[], T]) -> T:
+        started = time.monotonic()
+        result = function()
+        self._record(time.monotonic() - started)
+        return result
+
+    def _take_budget(self) -> bool:
+        with self._lock:
+            if self.fired + 1 > self.budget * self.requests:
+                self.skipped += 1
+                return False
+            self.fired += 1
+            return True
+
+    def call(self, function: Callable[[], T]) -> T:
+        """
+        Calls a function, calling it a second time in parallel if the first call takes
+        longer than the pNN latency, and returns the first successful result.
+
+        Args:
+            function (Callable[[], T]): The request, safe to issue twice.
+
+        Returns:
+            The result of the first call to succeed.
+
+        Raises:
+            The exception of the first call if both calls failed.
+        """
+        with self._lock:
+            self.requests += 1
+        threshold = self._threshold
+        if threshold is None:
+            return self._timed(function)
+
+        primary = self._executor.submit(self._timed, function)
+        done, _ = wait([primary], timeout=threshold)
+        if done or not self._take_budget():
+            return primary.result()
+
+        hedge = self._executor.submit(self._timed, function)
+        pending = {primary, hedge}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is hedge:
+                        with self._lock:
+                            self.won += 1
+                    return future.result()
+        return primary.result()
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Returns the hedging counters and the current latency threshold.
+        """
+        return {
+            "requests": self.requests,
+            "fired": self.fired,
+            "won": self.won,
+            "skipped": self.skipped,
+            "threshold": self._threshold or 0.0,
+        }
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False)
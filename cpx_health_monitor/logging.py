@@ -1,9 +1,15 @@
+import copy
+import json
 import logging
 import logging.config
+import logging.handlers
+import queue
+import re
 import socket
+import sys
 
 from datetime import datetime
-from typing import Dict
+from typing import Dict, List
 
 import pytz
 
@@ -20,6 +26,9 @@ class LogRecordFormatter(logging.Formatter):
     """
     Override standard implementation to support both microseconds and TZ.
 
+    The formatted date is cached for the current second, so that only the
+    microseconds are formatted for each record instead of calling strftime.
+
     See also:
         https://github.com/python/cpython/blob/v3.7.3/Lib/logging/__init__.py#L539-L563
         https://github.com/python/cpython/blob/v3.7.3/Lib/logging/__init__.py#L298
@@ -29,18 +38,136 @@ class LogRecordFormatter(logging.Formatter):
 
     converter = datetime.fromtimestamp
     _tz = pytz.UTC
+    _MICROSECONDS = "\x00"
+    _DIRECTIVE = re.compile(r"(%.)")
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        # (second, datefmt, formatted date), replaced as a whole to stay thread-safe.
+        self._cache = (None, None, None)
 
     def formatTime(self, record: logging.LogRecord, datefmt: str = None) -> str:
-        ct = self.converter(record.created, self._tz)
+        second = int(record.created)
+        cached_second, cached_datefmt, s = self._cache
 
-        if datefmt:
-            s = ct.strftime(datefmt)
-        else:
-            t = ct.strftime("%Y-%m-%d %H:%M:%S")
-            s = "%s,%03d" % (t, record.msecs)
+        if cached_second != second or cached_datefmt != datefmt:
+            ct = self.converter(second, self._tz)
+            if datefmt:
+                # strftime can't be given the placeholder, format around each %f instead.
+                segments = [[]]
+                for token in self._DIRECTIVE.split(datefmt):
+                    if token == "%f":
+                        segments.append([])
+                    else:
+                        segments[-1].append(token)
+                s = self._MICROSECONDS.join(
+                    ct.strftime("".join(segment)) for segment in segments
+                )
+            else:
+                s = ct.strftime("%Y-%m-%d %H:%M:%S")
+            self._cache = (second, datefmt, s)
 
+        if not datefmt:
+            return "%s,%03d" % (s, record.msecs)
+        if self._MICROSECONDS in s:
+            microseconds = int((record.created - second) * 1e6)
+            s = s.replace(self._MICROSECONDS, "%06d" % microseconds)
         return s
 
 
+class JsonLogRecordFormatter(LogRecordFormatter):
+    """
+    Formats records as single line JSON documents.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        document = {
+            "timestamp": self.formatTime(record, self.datefmt),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "hostname": getattr(record, "hostname", None),
+            "process": record.process,
+            "thread": record.threadName,
+        }
+        if record.exc_info:
+            document["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(document)
+
+
+class StandardStreamHandler(logging.StreamHandler):
+    """
+    StreamHandler writing to whatever sys.stdout or sys.stderr currently is,
+    so that output redirected by rich.live.Live is printed above the live display
+    instead of corrupting it.
+    """
+
+    def __init__(self, stream_name: str = "stderr") -> None:
+        if stream_name not in ("stdout", "stderr"):
+            raise ValueError(f"invalid stream name '{stream_name}'")
+        self._stream_name = stream_name
+        super().__init__()
+
+    @property
+    def stream(self):
+        return getattr(sys, self._stream_name)
+
+    @stream.setter
+    def stream(self, value) -> None:
+        pass
+
+
+class QueueListenerHandler(logging.handlers.QueueHandler):
+    """
+    Hands records over to a background thread, which passes them to the given handlers,
+    so that logging never blocks the caller on I/O.
+
+    When the queue is full, records are dropped rather than blocking.
+
+    Handlers are referred to with "cfg://handlers.<name>" in the logging config.
+    As handlers are configured in alphabetical order, their names must sort before
+    the name of this handler.
+    """
+
+    def __init__(self, handlers: List[logging.Handler], queue_size: int = 10000) -> None:
+        super().__init__(queue.Queue(maxsize=queue_size))
+        # Indexing resolves the "cfg://" references of the ConvertingList built by dictConfig.
+        handlers = [handlers[i] for i in range(len(handlers))]
+        for handler in handlers:
+            if not isinstance(handler, logging.Handler):
+                raise ValueError(
+                    "queued handlers must be configured before the queue handler, "
+                    "give it a name that sorts after theirs"
+                )
+
+        self.dropped = 0
+        self._listener = logging.handlers.QueueListener(
+            self.queue, *handlers, respect_handler_level=True
+        )
+        self._listener.start()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Unlike QueueHandler.prepare, the record isn't formatted on the caller thread: the handlers
+        # of the listener format it, with exc_info intact for structured formatters. Only the message
+        # is resolved, as its arguments may change once the caller moves on.
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self) -> None:
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
+        super().close()
+
+
 def setup_logging(config: Dict) -> None:
-    logging.config.dictConfig(config)
+    # dictConfig replaces handler configs with handler instances, keep the given config intact
+    logging.config.dictConfig(copy.deepcopy(config))
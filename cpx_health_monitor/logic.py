@@ -1,11 +1,21 @@
 #!/usr/bin/env python3
 
-import os
 import time
 import click
+from cpx_health_monitor.alerts import AlertEngine, build_alert_engine
 from cpx_health_monitor.classmodules import CPXMonitor, CPXMonitorPrinter
+from cpx_health_monitor.config import get_config
+from cpx_health_monitor.events import ChangeTracker, iter_events
+from cpx_health_monitor.logging import QueueListenerHandler, setup_logging
+from cpx_health_monitor.memory import memory_report, resident_memory
+from cpx_health_monitor.serve import MonitorServer
+from cpx_health_monitor.snapshot import SnapshotFile, save_snapshot
+from cpx_health_monitor.trends import TrendTracker
+from cpx_health_monitor.replay import ReplayExhaustedError, ReplayMonitor, SweepLog, SweepRecorder
+from cpx_health_monitor.view import InstanceTableView, KeyReader
 from rich.console import Console
 from rich.live import Live
+from rich.table import Table
 
 import logging
 
@@ -20,6 +30,8 @@ def run(group, command, *args) -> None:
         __version__,
     )
     try:
+        if cpx is None:
+            configure()
         if group == "instances":
             if command == "list":
                 run_list_instances(*args)
@@ -27,6 +39,8 @@ def run(group, command, *args) -> None:
                 run_watch_instances(*args)
             elif command == "show":
                 run_show_instance(*args)
+            elif command == "events":
+                run_instance_events(*args)
             else:
                 raise click.UsageError(
                     f"""Invalid command '{command}'.
@@ -44,6 +58,34 @@ def run(group, command, *args) -> None:
                     f"""Invalid command '{command}'.
                     See 'cpxstat --help' for available commands."""
                 )
+        elif group == "alerts":
+            if command == "watch":
+                run_watch_alerts(*args)
+            else:
+                raise click.UsageError(
+                    f"""Invalid command '{command}'.
+                    See 'cpxstat --help' for available commands."""
+                )
+        elif group == "snapshot":
+            if command == "save":
+                run_save_snapshot(*args)
+            elif command == "load":
+                run_load_snapshot(*args)
+            else:
+                raise click.UsageError(
+                    f"""Invalid command '{command}'.
+                    See 'cpxstat --help' for available commands."""
+                )
+        elif group == "serve":
+            run_serve(*args)
+        elif group == "memory":
+            if command == "report":
+                run_memory_report(*args)
+            else:
+                raise click.UsageError(
+                    f"""Invalid command '{command}'.
+                    See 'cpxstat --help' for available commands."""
+                )
         else:
             raise click.UsageError(
                 f"""Invalid command '{group}'.
@@ -51,6 +93,8 @@ def run(group, command, *args) -> None:
             )
             # click.echo(f"Error: Invalid command '{command}'")
             # click.echo("Run 'cpxstat --help' for more information.")
+    except ReplayExhaustedError:
+        LOG.info("replay finished")
     except Exception as e:
         raise click.ClickException(str(e))
         # click.echo(f"Error: {e}")
@@ -59,32 +103,177 @@ def run(group, command, *args) -> None:
 
 console = Console()
 
-cpx_protocol = os.getenv("CPX_HEALTH_MONITOR_PROTOCOL") if os.getenv(
-    "CPX_HEALTH_MONITOR_PROTOCOL") else "http"
-cpx_host = os.getenv("CPX_HEALTH_MONITOR_HOST") if os.getenv(
-    "CPX_HEALTH_MONITOR_HOST") else "localhost"
-cpx_port = os.getenv("CPX_HEALTH_MONITOR_PORT") if os.getenv(
-    "CPX_HEALTH_MONITOR_PORT") else 8085
+# Set by configure(), when the first command runs rather than on import.
+config = None
+cpx = None
+printer = None
 
 
-cpx = CPXMonitor(protocol=cpx_protocol, host=cpx_host,
-                 port=cpx_port)  # TODO: Initialise from config
-printer = CPXMonitorPrinter(cpx_monitor=cpx)
+def configure(
+    config_path=None,
+    overrides=None,
+    record=None,
+    replay=None,
+    replay_speed=1.0,
+    replay_loop=False,
+    cpx_monitor=None,
+) -> None:
+    # Reload the config and rebind the monitor, e.g. to record live sweeps, to replay recorded ones
+    # or to use a monitor built by the caller (cpx_monitor)
+    global config, cpx, printer
+
+    config = get_config(file_path=config_path, overrides=overrides)
+    if config_path:
+        setup_logging(config["logging"])
+    recorder = SweepRecorder(record) if record else None
+    if cpx is not None and cpx is not cpx_monitor:
+        cpx.close()
+    if cpx_monitor is not None:
+        cpx = cpx_monitor
+    elif replay:
+        cpx = ReplayMonitor.from_config(
+            config["monitor"], SweepLog(replay), speed=replay_speed, loop=replay_loop, recorder=recorder
+        )
+    else:
+        cpx = CPXMonitor.from_config(config["monitor"], recorder=recorder)
+    printer = CPXMonitorPrinter(
+        cpx_monitor=cpx,
+        search_cache=config["monitor"]["memory"]["search_cache"],
+        trends=TrendTracker.from_config(config["monitor"]["trends"]),
+    )
+
+
+def _poll_interval():
+    return config["monitor"]["poll_interval"]
+
+
+def _live():
+    # Full screen on terminals; elsewhere, e.g. when piped, the last refresh is printed on exit
+    return Live(console=console, screen=console.is_terminal, auto_refresh=False)
+
+
+def _output_defaults(sort, limit):
+    output = config["monitor"]["output"]
+    return (
+        sort if sort is not None else output["sort"],
+        limit if limit is not None else output["limit"],
+    )
 
 
-def run_list_instances(service=None, status=None):
+def run_list_instances(
+    service=None,
+    status=None,
+    sort=None,
+    top=None,
+    limit=None,
+    trends=False,
+    anomalous=False,
+    from_snapshot=None,
+):
     # Implementation logic for listing instances
-    console.print(printer.get_stats(status=status, service=service))
+    sort, limit = _output_defaults(sort, limit)
+    if from_snapshot:
+        if trends or anomalous:
+            raise click.UsageError("Snapshots don't have trends")
+        # Only the selected rows are read from the snapshot
+        with SnapshotFile(from_snapshot) as snapshot:
+            rows = snapshot.select(service=service, status=status, sort=sort, top=top, limit=limit)
+        # Snapshots only have the CPU and memory columns
+        console.print(printer.render_instances(rows, metrics=False))
+        return
+    if trends or anomalous:
+        # Trends need a baseline, sweep until every instance is warmed up
+        for _ in range(printer.trends.warmup):
+            started = time.monotonic()
+            printer.refresh()
+            time.sleep(max(_poll_interval() - (time.monotonic() - started), 0))
+    console.print(
+        printer.get_stats(
+            status=status,
+            service=service,
+            sort=sort,
+            top=top,
+            limit=limit,
+            trends=trends,
+            anomalous=anomalous,
+        )
+    )
 
 
-def run_watch_instances(service=None, status=None):
+def run_watch_instances(
+    service=None,
+    status=None,
+    sort=None,
+    top=None,
+    limit=None,
+    trends=False,
+    anomalous=False,
+    count=None,
+):
     # Implementation logic for watching instances
-    with Live(console=console, screen=True, auto_refresh=False) as live:
-        while True:
+    sort, limit = _output_defaults(sort, limit)
+    if top is None and limit is None:
+        run_browse_instances(
+            service=service,
+            status=status,
+            sort=sort,
+            trends=trends,
+            anomalous=anomalous,
+            count=count,
+        )
+        return
+
+    with _live() as live:
+        refreshes = 0
+        while count is None or refreshes < count:
             live.update(
-                printer.get_stats(status=status, service=service), refresh=True
+                printer.get_stats(
+                    status=status,
+                    service=service,
+                    sort=sort,
+                    top=top,
+                    limit=limit,
+                    trends=trends,
+                    anomalous=anomalous,
+                ),
+                refresh=True,
             )
-            time.sleep(1)
+            refreshes += 1
+            if count is None or refreshes < count:
+                time.sleep(_poll_interval())
+
+
+def run_browse_instances(
+    service=None, status=None, sort=None, interval=None, trends=False, anomalous=False, count=None
+):
+    # Virtualized watch: only the visible window is rendered, keys scroll and search
+    if interval is None:
+        interval = _poll_interval()
+    view = InstanceTableView(
+        printer.index,
+        console,
+        service=service,
+        status=status,
+        sort=sort,
+        trends=printer.trends if trends or anomalous else None,
+        anomalous=anomalous,
+    )
+    with KeyReader() as keys, _live() as live:
+        next_refresh = 0.0
+        refreshes = 0
+        while not view.closed:
+            now = time.monotonic()
+            if now >= next_refresh:
+                printer.refresh()
+                refreshes += 1
+                next_refresh = now + interval
+                changed = True
+            else:
+                changed = view.handle_key(keys.read(next_refresh - now))
+            if changed and not view.closed:
+                live.update(view.render(), refresh=True)
+            if count is not None and refreshes >= count:
+                break
 
 
 def run_show_instance(instancename):
@@ -94,26 +283,181 @@ def run_show_instance(instancename):
     console.print(printer.get_stats(ip=instancename))
 
 
-def run_list_services(status=None):
+def run_instance_events(
+    service=None, kinds=None, cpu_delta=10, memory_delta=10, initial=False, output="text", count=None
+):
+    # Stream the changes between consecutive sweeps, one event per line
+    for event in iter_events(
+        cpx,
+        interval=_poll_interval(),
+        cpu_delta=cpu_delta,
+        memory_delta=memory_delta,
+        initial=initial,
+        count=count,
+    ):
+        if service is not None and event.service.lower() != service.lower():
+            continue
+        if kinds and event.kind not in kinds:
+            continue
+        click.echo(event.to_json() if output == "json" else str(event))
+
+
+def run_list_services(status=None, sample=None, confidence=0.95):
     # Implementation logic for listing services
-    console.print(printer.get_services(status=status))
+    console.print(printer.get_services(status=status, sample=sample, confidence=confidence))
 
 
-def run_watch_services(servicename=None, status=None):
+def _estimates_forever(sample, confidence):
+    # Every refinement of the estimates, then start over from a new sample
+    while True:
+        yield from cpx.iter_service_estimates(sample, confidence=confidence)
+
+
+def run_watch_services(servicename=None, status=None, sample=None, confidence=0.95, count=None):
     # Implementation logic for watching services
-    with Live(console=console, screen=True, auto_refresh=False) as live:
-        while True:
-            if servicename:
-                live.update(
-                    printer.get_services(service=servicename), refresh=True
-                )
+    if servicename:
+        status = None
+    estimates = _estimates_forever(sample, confidence) if sample is not None else None
+    with _live() as live:
+        refreshes = 0
+        while count is None or refreshes < count:
+            started = time.monotonic()
+            if estimates is None:
+                table = printer.get_services(service=servicename, status=status)
             else:
-                live.update(printer.get_services(status=status), refresh=True)
-            time.sleep(1)
+                table = printer.render_services(next(estimates), service=servicename, status=status)
+            live.update(table, refresh=True)
+            refreshes += 1
+            if count is None or refreshes < count:
+                time.sleep(max(_poll_interval() - (time.monotonic() - started), 0))
 
 
-def run_show_service(servicename):
+def run_show_service(servicename, worst=5, max_age=None):
     if not servicename:
         raise click.UsageError("Missing argument 'servicename'")
-    # Implementation logic for showing service
-    console.print(printer.get_services(service=servicename))
+    # Only the instances of the service are queried, those seen within max_age seconds are reused
+    tables = printer.get_service(
+        servicename,
+        worst=worst,
+        max_age=max_age if max_age is not None else _poll_interval(),
+    )
+    if not tables:
+        raise click.ClickException(f"No instances of service '{servicename}'")
+    for table in tables:
+        console.print(table)
+
+
+def run_watch_alerts(interval=None, count=None):
+    # Evaluate the alert rules against every sweep
+    engine = build_alert_engine(config["alerts"], cpx.metrics)
+    if not len(engine):
+        raise click.UsageError("No alert rules configured")
+    if interval is None:
+        interval = _poll_interval()
+
+    sweeps = 0
+    while count is None or sweeps < count:
+        started = time.monotonic()
+        instances = cpx.get_stats()
+        engine.evaluate(instances, cpx.get_services(instances))
+        sweeps += 1
+        if count is None or sweeps < count:
+            time.sleep(max(interval - (time.monotonic() - started), 0))
+
+
+def _format_size(size):
+    for unit in ("B", "KiB", "MiB"):
+        if size < 1024:
+            return f"{size:.0f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GiB"
+
+
+def run_memory_report(sweeps=1, interval=None):
+    # Sweep the way the watch commands do, then measure what is kept between sweeps
+    if interval is None:
+        interval = _poll_interval()
+    engine = AlertEngine(config["alerts"]["rules"], metrics=cpx.metrics)
+    tracker = ChangeTracker()
+
+    for sweep in range(sweeps):
+        started = time.monotonic()
+        instances = cpx.get_stats()
+        printer.index.update(instances)
+        engine.evaluate(instances, cpx.get_services(instances))
+        tracker.update(instances)
+        if sweep < sweeps - 1:
+            time.sleep(max(interval - (time.monotonic() - started), 0))
+
+    structures = {
+        "Index search cache": (
+            printer.index.search_cache,
+            len(printer.index.search_cache),
+            printer.index.search_cache.max_entries,
+        ),
+        "Instance index": (printer.index, len(printer.index), None),
+        "Fleet members": (cpx.members, len(cpx.members), None),
+        "Alert windows": (engine, engine.tracked_keys, None),
+        "Change tracker": (tracker, len(tracker), None),
+        "Instance trends": (printer.trends, len(printer.trends), None),
+    }
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, QueueListenerHandler):
+            queue = handler.queue
+            structures["Log queue"] = (list(queue.queue), queue.qsize(), queue.maxsize)
+
+    table = Table(title="Memory Usage")
+    table.add_column("Structure", justify="left")
+    table.add_column("Entries", justify="right")
+    table.add_column("Budget", justify="right")
+    table.add_column("Size", justify="right")
+    for usage in memory_report(structures):
+        table.add_row(
+            usage.name,
+            str(usage.entries),
+            "-" if usage.budget is None else str(usage.budget),
+            _format_size(usage.size),
+        )
+
+    rss = resident_memory()
+    if rss is not None:
+        table.caption = f"Resident memory: {_format_size(rss)}"
+    console.print(table)
+
+
+def run_save_snapshot(path, compression="none"):
+    # Sweep the fleet once and write instance and service statistics to a snapshot file
+    timestamp = time.time()
+    stats = cpx.get_stats()
+    services = cpx.get_services(stats)
+    size = save_snapshot(path, stats, services, timestamp=timestamp, compression=compression)
+    click.echo(f"Saved {len(stats)} instances and {len(services)} services to {path} ({_format_size(size)})")
+
+
+def run_load_snapshot(path):
+    # Print the summary and the service statistics of a snapshot file
+    with SnapshotFile(path) as snapshot:
+        taken = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(snapshot.timestamp))
+        click.echo(
+            f"Snapshot of {len(snapshot)} instances taken {taken} ({snapshot.compression} compression)"
+        )
+        console.print(printer.render_services(snapshot.services))
+
+
+def run_serve(host=None, port=None, interval=None):
+    # Sweep in the background and serve the latest snapshot until interrupted
+    serve = config["serve"]
+    server = MonitorServer(
+        cpx,
+        host=host if host is not None else serve["host"],
+        port=port if port is not None else serve["port"],
+        interval=interval if interval is not None else _poll_interval(),
+    )
+    server.start()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
@@ -6,7 +6,12 @@ import sys
 import click
 import pyfiglet
 
-from cpx_health_monitor.logic import run
+from cpx_health_monitor.classmodules import InstanceIndex
+from cpx_health_monitor.config import get_config
+from cpx_health_monitor.events import EVENT_KINDS
+from cpx_health_monitor.logging import setup_logging
+from cpx_health_monitor.logic import configure, run
+from cpx_health_monitor.snapshot import COMPRESSIONS
 
 LOG = logging.getLogger(__name__)
 
@@ -23,18 +28,30 @@ def instances():
 @instances.command(help="List instances")
 @click.option("--service", help="Filter by service name")
 @click.option("--status", help="Filter by status")
-def list(service, status):
+@click.option("--sort", type=click.Choice(InstanceIndex.SORT_KEYS), help="Sort by column")
+@click.option("--top", type=click.IntRange(min=1), help="Show the N highest ranked instances (by CPU unless --sort is given)")
+@click.option("--limit", type=click.IntRange(min=1), help="Show at most N instances")
+@click.option("--trends", is_flag=True, help="Show z-scores, slopes and anomalies (sweeps until trends are warmed up)")
+@click.option("--anomalous", is_flag=True, help="Only show anomalous instances, implies --trends")
+@click.option("--from-snapshot", type=click.Path(exists=True, dir_okay=False), help="List the instances of a snapshot file instead of sweeping the fleet")
+def list(service, status, sort, top, limit, trends, anomalous, from_snapshot):
     """List instances"""
-    run("instances", "list", service, status)
+    run("instances", "list", service, status, sort, top, limit, trends, anomalous, from_snapshot)
 
 
 # cpxstat instances watch
 @instances.command(help="Watch instances")
 @click.option("--service", help="Filter by service name")
 @click.option("--status", help="Filter by status")
-def watch(service, status):
+@click.option("--sort", type=click.Choice(InstanceIndex.SORT_KEYS), help="Sort by column")
+@click.option("--top", type=click.IntRange(min=1), help="Show the N highest ranked instances (by CPU unless --sort is given)")
+@click.option("--limit", type=click.IntRange(min=1), help="Show at most N instances")
+@click.option("--trends", is_flag=True, help="Show z-scores, slopes and anomalies")
+@click.option("--anomalous", is_flag=True, help="Only show anomalous instances, implies --trends")
+@click.option("--count", type=click.IntRange(min=1), help="Stop after N sweeps")
+def watch(service, status, sort, top, limit, trends, anomalous, count):
     """Watch instances"""
-    run("instances", "watch", service, status)
+    run("instances", "watch", service, status, sort, top, limit, trends, anomalous, count)
 
 
 # cpxstat instances show
@@ -45,6 +62,20 @@ def show(instancename):
     run("instances", "show", instancename)
 
 
+# cpxstat instances events
+@instances.command(help="Stream instance changes between consecutive sweeps")
+@click.option("--service", help="Filter by service name")
+@click.option("--kind", "kinds", type=click.Choice(EVENT_KINDS), multiple=True, help="Only stream events of this kind, can be repeated")
+@click.option("--cpu-delta", type=click.IntRange(1, 100), default=10, show_default=True, help="CPU usage change (%) reported as an event")
+@click.option("--memory-delta", type=click.IntRange(1, 100), default=10, show_default=True, help="Memory usage change (%) reported as an event")
+@click.option("--initial", is_flag=True, help="Report every instance of the first sweep as added")
+@click.option("--output", type=click.Choice(["text", "json"]), default="text", show_default=True, help="Output format")
+@click.option("--count", type=click.IntRange(min=1), help="Stop after N sweeps")
+def events(service, kinds, cpu_delta, memory_delta, initial, output, count):
+    """Stream instance events"""
+    run("instances", "events", service, kinds, cpu_delta, memory_delta, initial, output, count)
+
+
 # cpxstat services
 @click.group()
 def services():
@@ -55,44 +86,157 @@ def services():
 # cpxstat services list
 @services.command(help="List services")
 @click.option("--status", help="Filter by status")
-def list(status):
+@click.option("--sample", type=click.FloatRange(0, 1, min_open=True), help="Only poll this fraction of each service and show estimates")
+@click.option("--confidence", type=click.FloatRange(0, 1, min_open=True, max_open=True), default=0.95, show_default=True, help="Confidence level of the estimates")
+def list(status, sample, confidence):
     """List services"""
-    run("services", "list", status)
+    run("services", "list", status, sample, confidence)
 
 
 # cpxstat services watch
 @services.command(help="Watch services")
 @click.argument("servicename", required=False)
 @click.option("--status", help="Filter by status")
-def watch(servicename, status):
+@click.option("--sample", type=click.FloatRange(0, 1, min_open=True), help="Poll this fraction of each service per refresh, refining the estimates until the whole fleet is polled")
+@click.option("--confidence", type=click.FloatRange(0, 1, min_open=True, max_open=True), default=0.95, show_default=True, help="Confidence level of the estimates")
+@click.option("--count", type=click.IntRange(min=1), help="Stop after N refreshes")
+def watch(servicename, status, sample, confidence, count):
     """Watch services"""
-    run("services", "watch", servicename, status)
+    run("services", "watch", servicename, status, sample, confidence, count)
 
 
 # cpxstat services show
-@services.command(help="Show service details")
+@services.command(help="Show service details. The first run queries every instance to learn their services; later runs only query those of the service, see monitor.memory.state_file")
 @click.argument("servicename")
-def show(servicename):
+@click.option("--worst", type=click.IntRange(min=0), default=5, show_default=True, help="Number of instances with the highest CPU or memory usage to show")
+@click.option("--max-age", type=click.FloatRange(min=0), help="Reuse instance statistics up to this many seconds old, including those saved by previous runs, defaults to monitor.poll_interval")
+def show(servicename, worst, max_age):
     """Show a service"""
-    run("services", "show", servicename)
+    run("services", "show", servicename, worst, max_age)
+
+
+# cpxstat alerts
+@click.group()
+def alerts():
+    """Evaluate cpxstat alert rules"""
+    pass
+
+
+# cpxstat alerts watch
+@alerts.command(help="Evaluate the alert rules of the config on every sweep")
+@click.option("--interval", type=click.FloatRange(min=0), help="Seconds between sweeps, defaults to monitor.poll_interval")
+@click.option("--count", type=click.IntRange(min=1), help="Stop after N sweeps")
+def watch(interval, count):
+    """Watch alerts"""
+    run("alerts", "watch", interval, count)
+
+
+# cpxstat serve
+@click.command(help="Sweep in the background and serve the latest statistics as JSON and Prometheus metrics")
+@click.option("--listen-host", help="Address to listen on, defaults to serve.host")
+@click.option("--listen-port", type=click.IntRange(0, 65535), help="Port to listen on, defaults to serve.port")
+@click.option("--interval", type=click.FloatRange(min=0), help="Seconds between sweeps, defaults to monitor.poll_interval")
+def serve(listen_host, listen_port, interval):
+    """Serve statistics over HTTP"""
+    run("serve", None, listen_host, listen_port, interval)
+
+
+# cpxstat snapshot
+@click.group()
+def snapshot():
+    """Save and load fleet snapshots"""
+    pass
+
+
+# cpxstat snapshot save
+@snapshot.command(help="Sweep the fleet and save instance and service statistics to a snapshot file")
+@click.argument("path", type=click.Path(dir_okay=False))
+@click.option("--compression", type=click.Choice(COMPRESSIONS), default="none", show_default=True, help="Compression of the file, only uncompressed snapshots are loaded lazily")
+def save(path, compression):
+    """Save a snapshot"""
+    run("snapshot", "save", path, compression)
+
+
+# cpxstat snapshot load
+@snapshot.command(help="Print the summary and service statistics of a snapshot file")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+def load(path):
+    """Load a snapshot"""
+    run("snapshot", "load", path)
+
+
+# cpxstat memory
+@click.group()
+def memory():
+    """Inspect the memory used by cpxstat"""
+    pass
+
+
+# cpxstat memory report
+@memory.command(help="Sweep the fleet and report the size of every structure kept between sweeps")
+@click.option("--sweeps", type=click.IntRange(min=1), default=1, show_default=True, help="Number of sweeps before reporting")
+@click.option("--interval", type=click.FloatRange(min=0), help="Seconds between sweeps, defaults to monitor.poll_interval")
+def report(sweeps, interval):
+    """Report memory usage"""
+    run("memory", "report", sweeps, interval)
 
 
 # cpxstat CLI
 @click.group(help="CPXStat command-line interface")
-def cpxstat():
+@click.option("--config", "config_path", type=click.Path(exists=True, dir_okay=False), help="YAML config file")
+@click.option("--protocol", type=click.Choice(["http", "https"]), help="Override monitor.protocol")
+@click.option("--host", help="Override monitor.host")
+@click.option("--port", type=click.IntRange(1, 65535), help="Override monitor.port")
+@click.option("--concurrency", type=click.IntRange(min=1), help="Override monitor.concurrency")
+@click.option("--timeout", type=click.FloatRange(min=0, min_open=True), help="Override monitor.timeout")
+@click.option("--rate-limit", type=click.FloatRange(min=0, min_open=True), help="Override monitor.rate_limit.rate (requests per second)")
+@click.option("--hedge", type=click.FloatRange(0, 100, min_open=True, max_open=True), help="Duplicate requests slower than this latency percentile (enables monitor.hedging)")
+@click.option("--record", type=click.Path(dir_okay=False), help="Record the raw responses of every sweep to a sweep log")
+@click.option("--replay", type=click.Path(exists=True, dir_okay=False), help="Replay sweeps from a sweep log instead of querying the CPX API")
+@click.option("--replay-speed", type=click.FloatRange(min=0), default=1.0, show_default=True, help="Replay speed factor, 0 replays as fast as possible")
+@click.option("--replay-loop", is_flag=True, help="Start over when the end of the sweep log is reached")
+def cpxstat(config_path, protocol, host, port, concurrency, timeout, rate_limit, hedge, record, replay, replay_speed, replay_loop):
     """CPXStat command-line interface"""
-    pass
+    monitor = {
+        key: value
+        for key, value in (
+            ("protocol", protocol),
+            ("host", host),
+            ("port", port),
+            ("concurrency", concurrency),
+            ("timeout", timeout),
+        )
+        if value is not None
+    }
+    if rate_limit is not None:
+        monitor["rate_limit"] = {"rate": rate_limit}
+    if hedge is not None:
+        monitor["hedging"] = {"enabled": True, "percentile": hedge}
+    if config_path or monitor or record or replay:
+        configure(
+            config_path=config_path,
+            overrides={"monitor": monitor} if monitor else None,
+            record=record,
+            replay=replay,
+            replay_speed=replay_speed,
+            replay_loop=replay_loop,
+        )
 
 
 # cpxstat.add_command(configs)
 cpxstat.add_command(instances)
 cpxstat.add_command(services)
+cpxstat.add_command(alerts)
+cpxstat.add_command(memory)
+cpxstat.add_command(serve)
+cpxstat.add_command(snapshot)
 
 
 # @click
 def main(
 ) -> int:
     exit_code = None
+    setup_logging(get_config()["logging"])
     print(pyfiglet.figlet_format("CPX STAT"))
 
     try:
@@ -0,0 +1,290 @@
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+from collections import OrderedDict, deque
+from types import FunctionType, ModuleType
+from typing import Any, Dict, Hashable, List, NamedTuple, Optional, Set, Tuple
+
+from cpx_health_monitor.utils import json_loads
+
+LOG = logging.getLogger(__name__)
+
+
+class LRUCache:
+    """
+    Mapping holding at most max_entries entries, evicting the least recently used
+    entry first, and optionally expiring entries ttl seconds after they were set.
+
+    Attributes:
+        max_entries (int): The maximum number of entries. 0 disables the cache.
+        ttl (float): The number of seconds entries are kept for, None keeps them until evicted.
+        evictions (int): The number of entries evicted or expired so far.
+    """
+
+    def __init__(self, max_entries: int, ttl: Optional[float] = None) -> None:
+        """
+        Initializes a new instance of the LRUCache class.
+
+        Args:
+            max_entries (int): The maximum number of entries. 0 disables the cache.
+            ttl (float, optional): The number of seconds entries are kept for.
+        """
+        if max_entries < 0:
+            raise ValueError("max_entries must not be negative")
+
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.evictions = 0
+        # key -> (expiry, value), least recently used first.
+        self._entries: "OrderedDict[Hashable, Tuple[Optional[float], Any]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+        expiry, value = entry
+        if expiry is not None and expiry <= time.monotonic():
+            del self._entries[key]
+            self.evictions += 1
+            return default
+        self._entries.move_to_end(key)
+        return value
+
+    def __setitem__(self, key: Hashable, value: Any) -> None:
+        if not self.max_entries:
+            return
+        expiry = None if self.ttl is None else time.monotonic() + self.ttl
+        self._entries[key] = (expiry, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._entries.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def expire(self) -> int:
+        """
+        Drops the expired entries.
+
+        Returns:
+            The number of dropped entries.
+        """
+        if self.ttl is None:
+            return 0
+        now = time.monotonic()
+        expired = [key for key, (expiry, _) in self._entries.items() if expiry <= now]
+        for key in expired:
+            del self._entries[key]
+        self.evictions += len(expired)
+        return len(expired)
+
+
+_MISSING = object()
+
+# Shared, immortal or unbounded objects that don't belong to the measured structures.
+_SKIPPED_TYPES = (type, ModuleType, FunctionType)
+
+
+def sizeof(obj: Any, seen: Optional[Set[int]] = None) -> int:
+    """
+    Returns the number of bytes used by an object and everything it refers to.
+
+    Containers, instance dictionaries and slots are followed; classes, modules and
+    functions are not.
+
+    Args:
+        obj (Any): The object to measure.
+        seen (Set[int], optional): Ids of the objects already counted, to share between
+            calls so that objects referred to by several structures are only counted once.
+
+    Returns:
+        The size in bytes.
+    """
+    if seen is None:
+        seen = set()
+
+    size = 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, _SKIPPED_TYPES):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+
+        if isinstance(obj, (str, bytes, bytearray, int, float, bool)):
+            continue
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+            stack.extend(obj)
+        if hasattr(obj, "__dict__"):
+            stack.append(vars(obj))
+        for slot in getattr(type(obj), "__slots__", ()):
+            if hasattr(obj, slot):
+                stack.append(getattr(obj, slot))
+
+    return size
+
+
+def resident_memory() -> Optional[int]:
+    """
+    Returns the resident set size of the current process in bytes,
+    or None where it can't be read (i.e. outside of Linux).
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return pages * os.sysconf("SC_PAGE_SIZE")
+
+
+class MemoryUsage(NamedTuple):
+    name: str
+    entries: int
+    budget: Optional[int]
+    size: int
+
+
+def memory_report(structures: Dict[str, Tuple[Any, int, Optional[int]]]) -> List[MemoryUsage]:
+    """
+    Measures the memory used by named structures.
+
+    Objects shared between structures are counted once, for the first structure
+    referring to them, so structures should be listed from the most to the least specific.
+
+    Args:
+        structures (Dict[str, Tuple[Any, int, Optional[int]]]):
+            The structure, its number of entries and its budget (None when unbounded), by name.
+
+    Returns:
+        The memory usage of each structure, in the given order.
+    """
+    seen: Set[int] = set()
+    return [
+        MemoryUsage(name, entries, budget, sizeof(obj, seen))
+        for name, (obj, entries, budget) in structures.items()
+    ]
+
+
+# The state of an instance in a state file: its service, when it was last seen (a time.time()
+# value) and its last statistics, only kept for the instances of the services drilled into.
+PersistedState = Tuple[str, float, Optional[Dict[str, str]]]
+
+_STATE_VERSION = 1
+
+
+class StateFile:
+    """
+    Keeps what a monitor learnt about the members of the fleet between runs of cpxstat,
+    so that e.g. ``services show`` only queries the instances of the service from the start.
+
+    The file is a JSON document, replaced atomically on every save. States older than ttl
+    seconds, and files written for another CPX API, are ignored when loaded.
+
+    Attributes:
+        file_path (str): The path of the file.
+        ttl (float): The number of seconds states are kept for, None keeps them.
+    """
+
+    def __init__(self, file_path: str, ttl: Optional[float] = None) -> None:
+        """
+        Initializes a new instance of the StateFile class.
+
+        Args:
+            file_path (str): The path of the file, "~" is expanded.
+            ttl (float, optional): The number of seconds states are kept for.
+        """
+        self.file_path = os.path.expanduser(file_path)
+        self.ttl = ttl
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any]) -> Optional["StateFile"]:
+        """
+        Creates the state file from the monitor.memory section of the config.
+
+        Returns:
+            The state file, or None if state_file isn't set.
+        """
+        file_path = config.get("state_file")
+        if not file_path:
+            return None
+        return cls(file_path, config.get("state_ttl"))
+
+    def load(self, endpoint: str) -> Dict[str, PersistedState]:
+        """
+        Loads the states saved for a CPX API.
+
+        Args:
+            endpoint (str): The URL of the CPX API.
+
+        Returns:
+            The states that didn't expire, by IP; empty if the file is missing or invalid.
+        """
+        try:
+            with open(self.file_path, "rb") as f:
+                document = json_loads(f.read())
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            LOG.warning("ignoring state file %s: %s", self.file_path, e)
+            return {}
+
+        if (
+            not isinstance(document, dict)
+            or document.get("version") != _STATE_VERSION
+            or document.get("endpoint") != endpoint
+        ):
+            return {}
+
+        deadline = None if self.ttl is None else time.time() - self.ttl
+        states = {}
+        try:
+            for ip, (service, seen, stats) in document.get("instances", {}).items():
+                if deadline is None or seen >= deadline:
+                    states[ip] = (service, seen, stats)
+        except (AttributeError, TypeError, ValueError):
+            LOG.warning("ignoring state file %s: invalid instances", self.file_path)
+            return {}
+        return states
+
+    def save(self, endpoint: str, states: Dict[str, PersistedState]) -> None:
+        """
+        Replaces the states saved for a CPX API. Failures are logged rather than raised,
+        since the state only spares requests.
+
+        Args:
+            endpoint (str): The URL of the CPX API.
+            states (Dict[str, PersistedState]): The states, by IP.
+        """
+        document = {"version": _STATE_VERSION, "endpoint": endpoint, "instances": states}
+        directory = os.path.dirname(self.file_path) or "."
+        try:
+            os.makedirs(directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(prefix=".state-", dir=directory)
+            try:
+                with os.fdopen(fd, "w") as f:
+                    json.dump(document, f, separators=(",", ":"))
+                os.replace(tmp_path, self.file_path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        except OSError as e:
+            LOG.warning("could not save state file %s: %s", self.file_path, e)
@@ -0,0 +1,335 @@
+from itertools import repeat
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+from cpx_health_monitor.exceptions import CPXHealthMonitorException
+
+
+class MetricSchemaException(CPXHealthMonitorException):
+    pass
+
+
+class InvalidMetricError(MetricSchemaException, ValueError):
+    pass
+
+
+# The CPX API reports usage as whole percentages, so every value it can return is
+# resolved by a dict lookup instead of string manipulation and int parsing.
+_PERCENTAGES = {"%d%%" % i: i for i in range(101)}
+
+
+def _parse_percentage(value: str) -> int:
+    """
+    Converts a percentage string as reported by the CPX API (e.g. "42%") to an int.
+
+    Args:
+        value (str): The percentage string.
+
+    Returns:
+        The percentage as an int.
+    """
+    try:
+        return _PERCENTAGES[value]
+    except KeyError:
+        return int(value.replace("%", ""))
+
+
+METRIC_TYPES = ("percentage", "integer", "number")
+AGGREGATIONS = ("mean", "max", "sum")
+
+# Keys of the instance and service statistics that can't be the name of a metric.
+RESERVED_NAMES = (
+    "cpu",
+    "memory",
+    "service",
+    "status",
+    "total_instances",
+    "healthy_instances",
+    "unhealthy_instances",
+    "sampled_instances",
+    "cpu_margin",
+    "memory_margin",
+    "estimated",
+)
+
+# Distinct raw values whose parsed value is kept, per metric. Fleets report few distinct
+# values (e.g. 101 percentages), so most values are parsed once rather than once per sweep.
+_PARSE_CACHE_SIZE = 4096
+
+
+class Metric(NamedTuple):
+    """
+    A metric reported by the CPX API for every instance.
+
+    Attributes:
+        name (str): The name of the metric, the key of its aggregate in the service statistics.
+        field (str): The key of the metric in the response of the CPX API.
+        type (str): One of METRIC_TYPES: "percentage" ("42%"), "integer" or "number".
+        label (str): The header of the column of the metric.
+        unit (str): The suffix of the values (e.g. "ms"), stripped when parsing.
+        unhealthy_from (float, optional): The value from which an instance is unhealthy.
+        unhealthy_below (float, optional): The value below which an instance is unhealthy.
+        aggregate (str): How the values of a service are aggregated, one of AGGREGATIONS.
+    """
+
+    name: str
+    field: str
+    type: str = "number"
+    label: str = ""
+    unit: str = ""
+    unhealthy_from: Optional[float] = None
+    unhealthy_below: Optional[float] = None
+    aggregate: str = "mean"
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any]) -> "Metric":
+        """
+        Builds a metric from an item of the monitor.metrics section of the config.
+
+        Args:
+            config (Dict[str, Any]): The metric; field and label default to its name.
+
+        Returns:
+            The metric.
+        """
+        name = config.get("name")
+        if not name or name in RESERVED_NAMES:
+            raise InvalidMetricError(f"invalid metric name '{name}'")
+        config = dict(config)
+        config.setdefault("field", name)
+        config.setdefault("label", name.replace("_", " ").title())
+        if config.get("type") == "percentage":
+            config.setdefault("unit", "%")
+        return cls(**config)
+
+    @property
+    def title(self) -> str:
+        return self.label or self.name
+
+    def format(self, value: Optional[float]) -> str:
+        """
+        Formats a value of the metric, e.g. an aggregate, the way the CPX API reports it.
+        """
+        if value is None:
+            return "n/a"
+        if self.type == "number":
+            return f"{value:.1f}{self.unit}"
+        return f"{int(value)}{self.unit}"
+
+    def cell(self, raw: Any) -> str:
+        """
+        Formats a raw value of the metric as reported by the CPX API, for a table cell.
+        """
+        return "" if raw is None else str(raw)
+
+
+def default_metrics(cpu_threshold: float = 80, memory_threshold: float = 80) -> Tuple[Metric, Metric]:
+    """
+    Returns the metrics every CPX API reports: CPU and memory usage.
+
+    Args:
+        cpu_threshold (float): The CPU usage (%) from which an instance is unhealthy.
+        memory_threshold (float): The memory usage (%) from which an instance is unhealthy.
+    """
+    return (
+        Metric("cpu", "cpu", "percentage", "CPU Usage", "%", unhealthy_from=cpu_threshold),
+        Metric("memory", "memory", "percentage", "Memory Usage", "%", unhealthy_from=memory_threshold),
+    )
+
+
+def _compile_parser(metric: Metric) -> Tuple[Callable[[Any], Optional[float]], Dict[Any, Optional[float]]]:
+    """
+    Compiles the parser of a metric: a function converting raw values to numbers,
+    None for missing or invalid values, memoized by raw value.
+
+    Returns:
+        The parser and its memo, so that hot loops can look values up without calling the parser.
+    """
+    convert = float if metric.type == "number" else int
+    unit = metric.unit
+    cache: Dict[Any, Optional[float]] = dict(_PERCENTAGES) if metric.type == "percentage" else {}
+
+    def parse(raw: Any) -> Optional[float]:
+        try:
+            return cache[raw]
+        except KeyError:
+            pass
+        except TypeError:
+            return None
+
+        if raw is None or isinstance(raw, bool):
+            value = None
+        elif isinstance(raw, str):
+            text = raw.strip()
+            if unit and text.endswith(unit):
+                text = text[: -len(unit)].strip()
+            try:
+                value = convert(text) if convert is float else int(float(text))
+            except ValueError:
+                value = None
+        else:
+            value = convert(raw)
+
+        if len(cache) < _PARSE_CACHE_SIZE:
+            cache[raw] = value
+        return value
+
+    return parse, cache
+
+
+class MetricSchema:
+    """
+    The metrics reported by the CPX API, compiled once into the parsers and checks used
+    by health evaluation, aggregation and rendering, so that adding a metric needs no
+    code changes and raw values are only parsed once per distinct value.
+
+    Instances missing a metric are unaffected by its thresholds and left out of its aggregate.
+
+    Methods:
+        is_healthy(instance: Dict[str, Any]) -> bool: Evaluates the thresholds of the metrics.
+        aggregate(instances: Sequence[Dict[str, Any]]) -> Dict[str, str]:
+            Aggregates the metrics of the instances of a service.
+        values(metric: Metric, instances: Iterable[Dict[str, Any]]) -> List[float]:
+            Returns the parsed values of a metric.
+        extra_values(stats: Dict[str, Any], aggregates: bool=False) -> Dict[str, float]:
+            Parses the extra metrics of an instance or a service.
+    """
+
+    def __init__(self, metrics: Iterable[Metric]) -> None:
+        """
+        Initializes a new instance of the MetricSchema class.
+
+        Args:
+            metrics (Iterable[Metric]): The metrics, in column order.
+        """
+        self._metrics = tuple(metrics)
+        self._parsers: Dict[str, Callable[[Any], Optional[float]]] = {}
+        self._memos: Dict[str, Dict[Any, Optional[float]]] = {}
+        for metric in self._metrics:
+            if metric.name in self._parsers:
+                raise InvalidMetricError(f"duplicate metric '{metric.name}'")
+            if metric.type not in METRIC_TYPES:
+                raise InvalidMetricError(f"metric '{metric.name}': invalid type '{metric.type}'")
+            if metric.aggregate not in AGGREGATIONS:
+                raise InvalidMetricError(f"metric '{metric.name}': invalid aggregate '{metric.aggregate}'")
+            self._parsers[metric.name], self._memos[metric.name] = _compile_parser(metric)
+
+        self._extra = tuple(metric for metric in self._metrics if metric.name not in ("cpu", "memory"))
+
+        # Only the metrics with thresholds are parsed to evaluate health.
+        self._checks = tuple(
+            (metric.field, self._parsers[metric.name], metric.unhealthy_from, metric.unhealthy_below)
+            for metric in self._metrics
+            if metric.unhealthy_from is not None or metric.unhealthy_below is not None
+        )
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any]) -> "MetricSchema":
+        """
+        Builds the schema from the monitor section of the config: CPU and memory usage,
+        with the thresholds of monitor.health, then the metrics of monitor.metrics.
+
+        Args:
+            config (Dict[str, Any]): The monitor section of the config.
+
+        Returns:
+            The schema.
+        """
+        health = config.get("health", {})
+        return cls(
+            default_metrics(health.get("cpu", 80), health.get("memory", 80))
+            + tuple(Metric.from_config(metric) for metric in config.get("metrics", []))
+        )
+
+    @property
+    def metrics(self) -> Tuple[Metric, ...]:
+        return self._metrics
+
+    @property
+    def extra(self) -> Tuple[Metric, ...]:
+        """
+        The metrics other than CPU and memory usage, which have columns of their own.
+        """
+        return self._extra
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._parsers
+
+    def parser(self, name: str) -> Callable[[Any], Optional[float]]:
+        """
+        Returns the compiled parser of a metric.
+        """
+        return self._parsers[name]
+
+    def extra_values(self, stats: Dict[str, Any], aggregates: bool = False) -> Dict[str, float]:
+        """
+        Parses the extra metrics of the statistics of an instance, or of a service.
+
+        Args:
+            stats (Dict[str, Any]): The statistics of the instance, or of the service.
+            aggregates (bool): Whether the statistics are those of a service, keyed by metric name.
+
+        Returns:
+            The value of each extra metric reported, by name.
+        """
+        values = {}
+        for metric in self._extra:
+            value = self._parsers[metric.name](stats.get(metric.name if aggregates else metric.field))
+            if value is not None:
+                values[metric.name] = value
+        return values
+
+    def is_healthy(self, instance: Dict[str, Any]) -> bool:
+        """
+        Evaluates the thresholds of the metrics against the statistics of an instance.
+
+        Args:
+            instance (Dict[str, Any]): The statistics of the instance.
+
+        Returns:
+            Whether no metric is beyond its thresholds.
+        """
+        for field, parse, above, below in self._checks:
+            value = parse(instance.get(field))
+            if value is None:
+                continue
+            if above is not None and value >= above:
+                return False
+            if below is not None and value < below:
+                return False
+        return True
+
+    def values(self, metric: Metric, instances: Iterable[Dict[str, Any]]) -> List[float]:
+        """
+        Returns the parsed values of a metric, skipping instances that don't report it.
+        """
+        raws = list(map(dict.get, instances, repeat(metric.field)))
+        values = list(map(self._memos[metric.name].get, raws))
+        if None in values:
+            # Values not seen yet, or missing.
+            parse = self._parsers[metric.name]
+            values = [value for value in map(parse, raws) if value is not None]
+        return values
+
+    def aggregate(self, instances: Sequence[Dict[str, Any]]) -> Dict[str, str]:
+        """
+        Aggregates the metrics of the instances of a service.
+
+        Args:
+            instances (Sequence[Dict[str, Any]]): The statistics of the instances.
+
+        Returns:
+            The formatted aggregate of each metric, by name.
+        """
+        result = {}
+        for metric in self._metrics:
+            values = self.values(metric, instances)
+            if not values:
+                aggregate = None
+            elif metric.aggregate == "max":
+                aggregate = max(values)
+            elif metric.aggregate == "sum":
+                aggregate = sum(values)
+            else:
+                aggregate = sum(values) / len(values)
+            result[metric.name] = metric.format(aggregate)
+        return result
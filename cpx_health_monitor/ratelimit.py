@@ -0,0 +1,188 @@
+import os
+import struct
+import threading
+import time
+
+from typing import Any, Dict, Optional
+
+from cpx_health_monitor.exceptions import CPXHealthMonitorException
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not available on Windows
+    fcntl = None
+
+
+class RateLimitException(CPXHealthMonitorException):
+    pass
+
+
+class RateLimitTimeoutError(RateLimitException, TimeoutError):
+    pass
+
+
+# Interactive lookups (e.g. "instances show") are served before background sweeps.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_SWEEP = 1
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter shared by all the threads of a process.
+
+    Tokens are added at a constant rate up to the burst size, and each request
+    takes one. Waiting requests are served by priority: a sweep request only gets
+    a token when no interactive request is waiting for one.
+
+    Methods:
+        acquire(priority: int=PRIORITY_SWEEP, timeout: float=None) -> None:
+            Blocks until a token is available and takes it.
+    """
+
+    def __init__(self, rate: float, burst: Optional[float] = None) -> None:
+        """
+        Initializes a new instance of the TokenBucket class.
+
+        Args:
+            rate (float): The number of tokens added per second.
+            burst (float, optional): The maximum number of tokens. Defaults to rate (one second worth).
+        """
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+
+        self.rate = float(rate)
+        self.burst = float(burst) if burst is not None else max(self.rate, 1.0)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._condition = threading.Condition()
+        self._waiting = [0, 0]
+        self.acquired = 0
+        self.waited = 0.0
+
+    def _try_take(self) -> float:
+        """
+        Takes a token if one is available.
+
+        Returns:
+            0 if a token was taken, otherwise the number of seconds until one is available.
+        """
+        now = time.monotonic()
+        self._tokens = min(self._tokens + (now - self._updated) * self.rate, self.burst)
+        self._updated = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0.0
+        return (1 - self._tokens) / self.rate
+
+    def acquire(self, priority: int = PRIORITY_SWEEP, timeout: Optional[float] = None) -> None:
+        """
+        Blocks until a token is available and takes it.
+
+        Args:
+            priority (int): PRIORITY_INTERACTIVE or PRIORITY_SWEEP.
+            timeout (float, optional): The maximum number of seconds to wait.
+
+        Raises:
+            RateLimitTimeoutError: If no token could be taken within the timeout.
+        """
+        started = time.monotonic()
+        deadline = None if timeout is None else started + timeout
+
+        with self._condition:
+            self._waiting[priority] += 1
+            try:
+                while True:
+                    if not any(self._waiting[:priority]):
+                        delay = self._try_take()
+                        if not delay:
+                            break
+                    else:
+                        # Let higher priority requests go first, they notify when done.
+                        delay = 1 / self.rate
+
+                    if deadline is not None:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            raise RateLimitTimeoutError("timed out waiting for the rate limiter")
+                        delay = min(delay, remaining)
+                    self._condition.wait(delay)
+            finally:
+                self._waiting[priority] -= 1
+                self._condition.notify_all()
+
+            self.acquired += 1
+            self.waited += time.monotonic() - started
+
+    def close(self) -> None:
+        """
+        Releases the resources of the rate limiter, if any.
+        """
+
+
+class FileTokenBucket(TokenBucket):
+    """
+    Token bucket whose state is kept in a lock file, so that it is shared by all the
+    processes using the same file (e.g. several watchers against the same CPX API).
+
+    Priorities are only honoured between the threads of a process.
+    """
+
+    _STATE = struct.Struct(">dd")
+
+    def __init__(self, path: str, rate: float, burst: Optional[float] = None) -> None:
+        """
+        Initializes a new instance of the FileTokenBucket class.
+
+        Args:
+            path (str): The path of the lock file, created if needed.
+            rate (float): The number of tokens added per second.
+            burst (float, optional): The maximum number of tokens. Defaults to rate (one second worth).
+        """
+        if fcntl is None:
+            raise RateLimitException("sharing a rate limit between processes requires fcntl")
+
+        super().__init__(rate, burst)
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+
+    def _try_take(self) -> float:
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            data = os.pread(self._fd, self._STATE.size, 0)
+            now = time.time()
+            if len(data) == self._STATE.size:
+                tokens, updated = self._STATE.unpack(data)
+                tokens = min(tokens + max(now - updated, 0) * self.rate, self.burst)
+            else:
+                tokens = self.burst
+
+            if tokens >= 1:
+                tokens -= 1
+                delay = 0.0
+            else:
+                delay = (1 - tokens) / self.rate
+            os.pwrite(self._fd, self._STATE.pack(tokens, now), 0)
+            return delay
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def close(self) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+def build_rate_limiter(config: Optional[Dict[str, Any]]) -> Optional[TokenBucket]:
+    """
+    Builds a rate limiter from the monitor.rate_limit section of the config.
+
+    Args:
+        config (Dict[str, Any], optional): The rate_limit section of the config.
+
+    Returns:
+        The rate limiter, or None if requests are not rate limited.
+    """
+    if not config or not config.get("rate"):
+        return None
+    if config.get("lock_file"):
+        return FileTokenBucket(config["lock_file"], config["rate"], config.get("burst"))
+    return TokenBucket(config["rate"], config.get("burst"))
@@ -0,0 +1,245 @@
+import json
+import struct
+import time
+import zlib
+
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional
+
+from cpx_health_monitor.classmodules import CPXMonitor
+from cpx_health_monitor.exceptions import CPXHealthMonitorException
+from cpx_health_monitor.ratelimit import PRIORITY_SWEEP
+from cpx_health_monitor.utils import json_loads
+
+
+class ReplayException(CPXHealthMonitorException):
+    pass
+
+
+class InvalidSweepLogError(ReplayException, ValueError):
+    pass
+
+
+class ReplayExhaustedError(ReplayException):
+    pass
+
+
+class UnknownInstanceError(ReplayException, LookupError):
+    pass
+
+
+# A sweep log starts with _MAGIC, followed by one frame per sweep.
+# Each frame is a (timestamp, payload length) header and a zlib-compressed JSON payload,
+# so frames can be located by reading headers only, without decompressing anything.
+_MAGIC = b"CPXSWEEP1\n"
+_FRAME_HEADER = struct.Struct(">dI")
+
+
+class Sweep(NamedTuple):
+    timestamp: float
+    instances: List[str]
+    responses: Dict[str, Dict[str, str]]
+
+
+class SweepRecorder:
+    """
+    Records the raw responses of fleet-wide sweeps to a compressed, seekable log.
+
+    Methods:
+        record(instances: List[str], responses: Dict[str, Dict[str, str]], timestamp: float=None) -> None:
+            Appends a sweep to the log.
+        close() -> None: Closes the log.
+    """
+
+    def __init__(self, file_path: str, level: int = 6) -> None:
+        """
+        Opens a sweep log for appending, creating it if needed.
+
+        Args:
+            file_path (str): The path of the log file.
+            level (int): The zlib compression level of each frame.
+        """
+        self._level = level
+        self._file = open(file_path, "ab")
+        if self._file.tell() == 0:
+            self._file.write(_MAGIC)
+            self._file.flush()
+
+    def record(
+        self,
+        instances: List[str],
+        responses: Dict[str, Dict[str, str]],
+        timestamp: Optional[float] = None,
+    ) -> None:
+        """
+        Appends a sweep to the log.
+
+        Args:
+            instances (List[str]): The response of the /servers endpoint.
+            responses (Dict[str, Dict[str, str]]): The response for each instance, by IP.
+            timestamp (float, optional): When the sweep happened. Defaults to now.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+
+        payload = json.dumps(
+            {"instances": instances, "responses": responses}, separators=(",", ":")
+        ).encode("utf-8")
+        payload = zlib.compress(payload, self._level)
+
+        self._file.write(_FRAME_HEADER.pack(timestamp, len(payload)))
+        self._file.write(payload)
+        self._file.flush()
+
+    def close(self) -> None:
+        self._file.close()
+
+    def __enter__(self) -> "SweepRecorder":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+class SweepLog:
+    """
+    Random access reader for sweep logs written by SweepRecorder.
+
+    Only frame headers are read when opening the log; sweeps are decompressed on access.
+    """
+
+    def __init__(self, file_path: str) -> None:
+        """
+        Opens a sweep log and indexes its frames.
+
+        Args:
+            file_path (str): The path of the log file.
+        """
+        self._file = open(file_path, "rb")
+        if self._file.read(len(_MAGIC)) != _MAGIC:
+            self._file.close()
+            raise InvalidSweepLogError(f"'{file_path}' is not a sweep log")
+
+        self._offsets: List[int] = []
+        self._timestamps: List[float] = []
+        while True:
+            header = self._file.read(_FRAME_HEADER.size)
+            if len(header) < _FRAME_HEADER.size:
+                break
+            timestamp, length = _FRAME_HEADER.unpack(header)
+            self._offsets.append(self._file.tell())
+            self._timestamps.append(timestamp)
+            self._file.seek(length, 1)
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    def __getitem__(self, i: int) -> Sweep:
+        offset = self._offsets[i]
+        self._file.seek(offset - _FRAME_HEADER.size)
+        timestamp, length = _FRAME_HEADER.unpack(self._file.read(_FRAME_HEADER.size))
+        payload = self._file.read(length)
+        if len(payload) < length:
+            raise InvalidSweepLogError(f"Sweep {i} is truncated")
+
+        data = json_loads(zlib.decompress(payload))
+        return Sweep(timestamp, data["instances"], data["responses"])
+
+    def __iter__(self) -> Iterator[Sweep]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def timestamp(self, i: int) -> float:
+        return self._timestamps[i]
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class ReplayMonitor(CPXMonitor):
+    """
+    CPXMonitor driven by a sweep log instead of a live CPX API.
+
+    Every fleet-wide sweep advances to the next recorded sweep, waiting for the
+    recorded interval between sweeps divided by the speed factor.
+
+    Attributes:
+        speed (float): The replay speed factor. 0 replays as fast as possible.
+        loop (bool): Whether to start over when the end of the log is reached.
+    """
+
+    def __init__(self, log: SweepLog, speed: float = 1.0, loop: bool = False, start: int = 0, **kwargs) -> None:
+        """
+        Initializes a new instance of the ReplayMonitor class.
+
+        Args:
+            log (SweepLog): The sweeps to replay.
+            speed (float): The replay speed factor. 0 replays as fast as possible.
+            loop (bool): Whether to start over when the end of the log is reached.
+            start (int): The index of the first sweep to replay.
+            **kwargs: Extra arguments passed to the CPXMonitor constructor, e.g. the health
+                thresholds, metrics or a recorder.
+        """
+        super().__init__(**kwargs)
+        if not len(log):
+            raise InvalidSweepLogError("Sweep log is empty")
+
+        self._log = log
+        self.speed = speed
+        self.loop = loop
+        self._next = start
+        self._sweep: Optional[Sweep] = None
+        self._clock_origin: Optional[float] = None
+        self._log_origin: Optional[float] = None
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any], log: SweepLog, **kwargs) -> "ReplayMonitor":
+        """
+        Creates a new instance of the ReplayMonitor class from the monitor section of the config,
+        so that replayed sweeps are judged with the same thresholds and metrics as live ones.
+
+        Args:
+            config (Dict[str, Any]): The monitor section of the config.
+            log (SweepLog): The sweeps to replay.
+            **kwargs: Extra arguments passed to the constructor, e.g. speed and loop.
+
+        Returns:
+            The new instance.
+        """
+        # Replays don't issue requests, and don't describe the live fleet.
+        kwargs.setdefault("rate_limiter", None)
+        kwargs.setdefault("hedger", None)
+        kwargs.setdefault("state_file", None)
+        return super().from_config(config, log=log, **kwargs)
+
+    def _wait_for(self, i: int) -> None:
+        if self._clock_origin is None or not self.speed:
+            self._clock_origin = time.monotonic()
+            self._log_origin = self._log.timestamp(i)
+            return
+
+        due = self._clock_origin + (self._log.timestamp(i) - self._log_origin) / self.speed
+        delay = due - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def _advance(self) -> Sweep:
+        if self._next >= len(self._log):
+            if not self.loop:
+                raise ReplayExhaustedError("Reached the end of the sweep log")
+            self._next = 0
+            self._clock_origin = None
+
+        self._wait_for(self._next)
+        self._sweep = self._log[self._next]
+        self._next += 1
+        return self._sweep
+
+    def _get_instances(self) -> List[str]:
+        return list(self._advance().instances)
+
+    def _get_stat(self, instance_ip: str, priority: int = PRIORITY_SWEEP) -> Dict[str, str]:
+        sweep = self._sweep if self._sweep is not None else self._advance()
+        try:
+            return dict(sweep.responses[instance_ip])
+        except KeyError:
+            raise UnknownInstanceError(f"Invalid IP '{instance_ip}'") from None
@@ -0,0 +1,352 @@
+import gzip
+import hashlib
+import json
+import logging
+import re
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from typing import Dict, List, Optional, Tuple
+
+from cpx_health_monitor.api import Snapshot
+from cpx_health_monitor.classmodules import CPXMonitor
+
+LOG = logging.getLogger(__name__)
+
+JSON_CONTENT_TYPE = "application/json"
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Response:
+    """
+    A response body serialized once per snapshot and shared by every request until
+    the next one, with its ETag and, on first request, its gzip-compressed variant.
+    """
+
+    __slots__ = ("body", "content_type", "etag", "_gzipped")
+
+    def __init__(self, body: bytes, content_type: str) -> None:
+        self.body = body
+        self.content_type = content_type
+        self.etag = '"' + hashlib.blake2b(body, digest_size=12).hexdigest() + '"'
+        self._gzipped: Optional[bytes] = None
+
+    @property
+    def gzipped(self) -> bytes:
+        # Racing requests may both compress the body, which is harmless.
+        if self._gzipped is None:
+            self._gzipped = gzip.compress(self.body, compresslevel=5)
+        return self._gzipped
+
+
+def _escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _metric(lines: List[str], name: str, kind: str, help: str, samples: List[Tuple[str, float]]) -> None:
+    lines.append(f"# HELP {name} {help}")
+    lines.append(f"# TYPE {name} {kind}")
+    for labels, value in samples:
+        lines.append(f"{name}{{{labels}}} {value}" if labels else f"{name} {value}")
+
+
+# Characters of metric names declared in the config that Prometheus doesn't allow.
+_METRIC_NAME = re.compile(r"[^a-zA-Z0-9_]")
+
+
+def _extra_metric_names(snapshot: Snapshot) -> List[str]:
+    # The metrics declared besides CPU and memory usage, in the order they are reported.
+    names: Dict[str, None] = {}
+    for item in snapshot.instances:
+        names.update(dict.fromkeys(item.extra))
+    for item in snapshot.services:
+        names.update(dict.fromkeys(item.extra))
+    return list(names)
+
+
+def to_prometheus(
+    snapshot: Snapshot, duration: float, errors: int, hedging: Optional[Dict[str, float]] = None
+) -> str:
+    """
+    Formats a snapshot in the Prometheus text exposition format.
+
+    Args:
+        snapshot (Snapshot): The snapshot.
+        duration (float): How long the sweep of the snapshot took, in seconds.
+        errors (int): The number of failed sweeps since the server started.
+        hedging (Dict[str, float], optional): The counters of Hedger.stats, if requests are hedged.
+
+    Returns:
+        The metrics.
+    """
+    instance_labels = [
+        (instance, f'instance="{instance.ip}",service="{_escape_label(instance.service)}"')
+        for instance in snapshot.instances
+    ]
+    service_labels = [
+        (service, f'service="{_escape_label(service.name)}"') for service in snapshot.services
+    ]
+
+    lines: List[str] = []
+    _metric(lines, "cpx_instance_cpu_usage_percent", "gauge", "CPU usage of the instance.",
+            [(labels, instance.cpu) for instance, labels in instance_labels])
+    _metric(lines, "cpx_instance_memory_usage_percent", "gauge", "Memory usage of the instance.",
+            [(labels, instance.memory) for instance, labels in instance_labels])
+    _metric(lines, "cpx_instance_healthy", "gauge", "Whether the instance is healthy.",
+            [(labels, int(instance.healthy)) for instance, labels in instance_labels])
+    _metric(lines, "cpx_service_cpu_usage_percent", "gauge", "Average CPU usage of the instances of the service.",
+            [(labels, service.cpu) for service, labels in service_labels])
+    _metric(lines, "cpx_service_memory_usage_percent", "gauge", "Average memory usage of the instances of the service.",
+            [(labels, service.memory) for service, labels in service_labels])
+    _metric(lines, "cpx_service_healthy", "gauge", "Whether the service is healthy.",
+            [(labels, int(service.healthy)) for service, labels in service_labels])
+    _metric(lines, "cpx_service_instances", "gauge", "Number of instances of the service, by status.",
+            [(f'{labels},status="healthy"', service.healthy_instances) for service, labels in service_labels]
+            + [(f'{labels},status="unhealthy"', service.unhealthy_instances) for service, labels in service_labels])
+    for name in _extra_metric_names(snapshot):
+        gauge = _METRIC_NAME.sub("_", name)
+        _metric(lines, f"cpx_instance_{gauge}", "gauge", f"{name} of the instance.",
+                [(labels, instance.extra[name]) for instance, labels in instance_labels if name in instance.extra])
+        _metric(lines, f"cpx_service_{gauge}", "gauge", f"Aggregate {name} of the instances of the service.",
+                [(labels, service.extra[name]) for service, labels in service_labels if name in service.extra])
+    _metric(lines, "cpx_sweep_timestamp_seconds", "gauge", "When the last sweep started.",
+            [("", snapshot.timestamp)])
+    _metric(lines, "cpx_sweep_duration_seconds", "gauge", "How long the last sweep took.",
+            [("", round(duration, 6))])
+    _metric(lines, "cpx_sweep_errors_total", "counter", "Number of failed sweeps.",
+            [("", errors)])
+    if hedging is not None:
+        _metric(lines, "cpx_hedge_requests_total", "counter", "Number of requests eligible for hedging.",
+                [("", hedging["requests"])])
+        _metric(lines, "cpx_hedges_total", "counter", "Number of duplicate requests, by outcome.",
+                [('outcome="won"', hedging["won"]),
+                 ('outcome="lost"', hedging["fired"] - hedging["won"]),
+                 ('outcome="over_budget"', hedging["skipped"])])
+        _metric(lines, "cpx_hedge_delay_seconds", "gauge", "Latency after which requests are duplicated.",
+                [("", round(hedging["threshold"], 6))])
+    return "\n".join(lines) + "\n"
+
+
+def build_responses(
+    snapshot: Snapshot, duration: float, errors: int, hedging: Optional[Dict[str, float]] = None
+) -> Dict[str, Response]:
+    """
+    Serializes a snapshot for every endpoint of the server.
+
+    Args:
+        snapshot (Snapshot): The snapshot.
+        duration (float): How long the sweep of the snapshot took, in seconds.
+        errors (int): The number of failed sweeps since the server started.
+        hedging (Dict[str, float], optional): The counters of Hedger.stats, if requests are hedged.
+
+    Returns:
+        The response of each endpoint, by path.
+    """
+    instances = json.dumps(
+        {"timestamp": snapshot.timestamp, "instances": [i._asdict() for i in snapshot.instances]},
+        separators=(",", ":"),
+    )
+    services = json.dumps(
+        {"timestamp": snapshot.timestamp, "services": [s._asdict() for s in snapshot.services]},
+        separators=(",", ":"),
+    )
+    return {
+        "/instances": Response(instances.encode("utf-8"), JSON_CONTENT_TYPE),
+        "/services": Response(services.encode("utf-8"), JSON_CONTENT_TYPE),
+        "/metrics": Response(
+            to_prometheus(snapshot, duration, errors, hedging).encode("utf-8"), PROMETHEUS_CONTENT_TYPE
+        ),
+    }
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server_version = "cpxstat"
+
+    def log_message(self, format: str, *args) -> None:
+        LOG.debug("%s %s", self.address_string(), format % args)
+
+    def _send(self, status: int, body: bytes, content_type: str, headers: Dict[str, str] = None) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def do_GET(self) -> None:
+        monitor_server: "MonitorServer" = self.server.monitor_server
+        path = self.path.split("?", 1)[0].rstrip("/") or "/"
+
+        if path == "/healthz":
+            if monitor_server.fresh:
+                self._send(200, b"ok\n", "text/plain")
+            else:
+                self._send(503, b"stale\n", "text/plain")
+            return
+
+        responses = monitor_server.responses
+        if path not in ("/instances", "/services", "/metrics"):
+            self._send(404, b'{"error":"not found"}', JSON_CONTENT_TYPE)
+            return
+        if responses is None:
+            self._send(503, b'{"error":"no snapshot yet"}', JSON_CONTENT_TYPE, {"Retry-After": "1"})
+            return
+
+        response = responses[path]
+        headers = {"ETag": response.etag, "Vary": "Accept-Encoding"}
+        if self.headers.get("If-None-Match") == response.etag:
+            self.send_response(304)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            return
+
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            headers["Content-Encoding"] = "gzip"
+            self._send(200, response.gzipped, response.content_type, headers)
+        else:
+            self._send(200, response.body, response.content_type, headers)
+
+    do_HEAD = do_GET
+
+
+class MonitorServer:
+    """
+    Sweeps the fleet in the background and serves the latest snapshot over HTTP,
+    so that any number of clients cost one sweep per interval.
+
+    Every snapshot is serialized once, when it is taken, and the same bytes are
+    served to every request until the next one. Failed sweeps are logged and the
+    previous snapshot keeps being served, with /metrics updated to count the failure.
+
+    Endpoints:
+        /instances: The statistics of every instance, as JSON.
+        /services: The statistics of every service, as JSON.
+        /metrics: Both, in the Prometheus text format.
+        /healthz: 200 while the snapshot is fresh, 503 otherwise.
+
+    Methods:
+        start() -> None: Starts the sweep and HTTP server threads.
+        shutdown() -> None: Stops them.
+    """
+
+    def __init__(
+        self,
+        cpx_monitor: CPXMonitor,
+        host: str = "127.0.0.1",
+        port: int = 9185,
+        interval: float = 1.0,
+    ) -> None:
+        """
+        Initializes a new instance of the MonitorServer class.
+
+        Args:
+            cpx_monitor (CPXMonitor): The monitor to sweep the fleet with.
+            host (str): The address to listen on.
+            port (int): The port to listen on, 0 picks a free one.
+            interval (float): The number of seconds between the start of two sweeps.
+        """
+        self._cpx = cpx_monitor
+        self._interval = interval
+        self._httpd = _ThreadingHTTPServer((host, port), _Handler)
+        self._httpd.monitor_server = self
+        self._stop = threading.Event()
+        self._ready = threading.Event()
+        self._threads: List[threading.Thread] = []
+        self.responses: Optional[Dict[str, Response]] = None
+        self.snapshot: Optional[Snapshot] = None
+        self.sweeps = 0
+        self.errors = 0
+        self._duration = 0.0
+
+    @property
+    def address(self) -> Tuple[str, int]:
+        return self._httpd.server_address[:2]
+
+    @property
+    def fresh(self) -> bool:
+        snapshot = self.snapshot
+        return snapshot is not None and time.time() - snapshot.timestamp <= 3 * self._interval + 10
+
+    def _hedging(self) -> Optional[Dict[str, float]]:
+        hedger = self._cpx.hedger
+        return hedger.stats() if hedger is not None else None
+
+    def sweep(self) -> None:
+        """
+        Takes a snapshot of the fleet and replaces the served responses.
+        """
+        timestamp = time.time()
+        started = time.monotonic()
+        try:
+            stats = self._cpx.get_stats()
+            snapshot = Snapshot.from_stats(timestamp, stats, self._cpx.get_services(stats), self._cpx.metrics)
+        except Exception:
+            self.errors += 1
+            LOG.exception("sweep failed, serving the previous snapshot")
+            if self.snapshot is not None:
+                # Only /metrics changes: the error counter must keep counting during outages.
+                responses = dict(self.responses)
+                responses["/metrics"] = Response(
+                    to_prometheus(self.snapshot, self._duration, self.errors, self._hedging()).encode("utf-8"),
+                    PROMETHEUS_CONTENT_TYPE,
+                )
+                self.responses = responses
+            return
+
+        # Readers get either the previous or the new responses, never a mix of both.
+        self._duration = time.monotonic() - started
+        self.responses = build_responses(snapshot, self._duration, self.errors, self._hedging())
+        self.snapshot = snapshot
+        self.sweeps += 1
+        self._ready.set()
+
+    def _sweep_forever(self) -> None:
+        while not self._stop.is_set():
+            started = time.monotonic()
+            self.sweep()
+            self._stop.wait(max(self._interval - (time.monotonic() - started), 0))
+
+    def wait_ready(self, timeout: Optional[float] = None) -> bool:
+        """
+        Waits for the first snapshot.
+
+        Returns:
+            True if a snapshot is available.
+        """
+        return self._ready.wait(timeout)
+
+    def start(self) -> None:
+        for target, name in (
+            (self._sweep_forever, "cpx-serve-sweep"),
+            (self._httpd.serve_forever, "cpx-serve-http"),
+        ):
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        LOG.info("serving on http://%s:%d", *self.address)
+
+    def shutdown(self) -> None:
+        self._stop.set()
+        if self._threads:
+            # Waits for serve_forever, which only runs once started.
+            self._httpd.shutdown()
+        self._httpd.server_close()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def __enter__(self) -> "MonitorServer":
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.shutdown()
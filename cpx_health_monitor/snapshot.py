@@ -0,0 +1,407 @@
+import gzip
+import heapq
+import json
+import mmap
+import socket
+import struct
+import sys
+import time
+
+from array import array
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Set, Tuple
+
+from cpx_health_monitor.classmodules import InstanceIndex, _parse_percentage
+from cpx_health_monitor.exceptions import CPXHealthMonitorException
+from cpx_health_monitor.utils import json_loads
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+
+class SnapshotException(CPXHealthMonitorException):
+    pass
+
+
+class InvalidSnapshotError(SnapshotException, ValueError):
+    pass
+
+
+class UnsupportedCompressionError(SnapshotException, ValueError):
+    pass
+
+
+COMPRESSIONS = ("none", "gzip", "zstd")
+
+# A snapshot file starts with a header: _MAGIC, the compression of the body (index in
+# COMPRESSIONS), the number of instances, the timestamp and the length of the metadata.
+# The body follows, compressed as a whole: the JSON metadata (the service and status
+# dictionaries, the format of the IP column and the service aggregates), then one
+# column per field, in instance order, each padded to 8 bytes:
+#   ip: uint32 IPv4 addresses, or uint32 offsets (count + 1) into UTF-8 text
+#   service: uint16 index in the service dictionary
+#   status: uint8 index in the status dictionary
+#   cpu, memory: uint8 percentages
+# Instances are sorted by IP, and numbers are little-endian, so that an uncompressed
+# body can be memory-mapped and read in place.
+_MAGIC = b"CPXSNAP1"
+_HEADER = struct.Struct("<8sB3xIdQ")
+_IPV4 = "ipv4"
+_TEXT = "text"
+_NATIVE = sys.byteorder == "little"
+
+_PERCENT_STRINGS = ["%d%%" % i for i in range(256)]
+
+
+def _pad(length: int) -> int:
+    return -length % 8
+
+
+def _ipv4(ip: str) -> Optional[int]:
+    try:
+        value = int.from_bytes(socket.inet_aton(ip), "big")
+    except OSError:
+        return None
+    # inet_aton also accepts shorthands like "10.1", which wouldn't round-trip.
+    return value if _format_ipv4(value) == ip else None
+
+
+def _format_ipv4(value: int) -> str:
+    return "%d.%d.%d.%d" % (value >> 24, value >> 16 & 255, value >> 8 & 255, value & 255)
+
+
+def _little_endian(values: array) -> bytes:
+    if not _NATIVE:
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def _compress(body: bytes, compression: str, level: Optional[int]) -> bytes:
+    if compression == "none":
+        return body
+    if compression == "gzip":
+        return gzip.compress(body, compresslevel=6 if level is None else level)
+    if zstandard is None:
+        raise UnsupportedCompressionError(
+            "zstd compression requires the zstandard package (pip install cpx_health_monitor[zstd])"
+        )
+    return zstandard.ZstdCompressor(level=3 if level is None else level).compress(body)
+
+
+def _decompress(body, compression: str) -> bytes:
+    if compression == "gzip":
+        return gzip.decompress(body)
+    if zstandard is None:
+        raise UnsupportedCompressionError(
+            "zstd snapshots require the zstandard package (pip install cpx_health_monitor[zstd])"
+        )
+    return zstandard.ZstdDecompressor().decompress(body)
+
+
+def save_snapshot(
+    file_path: str,
+    stats: List[Dict[str, Dict[str, str]]],
+    services: List[Dict[str, Dict[str, Any]]],
+    timestamp: Optional[float] = None,
+    compression: str = "none",
+    level: Optional[int] = None,
+) -> int:
+    """
+    Writes instance and service statistics to a columnar snapshot file.
+
+    Args:
+        file_path (str): The path of the snapshot file, overwritten if it exists.
+        stats (List[Dict[str, Dict[str, str]]]): The result of CPXMonitor.get_stats.
+        services (List[Dict[str, Dict[str, Any]]]): The result of CPXMonitor.get_services.
+        timestamp (float, optional): When the statistics were retrieved. Defaults to now.
+        compression (str): One of COMPRESSIONS. Only uncompressed snapshots are
+            memory-mapped when loaded, compressed ones are decompressed in memory.
+        level (int, optional): The compression level.
+
+    Returns:
+        The size of the file, in bytes.
+    """
+    if compression not in COMPRESSIONS:
+        raise UnsupportedCompressionError(
+            f"Invalid compression '{compression}', expected one of {COMPRESSIONS}"
+        )
+    if timestamp is None:
+        timestamp = time.time()
+
+    instances = sorted(
+        (ip, instance) for instance_stats in stats for ip, instance in instance_stats.items()
+    )
+    service_codes: Dict[str, int] = {}
+    status_codes: Dict[str, int] = {}
+    ipv4 = array("I")
+    service_column = array("H")
+    status_column = bytearray()
+    cpu_column = bytearray()
+    memory_column = bytearray()
+    try:
+        for ip, instance in instances:
+            if ipv4 is not None:
+                value = _ipv4(ip)
+                if value is None:
+                    ipv4 = None
+                else:
+                    ipv4.append(value)
+            service_column.append(service_codes.setdefault(instance["service"], len(service_codes)))
+            status_column.append(status_codes.setdefault(instance["status"], len(status_codes)))
+            cpu_column.append(_parse_percentage(instance["cpu"]))
+            memory_column.append(_parse_percentage(instance["memory"]))
+    except (OverflowError, ValueError) as e:
+        raise InvalidSnapshotError(f"Statistics can't be stored in a snapshot: {e}") from None
+
+    if ipv4 is not None:
+        ip_column = _little_endian(ipv4)
+    else:
+        texts = [ip.encode("utf-8") for ip, _ in instances]
+        offsets = array("I", [0])
+        for text in texts:
+            offsets.append(offsets[-1] + len(text))
+        ip_column = _little_endian(offsets) + b"".join(texts)
+
+    metadata = json.dumps(
+        {
+            "services": list(service_codes),
+            "statuses": list(status_codes),
+            "ip_format": _IPV4 if ipv4 is not None else _TEXT,
+            "aggregates": services,
+        },
+        separators=(",", ":"),
+    ).encode("utf-8")
+
+    sections = [
+        metadata,
+        ip_column,
+        _little_endian(service_column),
+        bytes(status_column),
+        bytes(cpu_column),
+        bytes(memory_column),
+    ]
+    body = b"".join(section + b"\0" * _pad(len(section)) for section in sections)
+    body = _compress(body, compression, level)
+    header = _HEADER.pack(_MAGIC, COMPRESSIONS.index(compression), len(instances), timestamp, len(metadata))
+    with open(file_path, "wb") as f:
+        f.write(header)
+        f.write(body)
+    return len(header) + len(body)
+
+
+class SnapshotFile:
+    """
+    Reader for snapshot files written by save_snapshot.
+
+    Uncompressed snapshots are memory-mapped: opening one only parses the header and
+    the metadata, whatever the number of instances, and rows are decoded on access.
+
+    Methods:
+        select(service: str=None, status: str=None, sort: str=None, top: int=None, limit: int=None)
+            -> List[Tuple[str, str, str, str, str]]:
+            Returns the matching rows in the requested order, like InstanceIndex.select.
+        stats() -> List[Dict[str, Dict[str, str]]]: The instance statistics, as CPXMonitor.get_stats.
+        close() -> None: Closes the snapshot.
+    """
+
+    def __init__(self, file_path: str) -> None:
+        """
+        Opens a snapshot file.
+
+        Args:
+            file_path (str): The path of the snapshot file.
+        """
+        self._views: List[memoryview] = []
+        self._mmap: Optional[mmap.mmap] = None
+        with open(file_path, "rb") as f:
+            header = f.read(_HEADER.size)
+            if len(header) < _HEADER.size or header[:len(_MAGIC)] != _MAGIC:
+                raise InvalidSnapshotError(f"'{file_path}' is not a snapshot")
+            _, compression, count, timestamp, metadata_length = _HEADER.unpack(header)
+            if compression >= len(COMPRESSIONS):
+                raise InvalidSnapshotError(f"'{file_path}' has an unknown compression")
+            self.compression = COMPRESSIONS[compression]
+            if self.compression == "none":
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                body = self._view(memoryview(self._mmap))[_HEADER.size:]
+            else:
+                body = memoryview(_decompress(f.read(), self.compression))
+
+        self.timestamp: float = timestamp
+        self._count = count
+        try:
+            self._read_columns(self._view(body), metadata_length)
+        except (ValueError, TypeError, KeyError) as e:
+            self.close()
+            raise InvalidSnapshotError(f"'{file_path}' is corrupted: {e}") from None
+
+    def _view(self, view: memoryview) -> memoryview:
+        # Views of the memory map must be released before it can be closed.
+        self._views.append(view)
+        return view
+
+    def _section(self, body: memoryview, offset: int, length: int) -> Tuple[memoryview, int]:
+        if offset + length > len(body):
+            raise ValueError("truncated column")
+        return self._view(body[offset:offset + length]), offset + length + _pad(length)
+
+    def _integers(self, section: memoryview, typecode: str) -> Sequence[int]:
+        if _NATIVE:
+            return self._view(section.cast(typecode))
+        values = array(typecode, section.tobytes())
+        values.byteswap()
+        return values
+
+    def _read_columns(self, body: memoryview, metadata_length: int) -> None:
+        count = self._count
+        section, offset = self._section(body, 0, metadata_length)
+        metadata = json_loads(section.tobytes())
+        self.services: List[Dict[str, Dict[str, Any]]] = metadata["aggregates"]
+        self._service_names: List[str] = metadata["services"]
+        self._status_names: List[str] = metadata["statuses"]
+
+        if metadata["ip_format"] == _IPV4:
+            section, offset = self._section(body, offset, 4 * count)
+            self._ipv4 = self._integers(section, "I")
+            self._ip_offsets = self._ip_text = None
+        else:
+            # The offsets and the text they point into are a single section.
+            section, _ = self._section(body, offset, 4 * (count + 1))
+            self._ipv4 = None
+            self._ip_offsets = self._integers(section, "I")
+            self._ip_text, _ = self._section(body, offset + len(section), self._ip_offsets[-1])
+            length = len(section) + len(self._ip_text)
+            offset += length + _pad(length)
+
+        section, offset = self._section(body, offset, 2 * count)
+        self._service_column = self._integers(section, "H")
+        self._status_column, offset = self._section(body, offset, count)
+        self._cpu_column, offset = self._section(body, offset, count)
+        self._memory_column, offset = self._section(body, offset, count)
+
+    def __len__(self) -> int:
+        return self._count
+
+    def ip(self, i: int) -> str:
+        if self._ipv4 is not None:
+            return _format_ipv4(self._ipv4[i])
+        start, end = self._ip_offsets[i], self._ip_offsets[i + 1]
+        return self._ip_text[start:end].tobytes().decode("utf-8")
+
+    def row(self, i: int) -> Tuple[str, str, str, str, str]:
+        """
+        Returns the (instance, service, cpu, memory, status) row of the i-th instance, in IP order.
+        """
+        return (
+            self.ip(i),
+            self._service_names[self._service_column[i]],
+            _PERCENT_STRINGS[self._cpu_column[i]],
+            _PERCENT_STRINGS[self._memory_column[i]],
+            self._status_names[self._status_column[i]],
+        )
+
+    def __iter__(self) -> Iterator[Tuple[str, str, str, str, str]]:
+        for i in range(self._count):
+            yield self.row(i)
+
+    def stats(self) -> List[Dict[str, Dict[str, str]]]:
+        """
+        Returns the instance statistics of the snapshot, in the format of CPXMonitor.get_stats.
+        """
+        return [
+            {ip: {"service": service, "cpu": cpu, "memory": memory, "status": status}}
+            for ip, service, cpu, memory, status in self
+        ]
+
+    @staticmethod
+    def _codes(names: List[str], name: str) -> Set[int]:
+        name = name.lower()
+        return {code for code, candidate in enumerate(names) if candidate.lower() == name}
+
+    def _candidates(self, service: Optional[str], status: Optional[str]) -> Sequence[int]:
+        candidates: Sequence[int] = range(self._count)
+        for column, names, name in (
+            (self._status_column, self._status_names, status),
+            (self._service_column, self._service_names, service),
+        ):
+            if name is None:
+                continue
+            codes = self._codes(names, name)
+            candidates = [i for i in candidates if column[i] in codes]
+        return candidates
+
+    def select(
+        self,
+        service: Optional[str] = None,
+        status: Optional[str] = None,
+        sort: Optional[str] = None,
+        top: Optional[int] = None,
+        limit: Optional[int] = None,
+        offset: int = 0,
+    ) -> List[Tuple[str, str, str, str, str]]:
+        """
+        Returns the rows matching the filters, in the requested order, with the same
+        semantics as InstanceIndex.select. Only the returned rows are decoded.
+
+        Args:
+            service (str, optional): Only return instances of this service.
+            status (str, optional): Only return instances with this status.
+            sort (str, optional): One of InstanceIndex.SORT_KEYS.
+            top (int, optional): Only return the N highest ranked rows.
+            limit (int, optional): Return at most N rows.
+            offset (int): Skip the first N rows of the ordering.
+
+        Returns:
+            A list of (instance, service, cpu, memory, status) rows.
+        """
+        if sort is None:
+            sort = InstanceIndex.TOP_SORT_KEY if top is not None else InstanceIndex.DEFAULT_SORT_KEY
+        if sort not in InstanceIndex.SORT_KEYS:
+            raise ValueError(f"Invalid sort key '{sort}', expected one of {InstanceIndex.SORT_KEYS}")
+
+        counts = [n for n in (top, limit) if n is not None]
+        end = None if not counts else offset + min(counts)
+        candidates = self._candidates(service, status)
+
+        # Instances are stored in IP order, which breaks the ties of every other order.
+        if sort == "instance":
+            order = candidates[offset:end]
+        elif sort in ("cpu", "memory"):
+            # Bucket by percentage, hottest first.
+            column = self._cpu_column if sort == "cpu" else self._memory_column
+            buckets: List[List[int]] = [[] for _ in range(256)]
+            for i in candidates:
+                buckets[column[i]].append(i)
+            order = []
+            for bucket in reversed(buckets):
+                order.extend(bucket)
+                if end is not None and len(order) >= end:
+                    break
+            order = order[offset:end]
+        else:
+            column, names = (
+                (self._service_column, self._service_names)
+                if sort == "service"
+                else (self._status_column, self._status_names)
+            )
+            key = lambda i: (names[column[i]], i)  # noqa: E731
+            order = heapq.nsmallest(end, candidates, key=key) if end is not None else sorted(candidates, key=key)
+            order = order[offset:end]
+
+        return [self.row(i) for i in order]
+
+    def close(self) -> None:
+        for view in reversed(self._views):
+            view.release()
+        self._views = []
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def __enter__(self) -> "SnapshotFile":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
@@ -0,0 +1,238 @@
+import math
+import time
+
+from typing import Any, Dict, List, NamedTuple, Optional, Set, Tuple
+
+from cpx_health_monitor.classmodules import _parse_percentage
+
+ANOMALY_CPU = "cpu"
+ANOMALY_MEMORY = "memory"
+ANOMALY_LEAK = "memory leak"
+
+
+class Trend(NamedTuple):
+    cpu_z: float
+    memory_z: float
+    # Smoothed change of the usage, in % per minute.
+    cpu_slope: float
+    memory_slope: float
+    # Number of consecutive sweeps the memory usage hasn't decreased for.
+    memory_growth: int
+    anomalies: Tuple[str, ...]
+
+    @property
+    def anomalous(self) -> bool:
+        return bool(self.anomalies)
+
+    def cells(self) -> List[str]:
+        return [
+            f"{self.cpu_z:+.1f}",
+            f"{self.memory_z:+.1f}",
+            f"{self.cpu_slope:+.1f}/min",
+            f"{self.memory_slope:+.1f}/min",
+            ", ".join(self.anomalies),
+        ]
+
+
+_WARMING_UP_CELLS = ["", "", "", "", "warming up"]
+
+
+class _Baseline:
+    """
+    Exponentially weighted mean and variance of a metric, and of its rate of change.
+    """
+
+    __slots__ = ("mean", "variance", "slope", "last")
+
+    def __init__(self, value: float) -> None:
+        self.mean = value
+        self.variance = 0.0
+        self.slope = 0.0
+        self.last = value
+
+    def update(self, value: float, alpha: float, minutes: float) -> float:
+        # The z-score is taken against the baseline before the sample is added to it,
+        # so that a spike doesn't hide itself.
+        deviation = value - self.mean
+        z = deviation / math.sqrt(self.variance) if self.variance > 0 else 0.0
+
+        increment = alpha * deviation
+        self.mean += increment
+        self.variance = (1 - alpha) * (self.variance + deviation * increment)
+        if minutes > 0:
+            self.slope += alpha * ((value - self.last) / minutes - self.slope)
+        self.last = value
+        return z
+
+
+class _InstanceTrend:
+    __slots__ = ("cpu", "memory", "samples", "updated", "growth", "growth_from", "trend")
+
+    def __init__(self, cpu: int, memory: int, timestamp: float) -> None:
+        self.cpu = _Baseline(cpu)
+        self.memory = _Baseline(memory)
+        self.samples = 1
+        self.updated = timestamp
+        self.growth = 0
+        self.growth_from = memory
+        self.trend: Optional[Trend] = None
+
+
+class TrendTracker:
+    """
+    Streaming trend estimation of the CPU and memory usage of every instance.
+
+    Each instance keeps a constant amount of state, updated in O(1) per sweep:
+    exponentially weighted baselines (mean and variance) for the z-score of each new
+    sample, smoothed slopes, and the length of the current run of non-decreasing
+    memory usage. No history is stored.
+
+    An instance is anomalous when, after the warm-up sweeps, its CPU or memory usage
+    deviates from its baseline by at least z_threshold standard deviations, or its
+    memory usage has grown by at least growth_min % without ever decreasing over at
+    least growth_sweeps sweeps, which is how leaks look.
+
+    Methods:
+        update(stats: List[Dict[str, Dict[str, str]]], timestamp: float=None, replace: bool=True) -> None:
+            Adds a sweep to the trends.
+        get(ip: str) -> Optional[Trend]: Returns the trend of an instance, once warmed up.
+    """
+
+    def __init__(
+        self,
+        alpha: float = 0.1,
+        z_threshold: float = 3.0,
+        warmup: int = 5,
+        growth_sweeps: int = 10,
+        growth_min: int = 10,
+    ) -> None:
+        """
+        Initializes a new instance of the TrendTracker class.
+
+        Args:
+            alpha (float): The weight of each new sample in the baselines and slopes.
+            z_threshold (float): The absolute z-score from which a sample is anomalous.
+            warmup (int): The number of sweeps of an instance before it can be anomalous.
+            growth_sweeps (int): The number of sweeps of memory growth that look like a leak.
+            growth_min (int): The minimum memory growth (%) over those sweeps.
+        """
+        self.alpha = alpha
+        self.z_threshold = z_threshold
+        self.warmup = warmup
+        self.growth_sweeps = growth_sweeps
+        self.growth_min = growth_min
+        self._trends: Dict[str, _InstanceTrend] = {}
+        self._anomalous: Set[str] = set()
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any]) -> "TrendTracker":
+        """
+        Creates a new instance of the TrendTracker class from the monitor.trends section of the config.
+        """
+        return cls(**config)
+
+    def __len__(self) -> int:
+        return len(self._trends)
+
+    @property
+    def anomalous(self) -> Set[str]:
+        """
+        The IPs of the anomalous instances, as of the last sweep.
+        """
+        return self._anomalous
+
+    def _update(self, ip: str, cpu: int, memory: int, timestamp: float) -> None:
+        state = self._trends.get(ip)
+        if state is None:
+            self._trends[ip] = _InstanceTrend(cpu, memory, timestamp)
+            return
+
+        minutes = (timestamp - state.updated) / 60
+        state.updated = timestamp
+        state.samples += 1
+        # Weighting the first samples by 1 / n makes the baselines plain running means and
+        # variances until there are enough samples for the exponential weighting.
+        alpha = max(self.alpha, 1 / state.samples)
+        cpu_z = state.cpu.update(cpu, alpha, minutes)
+        previous_memory = state.memory.last
+        memory_z = state.memory.update(memory, alpha, minutes)
+
+        if memory < previous_memory:
+            state.growth = 0
+            state.growth_from = memory
+        elif memory > previous_memory or state.growth:
+            state.growth += 1
+
+        if state.samples <= self.warmup:
+            return
+
+        anomalies = []
+        if abs(cpu_z) >= self.z_threshold:
+            anomalies.append(ANOMALY_CPU)
+        if abs(memory_z) >= self.z_threshold:
+            anomalies.append(ANOMALY_MEMORY)
+        if state.growth >= self.growth_sweeps and memory - state.growth_from >= self.growth_min:
+            anomalies.append(ANOMALY_LEAK)
+
+        state.trend = Trend(
+            cpu_z, memory_z, state.cpu.slope, state.memory.slope, state.growth, tuple(anomalies)
+        )
+        if anomalies:
+            self._anomalous.add(ip)
+        else:
+            self._anomalous.discard(ip)
+
+    def update(
+        self,
+        stats: List[Dict[str, Dict[str, str]]],
+        timestamp: Optional[float] = None,
+        replace: bool = True,
+    ) -> None:
+        """
+        Adds a sweep to the trends.
+
+        Args:
+            stats (List[Dict[str, Dict[str, str]]]): The result of CPXMonitor.get_stats.
+            timestamp (float, optional): When the sweep happened, as a time.monotonic() value.
+            replace (bool): Whether the statistics describe the whole fleet,
+                in which case the trends of instances missing from them are dropped.
+        """
+        if timestamp is None:
+            timestamp = time.monotonic()
+
+        seen = 0
+        for instance_stats in stats:
+            for ip, instance in instance_stats.items():
+                seen += 1
+                self._update(
+                    ip,
+                    _parse_percentage(instance["cpu"]),
+                    _parse_percentage(instance["memory"]),
+                    timestamp,
+                )
+
+        if replace and seen != len(self._trends):
+            current = {ip for instance_stats in stats for ip in instance_stats}
+            for ip in [ip for ip in self._trends if ip not in current]:
+                del self._trends[ip]
+                self._anomalous.discard(ip)
+
+    def get(self, ip: str) -> Optional[Trend]:
+        """
+        Returns the trend of an instance.
+
+        Args:
+            ip (str): The IP address of the instance.
+
+        Returns:
+            The trend, or None until the instance has been seen for more than the warm-up sweeps.
+        """
+        state = self._trends.get(ip)
+        return state.trend if state is not None else None
+
+    def cells(self, ip: str) -> List[str]:
+        """
+        Returns the trend of an instance formatted for the TREND_COLUMNS of the printer.
+        """
+        trend = self.get(ip)
+        return trend.cells() if trend is not None else _WARMING_UP_CELLS
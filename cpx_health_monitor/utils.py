@@ -1,15 +1,30 @@
-import collections
+import collections.abc
+import json
 
-from typing import Dict
+from typing import Any, Dict, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 def update_nested_dict(target: Dict, overrides: Dict) -> Dict:
     for key, value in overrides.items():
         value = (
             update_nested_dict(target.get(key, {}), value)
-            if isinstance(value, collections.Mapping)
+            if isinstance(value, collections.abc.Mapping)
             else overrides[key]
         )
         target[key] = value
 
     return target
+
+
+def json_loads(data: Union[bytes, str]) -> Any:
+    """
+    Decodes a JSON document, using orjson when it is installed.
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
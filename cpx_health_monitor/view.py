@@ -0,0 +1,269 @@
+import os
+import select
+import sys
+
+from typing import Optional
+
+from rich.console import Console
+from rich.table import Table
+
+from cpx_health_monitor.classmodules import TREND_COLUMNS, InstanceIndex, rich_table
+
+try:
+    import termios
+    import tty
+except ImportError:  # pragma: no cover - not available on Windows
+    termios = None
+    tty = None
+
+
+KEY_UP = "up"
+KEY_DOWN = "down"
+KEY_PAGE_UP = "page_up"
+KEY_PAGE_DOWN = "page_down"
+KEY_HOME = "home"
+KEY_END = "end"
+KEY_ENTER = "enter"
+KEY_ESCAPE = "escape"
+KEY_BACKSPACE = "backspace"
+
+_ESCAPE_SEQUENCES = {
+    "[A": KEY_UP,
+    "[B": KEY_DOWN,
+    "[5~": KEY_PAGE_UP,
+    "[6~": KEY_PAGE_DOWN,
+    "[H": KEY_HOME,
+    "[1~": KEY_HOME,
+    "[F": KEY_END,
+    "[4~": KEY_END,
+}
+
+# Lines used by the table title, header, borders and the status line.
+_CHROME_HEIGHT = 7
+
+
+class KeyReader:
+    """
+    Context manager reading single key presses from the terminal without blocking.
+
+    On terminals that don't support it (e.g. when stdin is not a TTY),
+    read() simply waits for the timeout and returns None.
+    """
+
+    def __init__(self, stream=None) -> None:
+        self._stream = stream if stream is not None else sys.stdin
+        self._fd = None
+        self._saved = None
+
+    def __enter__(self) -> "KeyReader":
+        if termios is not None and self._stream.isatty():
+            self._fd = self._stream.fileno()
+            self._saved = termios.tcgetattr(self._fd)
+            tty.setcbreak(self._fd)
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        if self._saved is not None:
+            termios.tcsetattr(self._fd, termios.TCSADRAIN, self._saved)
+            self._saved = None
+
+    def _read_char(self, timeout: float) -> Optional[str]:
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return None
+        return os.read(self._fd, 1).decode(errors="ignore")
+
+    def read(self, timeout: float) -> Optional[str]:
+        """
+        Waits up to timeout seconds for a key press.
+
+        Args:
+            timeout (float): The maximum number of seconds to wait.
+
+        Returns:
+            The pressed character, one of the KEY_* names for special keys,
+            or None if no key was pressed.
+        """
+        if self._fd is None:
+            select.select([], [], [], timeout)
+            return None
+
+        char = self._read_char(timeout)
+        if char == "\x1b":
+            sequence = ""
+            while True:
+                nxt = self._read_char(0.01)
+                if nxt is None:
+                    break
+                sequence += nxt
+                if sequence in _ESCAPE_SEQUENCES or nxt.isalpha() or nxt == "~":
+                    break
+            return _ESCAPE_SEQUENCES.get(sequence, KEY_ESCAPE if not sequence else None)
+        if char in ("\r", "\n"):
+            return KEY_ENTER
+        if char in ("\x7f", "\x08"):
+            return KEY_BACKSPACE
+        return char
+
+
+class InstanceTableView:
+    """
+    Virtualized view over an InstanceIndex that only builds renderables for the visible rows.
+
+    The view keeps a scroll offset and an optional search term, and renders a window
+    of at most as many rows as fit on the console, so the cost of a repaint depends on
+    the terminal height rather than on the fleet size.
+
+    Keys:
+        j / down, k / up: scroll by one row.
+        space / f / page down, b / page up: scroll by one page.
+        g / home, G / end: jump to the first / last row.
+        /: start a search, enter applies it, escape clears it.
+        q: quit.
+    """
+
+    def __init__(
+        self,
+        index: InstanceIndex,
+        console: Console,
+        service: Optional[str] = None,
+        status: Optional[str] = None,
+        sort: Optional[str] = None,
+        trends=None,
+        anomalous: bool = False,
+    ) -> None:
+        """
+        Initializes a new instance of the InstanceTableView class.
+
+        Args:
+            index (InstanceIndex): The index to render rows from.
+            console (Console): The console the view is rendered on, used for its height.
+            service (str, optional): Only show instances of this service.
+            status (str, optional): Only show instances with this status.
+            sort (str, optional): The column to sort instances by.
+            trends (TrendTracker, optional): If given, the trend columns are shown.
+            anomalous (bool): Only show the instances the trends report as anomalous.
+        """
+        if anomalous and trends is None:
+            raise ValueError("anomalous instances can only be shown with trends")
+
+        self._index = index
+        self._trends = trends
+        self._anomalous = anomalous
+        self._console = console
+        self._service = service
+        self._status = status
+        self._sort = sort
+        self.offset = 0
+        self.search: Optional[str] = None
+        self._search_input: Optional[str] = None
+        self.closed = False
+
+    @property
+    def page_size(self) -> int:
+        return max(self._console.size.height - _CHROME_HEIGHT, 1)
+
+    def _ips(self):
+        return self._trends.anomalous if self._anomalous else None
+
+    def _total(self) -> int:
+        return self._index.count(
+            service=self._service, status=self._status, search=self.search, ips=self._ips()
+        )
+
+    def _clamp(self, total: int) -> None:
+        self.offset = max(min(self.offset, total - self.page_size), 0)
+
+    def handle_key(self, key: Optional[str]) -> bool:
+        """
+        Applies a key press to the view.
+
+        Args:
+            key (str): The key, as returned by KeyReader.read.
+
+        Returns:
+            True if the view changed and must be repainted.
+        """
+        if key is None:
+            return False
+
+        if self._search_input is not None:
+            if key == KEY_ENTER:
+                self.search = self._search_input or None
+                self._search_input = None
+                self.offset = 0
+            elif key == KEY_ESCAPE:
+                self._search_input = None
+            elif key == KEY_BACKSPACE:
+                self._search_input = self._search_input[:-1]
+            elif len(key) == 1 and key.isprintable():
+                self._search_input += key
+            return True
+
+        page = self.page_size
+        moves = {
+            "j": 1,
+            KEY_DOWN: 1,
+            "k": -1,
+            KEY_UP: -1,
+            " ": page,
+            "f": page,
+            KEY_PAGE_DOWN: page,
+            "b": -page,
+            KEY_PAGE_UP: -page,
+        }
+
+        if key in moves:
+            self.offset += moves[key]
+        elif key in ("g", KEY_HOME):
+            self.offset = 0
+        elif key in ("G", KEY_END):
+            self.offset = self._total()
+        elif key == "/":
+            self._search_input = ""
+        elif key == KEY_ESCAPE and self.search:
+            self.search = None
+            self.offset = 0
+        elif key == "q":
+            self.closed = True
+        else:
+            return False
+
+        self._clamp(self._total())
+        return True
+
+    def render(self) -> Table:
+        """
+        Builds the table for the visible window of rows.
+
+        Returns:
+            A rich Table containing at most page_size rows.
+        """
+        total = self._total()
+        self._clamp(total)
+
+        rows = self._index.select(
+            service=self._service,
+            status=self._status,
+            sort=self._sort,
+            limit=self.page_size,
+            offset=self.offset,
+            search=self.search,
+            ips=self._ips(),
+        )
+
+        if self._search_input is not None:
+            caption = f"/{self._search_input}"
+        else:
+            first = self.offset + 1 if rows else 0
+            caption = f"{first}-{self.offset + len(rows)} of {total}"
+            if self.search:
+                caption += f" matching '{self.search}'"
+            caption += "  (j/k scroll, space/b page, / search, q quit)"
+
+        if self._trends is None:
+            return rich_table("Instance Statistics", self._index.columns, rows, caption=caption)
+
+        cells = self._trends.cells
+        rows = [list(row) + cells(row[0]) for row in rows]
+        return rich_table("Instance Statistics", self._index.columns + TREND_COLUMNS, rows, caption=caption)
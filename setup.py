@@ -117,6 +117,10 @@ setup(
         )
     ),
     install_requires=INSTALL_REQUIREMENTS,
+    extras_require={
+        "fast": ["orjson"],
+        "zstd": ["zstandard"],
+    },
     setup_requires=SETUP_REQUIREMENTS,
     tests_require=TEST_REQUIREMENTS,
     test_suite="tests",
@@ -0,0 +1,86 @@
+import pytest
+from click.testing import CliRunner
+
+from cpx_health_monitor import logic
+from cpx_health_monitor.classmodules import CPXMonitor
+from tests.cpx_server import Fleet, StandInServer
+
+
+@pytest.fixture(scope='session')
+def cpx_server():
+    """
+    A stand-in CPX API with the default fleet, on an ephemeral port, shared by the session.
+    """
+    with StandInServer() as server:
+        yield server
+
+
+@pytest.fixture
+def cpx_server_factory():
+    """
+    Starts stand-in CPX APIs with custom fleets, e.g. cpx_server_factory(size=1000, latency=0.01),
+    stopped at the end of the test.
+    """
+    servers = []
+
+    def start(size=150, latency=0, churn=0, seed=None, **fleet):
+        server = StandInServer(Fleet(size=size, latency=latency, seed=seed, **fleet), churn=churn)
+        servers.append(server.start())
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+
+
+@pytest.fixture
+def cpx_monitor_factory(cpx_server):
+    """
+    Creates CPXMonitor instances polling a stand-in CPX API, the shared one by default,
+    closed at the end of the test.
+    """
+    monitors = []
+
+    def create(server=None, **kwargs):
+        monitor = CPXMonitor(port=(server or cpx_server).port, **kwargs)
+        monitors.append(monitor)
+        return monitor
+
+    yield create
+    for monitor in monitors:
+        monitor.close()
+
+
+@pytest.fixture
+def cpx_monitor(cpx_monitor_factory):
+    return cpx_monitor_factory()
+
+
+@pytest.fixture
+def inject_monitor(cpx_server):
+    """
+    Binds the cpxstat commands to a monitor, and unbinds them at the end of the test.
+    Watch commands sweep without waiting; bound them with --count.
+    Nothing is persisted between tests: the state file is disabled.
+    """
+
+    def inject(cpx_monitor=None, **monitor_config):
+        overrides = {'monitor': dict(
+            {'port': cpx_server.port, 'poll_interval': 0, 'memory': {'state_file': None}}, **monitor_config
+        )}
+        logic.configure(overrides=overrides, cpx_monitor=cpx_monitor)
+        return logic.cpx
+
+    yield inject
+    if logic.cpx is not None:
+        logic.cpx.close()
+    logic.config = logic.cpx = logic.printer = None
+
+
+@pytest.fixture
+def runner(inject_monitor):
+    """
+    A CLI runner for the cpxstat commands, bound to the shared stand-in CPX API.
+    """
+    inject_monitor()
+    return CliRunner()
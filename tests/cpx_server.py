@@ -6,12 +6,19 @@ import json
 import random
 import re
 import socket
-from typing import Dict
+import threading
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
 from http.server import HTTPServer, SimpleHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
 
 NUM_SERVERS = 150
-SERVER_SET = set(['10.58.1.%d' % i for i in range(1, NUM_SERVERS + 1)])
-IP_REGEX = r'/10\.58\.1\.[0-9]{1,3}$'
+IP_REGEX = r'/10\.58\.[0-9]{1,3}\.[0-9]{1,3}$'
+
+# Membership changes kept for clients listing the servers that changed since
+# the version they last saw (/servers?since=<version>).
+MAX_MEMBERSHIP_LOG = 1000
 SERVICES = [
     'PermissionsService',
     'AuthService',
@@ -27,58 +34,196 @@ SERVICES = [
 ]
 
 
-def _server_stats(ip: str) -> Dict[str, str]:
-    ip_u = ip.encode('utf-8')
-    service_idx = int(hashlib.md5(ip_u).hexdigest(), 16) % len(SERVICES)
-    service_name = SERVICES[service_idx]
-    return {
-        'cpu': '%d%%' % random.randint(0, 100),
-        'memory': '%d%%' % random.randint(0, 100),
-        'service': service_name
-    }
-
-
-class HTTPServerV6(HTTPServer):
+def _ip(i: int) -> str:
+    return '10.58.%d.%d' % (1 + i // 254, 1 + i % 254)
+
+
+class Fleet:
+    """
+    The servers of a stand-in CPX API, their membership history and their statistics.
+
+    The servers are the first `size` addresses of a pool of 10.58.x.y addresses
+    (10.58.1.1 to 10.58.1.150 by default); churn replaces them with other addresses
+    of the pool.
+    """
+
+    def __init__(self, size: int = NUM_SERVERS, services: Sequence[str] = SERVICES,
+                 latency: float = 0, seed: Optional[int] = None) -> None:
+        self.pool = [_ip(i) for i in range(max(254, 2 * size))]
+        self.servers = set(self.pool[:size])
+        self.services = list(services)
+        # Seconds each instance takes to respond.
+        self.latency = latency
+        self.version = 1
+        self.membership_log: List[Tuple[int, str, bool]] = []
+        self.lock = threading.Lock()
+        self._random = random.Random(seed)
+
+    def stats(self, ip: str) -> Dict[str, str]:
+        ip_u = ip.encode('utf-8')
+        service_idx = int(hashlib.md5(ip_u).hexdigest(), 16) % len(self.services)
+        return {
+            'cpu': '%d%%' % self._random.randint(0, 100),
+            'memory': '%d%%' % self._random.randint(0, 100),
+            'service': self.services[service_idx]
+        }
+
+    def replace(self, removed: Optional[str] = None, added: Optional[str] = None) -> None:
+        with self.lock:
+            if removed is None:
+                removed = self._random.choice(sorted(self.servers))
+            if added is None:
+                added = self._random.choice(sorted(set(self.pool) - self.servers))
+            self.servers.remove(removed)
+            self.servers.add(added)
+            self.version += 1
+            self.membership_log.append((self.version, removed, False))
+            self.membership_log.append((self.version, added, True))
+            del self.membership_log[:-MAX_MEMBERSHIP_LOG]
+
+    def churn(self, interval: float, stop: Optional[threading.Event] = None) -> None:
+        stop = stop or threading.Event()
+        while not stop.wait(interval):
+            self.replace()
+
+    def servers_since(self, since: int):
+        with self.lock:
+            if since >= self.version:
+                return {'version': self.version, 'added': [], 'removed': []}
+            if not self.membership_log or self.membership_log[0][0] > since + 1:
+                return {'version': self.version, 'reset': True, 'servers': list(self.servers)}
+
+            changes = {}
+            for version, ip, added in self.membership_log:
+                if version > since:
+                    changes[ip] = changes.get(ip, 0) + (1 if added else -1)
+            return {
+                'version': self.version,
+                'added': [ip for ip, change in changes.items() if change > 0],
+                'removed': [ip for ip, change in changes.items() if change < 0],
+            }
+
+
+class CPXServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, fleet: Fleet, quiet: bool = False) -> None:
+        super().__init__(address, CPXHandler)
+        self.fleet = fleet
+        self.quiet = quiet
+
+
+class CPXServerV6(CPXServer):
     address_family = socket.AF_INET6
 
 
 class CPXHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
     def _invalid_endpoint(self):
         self.send_response(400)
         self.send_header("Content-type", "application/json")
         self.end_headers()
         self.wfile.write(bytes(json.dumps({'error': 'Invalid IP'}), 'utf-8'))
 
-    def _json(self, data: str):
+    def _json(self, data: str, headers: Dict[str, str] = None):
         self.send_response(200)
         self.send_header("Content-type", "application/json")
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
         self.end_headers()
         self.wfile.write(bytes(json.dumps(data), 'utf-8'))
 
     def do_GET(self):
+        fleet: Fleet = self.server.fleet
+        url = urlparse(self.path)
         ip_match = re.match(IP_REGEX, self.path)
-        if self.path == '/servers':
-            self._json(list(SERVER_SET))
+        if url.path == '/servers':
+            query = parse_qs(url.query)
+            if 'since' in query:
+                try:
+                    since = int(query['since'][0])
+                except ValueError:
+                    self._invalid_endpoint()
+                    return
+                self._json(fleet.servers_since(since))
+            else:
+                with fleet.lock:
+                    servers, version = list(fleet.servers), fleet.version
+                self._json(servers, {'X-Servers-Version': str(version)})
         elif ip_match:
             ip = ip_match.group().replace('/', '')
-            if ip not in SERVER_SET:
+            if ip not in fleet.servers:
                 self._invalid_endpoint()
             else:
-                self._json(_server_stats(ip))
+                if fleet.latency:
+                    time.sleep(fleet.latency)
+                self._json(fleet.stats(ip))
         else:
             self._invalid_endpoint()
 
 
-def main(port: int, protocol: int):
+class StandInServer:
+    """
+    A stand-in CPX API running on background threads of the current process,
+    e.g. for tests and benchmarks:
+
+        with StandInServer(Fleet(size=1000)) as server:
+            monitor = CPXMonitor(port=server.port)
+    """
+
+    def __init__(self, fleet: Optional[Fleet] = None, port: int = 0, churn: float = 0) -> None:
+        self.fleet = fleet if fleet is not None else Fleet()
+        self._httpd = CPXServer(('127.0.0.1', port), self.fleet, quiet=True)
+        self._churn = churn
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+
+    @property
+    def port(self) -> int:
+        return self._httpd.server_address[1]
+
+    def start(self) -> 'StandInServer':
+        targets = [self._httpd.serve_forever]
+        if self._churn:
+            targets.append(lambda: self.fleet.churn(self._churn, self._stop))
+        for target in targets:
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def shutdown(self) -> None:
+        self._stop.set()
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def __enter__(self) -> 'StandInServer':
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.shutdown()
+
+
+def main(port: int, protocol: int, churn: float = 0, size: int = NUM_SERVERS, latency: float = 0):
+    fleet = Fleet(size=size, latency=latency)
+    if churn:
+        threading.Thread(target=fleet.churn, args=(churn,), daemon=True).start()
+
     if protocol == 6 and not socket.has_ipv6:
         print("Falling back to IPv4")
 
     if protocol == 6 and socket.has_ipv6:
-        httpd = HTTPServerV6(('::', port), CPXHandler)
+        httpd = CPXServerV6(('::', port), fleet)
         httpd.serve_forever()
 
     else:
-        httpd = HTTPServer(('0.0.0.0', port), CPXHandler)
+        httpd = CPXServer(('0.0.0.0', port), fleet)
         httpd.serve_forever()
 
 
@@ -87,6 +232,11 @@ if __name__ == '__main__':
     parser.add_argument("port", help="the port on which to run", type=int)
     parser.add_argument("--protocol", help="which IP version to use, 4 for IPv4, 6 for IPv6",
                         type=int, choices=[4, 6], default=6)
+    parser.add_argument("--churn", help="replace a random server every CHURN seconds",
+                        type=float, default=0)
+    parser.add_argument("--size", help="the number of servers", type=int, default=NUM_SERVERS)
+    parser.add_argument("--latency", help="seconds each server takes to respond",
+                        type=float, default=0)
     args = parser.parse_args()
 
-    main(args.port, args.protocol)
+    main(args.port, args.protocol, args.churn, args.size, args.latency)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Soak test: runs the watch loops of cpxstat against tests/cpx_server.py for a long time
+and checks that the resident memory of the process stays flat.
+
+    python tests/soak.py --duration 10800 --churn 0.5
+
+Prints one CSV line per sample (elapsed seconds, resident memory, fleet members,
+indexed instances) and exits with status 1 if the resident memory grew by more than
+--max-growth MiB between the first and the last samples after the warm-up.
+"""
+
+import argparse
+import gc
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from rich.console import Console
+
+from cpx_health_monitor.alerts import AlertEngine
+from cpx_health_monitor.classmodules import CPXMonitor, CPXMonitorPrinter
+from cpx_health_monitor.events import ChangeTracker
+from cpx_health_monitor.memory import resident_memory
+from cpx_health_monitor.view import InstanceTableView
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cpx_server.py')
+SEARCHES = [None, '10.58.1.1', 'auth', 'service', '10.58', 'ml', None]
+RULES = [
+    {'name': 'service-unhealthy', 'scope': 'service', 'metric': 'status', 'equals': 'Unhealthy'},
+    {'name': 'cpu-p95', 'metric': 'cpu', 'window': 10, 'percentile': 95, 'above': 90},
+]
+
+
+def _wait_for_server(monitor: CPXMonitor, timeout: float = 10) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            monitor.get_stats()
+            return
+        except Exception:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def soak(port: int, duration: float, interval: float, sample_every: float,
+         warmup: float, churn: float, concurrency: int) -> list:
+    server = subprocess.Popen(
+        [sys.executable, SERVER, str(port), '--protocol', '4', '--churn', str(churn)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    monitor = CPXMonitor(port=port, concurrency=concurrency, state_ttl=30)
+    printer = CPXMonitorPrinter(monitor, search_cache=4)
+    console = Console(file=open(os.devnull, 'w'), width=120, height=40)
+    view = InstanceTableView(printer.index, console, sort='cpu')
+    tracker = ChangeTracker()
+    engine = AlertEngine(RULES)
+    samples = []
+
+    try:
+        _wait_for_server(monitor)
+        started = time.monotonic()
+        next_sample = started
+        sweeps = 0
+        while True:
+            now = time.monotonic()
+            if now - started >= duration:
+                break
+
+            # The work of instances watch, services watch, instances events and alerts watch.
+            stats = monitor.get_stats()
+            printer.index.update(stats)
+            view.search = SEARCHES[sweeps % len(SEARCHES)]
+            console.print(view.render())
+            services = monitor.get_services(stats)
+            console.print(printer.render_services(services))
+            tracker.update(stats)
+            engine.evaluate(stats, services)
+            if sweeps % 10 == 0:
+                for estimates in monitor.iter_service_estimates(0.25):
+                    console.print(printer.render_services(estimates))
+            sweeps += 1
+
+            if now >= next_sample:
+                gc.collect()
+                elapsed = now - started
+                rss = resident_memory() or 0
+                samples.append((elapsed, rss))
+                print(f'{elapsed:.0f},{rss},{len(monitor.members)},{len(printer.index)}', flush=True)
+                next_sample += sample_every
+
+            time.sleep(max(interval - (time.monotonic() - now), 0))
+    finally:
+        monitor.close()
+        server.terminate()
+        server.wait()
+
+    return [rss for elapsed, rss in samples if elapsed >= warmup]
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8095, help='port of the stand-in CPX server')
+    parser.add_argument('--duration', type=float, default=3 * 3600, help='seconds to run for')
+    parser.add_argument('--interval', type=float, default=0.5, help='seconds between sweeps')
+    parser.add_argument('--sample-every', type=float, default=60, help='seconds between memory samples')
+    parser.add_argument('--warmup', type=float, default=300, help='seconds ignored before comparing samples')
+    parser.add_argument('--churn', type=float, default=0.5, help='replace a server every CHURN seconds')
+    parser.add_argument('--concurrency', type=int, default=8, help='instances queried in parallel')
+    parser.add_argument('--max-growth', type=float, default=8, help='allowed growth of the resident memory, in MiB')
+    args = parser.parse_args()
+
+    if resident_memory() is None:
+        print('resident memory is not available on this platform', file=sys.stderr)
+        return 2
+
+    print('elapsed,rss,members,indexed', flush=True)
+    samples = soak(args.port, args.duration, args.interval, args.sample_every,
+                   args.warmup, args.churn, args.concurrency)
+    if len(samples) < 4:
+        print('not enough samples after the warm-up, increase --duration', file=sys.stderr)
+        return 2
+
+    # Compare the median of the first and last quarters, to ignore allocator noise.
+    quarter = len(samples) // 4
+    growth = (statistics.median(samples[-quarter:]) - statistics.median(samples[:quarter])) / 2 ** 20
+    print(f'resident memory growth: {growth:.1f} MiB', file=sys.stderr)
+    return 1 if growth > args.max_growth else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,11 +1,31 @@
-import pytest
-from click.testing import CliRunner
-from cpx_health_monitor.main import instances, services
-
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
 
-@pytest.fixture
-def runner():
-    return CliRunner()
+import pytest
+import requests
+from cpx_health_monitor.api import AsyncMonitor, InstanceStats, Monitor, MonitorClosedError, ServiceStats
+from cpx_health_monitor.alerts import AlertEngine, InvalidAlertRuleError
+from cpx_health_monitor.classmodules import CPXMonitorPrinter, CPXMonitor, InstanceIndex, _decode_instance, _parse_percentage
+from cpx_health_monitor import config as config_module
+from cpx_health_monitor.config import InvalidConfigValueError, get_config, try_to_load_config
+from cpx_health_monitor.events import ChangeTracker
+from cpx_health_monitor.hedging import Hedger
+from cpx_health_monitor.logging import JsonLogRecordFormatter, LogRecordFormatter, QueueListenerHandler
+from cpx_health_monitor.memory import LRUCache, StateFile, memory_report
+from cpx_health_monitor.metrics import InvalidMetricError, Metric, MetricSchema
+from cpx_health_monitor.main import instances, services, snapshot
+from cpx_health_monitor.ratelimit import (
+    PRIORITY_INTERACTIVE, PRIORITY_SWEEP, FileTokenBucket, RateLimitTimeoutError, TokenBucket)
+from cpx_health_monitor.serve import MonitorServer
+from cpx_health_monitor.snapshot import InvalidSnapshotError, SnapshotFile, save_snapshot
+from cpx_health_monitor.trends import ANOMALY_CPU, ANOMALY_LEAK, TrendTracker
+from cpx_health_monitor.replay import ReplayExhaustedError, ReplayMonitor, SweepLog, SweepRecorder
+from cpx_health_monitor.view import InstanceTableView
+from rich.console import Console
 
 
 def test_instances_list(runner):
@@ -47,43 +67,720 @@ def test_services_show(runner):
     assert result.exit_code == 0
 
 
-""" 
+def test_instances_list_with_sort_and_top(runner):
+    result = runner.invoke(instances, ['list', '--sort', 'cpu', '--top', '5'])
+    assert result.exit_code == 0
+    assert "Instance" in result.output
+
+
+def _index_stats():
+    return [
+        {'10.58.1.1': {'cpu': '9%', 'memory': '50%', 'service': 'AuthService', 'status': 'Healthy'}},
+        {'10.58.1.2': {'cpu': '42%', 'memory': '90%', 'service': 'MLService', 'status': 'Unhealthy'}},
+        {'10.58.1.3': {'cpu': '100%', 'memory': '10%', 'service': 'AuthService', 'status': 'Unhealthy'}},
+    ]
+
+
+def test_instance_index_sorts_percentages_numerically():
+    index = InstanceIndex()
+    index.update(_index_stats())
+    assert [row[0] for row in index.select(sort='cpu')] == [
+        '10.58.1.3', '10.58.1.2', '10.58.1.1']
+    assert [row[0] for row in index.select(top=1)] == ['10.58.1.3']
+
+
+def test_instance_index_filters_and_drops_missing_instances():
+    index = InstanceIndex()
+    index.update(_index_stats())
+    assert [row[0] for row in index.select(service='authservice', status='UNHEALTHY')] == [
+        '10.58.1.3']
+    index.update(_index_stats()[:2])
+    assert len(index) == 2
+    assert index.select(service='AuthService', status='Unhealthy') == []
+
+
+def _large_index(size):
+    index = InstanceIndex()
+    index.update([
+        {'10.58.%d.%d' % (i // 256, i % 256): {
+            'cpu': '%d%%' % (i % 101), 'memory': '1%',
+            'service': 'AuthService' if i % 2 else 'MLService', 'status': 'Healthy'}}
+        for i in range(size)
+    ])
+    return index
+
+
+def test_instance_table_view_renders_visible_window_only():
+    console = Console(width=120, height=17)
+    view = InstanceTableView(_large_index(1000), console)
+    assert view.render().row_count == view.page_size == 10
+    view.handle_key(' ')
+    assert view.offset == 10
+    view.handle_key('G')
+    assert view.offset == 990
+    assert view.render().row_count == 10
+
+
+def test_instance_table_view_search():
+    console = Console(width=120, height=17)
+    view = InstanceTableView(_large_index(1000), console)
+    for key in ['/', 'm', 'l', 'enter']:
+        view.handle_key(key)
+    assert view.search == 'ml'
+    table = view.render()
+    assert '1-10 of 500' in table.caption
+
+
 def test_instances_watch(runner):
-    result = runner.invoke(instances, ['watch'])
+    result = runner.invoke(instances, ['watch', '--count', '2'])
     assert result.exit_code == 0
-"""
+    assert "Instance" in result.output
 
 
-""" 
 def test_instances_watch_with_service(runner):
-    result = runner.invoke(instances, ['watch', '--service', 'GeoService'])
+    result = runner.invoke(instances, ['watch', '--service', 'GeoService', '--top', '5', '--count', '2'])
     assert result.exit_code == 0
-"""
+    assert "GeoService" in result.output
 
 
-""" 
 def test_instances_watch_with_status(runner):
-    result = runner.invoke(instances, ['watch', '--status', 'unhealthy'])
+    result = runner.invoke(instances, ['watch', '--status', 'unhealthy', '--count', '2'])
     assert result.exit_code == 0
-"""
+    assert "Unhealthy" in result.output
 
 
-""" 
 def test_instances_show(runner):
-    result = runner.invoke(instances, ['instances', 'show', 'INSTANCE_NAME'])
+    result = runner.invoke(instances, ['show', '10.58.1.1'])
     assert result.exit_code == 0
-"""
+    assert "10.58.1.1" in result.output
 
 
-""" 
 def test_services_watch(runner):
-    result = runner.invoke(services, ['watch'])
+    result = runner.invoke(services, ['watch', '--count', '2'])
     assert result.exit_code == 0
-"""
+    assert "Service" in result.output
 
 
-""" 
 def test_services_watch_with_service(runner):
-    result = runner.invoke(services, ['watch', 'UserService'])
+    result = runner.invoke(services, ['watch', 'UserService', '--sample', '0.5', '--count', '3'])
     assert result.exit_code == 0
-"""
+    assert "Service Statistics (estimated)" in result.output
+
+
+def test_record_and_replay(tmp_path):
+    path = str(tmp_path / 'sweeps.log')
+    responses = {
+        '10.58.1.1': {'cpu': '90%', 'memory': '10%', 'service': 'AuthService'},
+        '10.58.1.2': {'cpu': '10%', 'memory': '10%', 'service': 'AuthService'},
+    }
+    with SweepRecorder(path) as recorder:
+        recorder.record(list(responses), responses, timestamp=1.0)
+        recorder.record(['10.58.1.2'], responses, timestamp=2.0)
+
+    log = SweepLog(path)
+    assert len(log) == 2
+    assert log[1].instances == ['10.58.1.2']
+
+    monitor = ReplayMonitor(log, speed=0)
+    first = monitor.get_stats()
+    assert first[0]['10.58.1.1']['status'] == 'Unhealthy'
+    assert len(monitor.get_stats()) == 1
+    with pytest.raises(ReplayExhaustedError):
+        monitor.get_stats()
+
+    config = get_config(overrides={'monitor': {'health': {'cpu': 95}}})
+    monitor = ReplayMonitor.from_config(config['monitor'], log, speed=0)
+    assert monitor.get_stats()[0]['10.58.1.1']['status'] == 'Healthy'
+
+
+def test_decode_instance_shares_strings():
+    first = _decode_instance(b'{"cpu": "42%", "memory": "7%", "service": "AuthService"}')
+    second = _decode_instance(b'{"cpu": "42%", "memory": "7%", "service": "AuthService"}')
+    assert first == {'cpu': '42%', 'memory': '7%', 'service': 'AuthService'}
+    assert first['service'] is second['service']
+    assert first['cpu'] is second['cpu']
+    assert _parse_percentage(first['cpu']) == 42
+    assert _parse_percentage('150%') == 150
+
+
+def test_alert_engine_fires_once_and_resolves():
+    received = []
+    engine = AlertEngine([
+        {'name': 'hot', 'metric': 'cpu', 'above': 80},
+        {'name': 'very-hot', 'metric': 'cpu', 'above': 95, 'for': 2},
+        {'name': 'service-down', 'scope': 'service', 'metric': 'status', 'equals': 'unhealthy'},
+    ], sinks=[received.append])
+
+    def sweep(cpu):
+        return [{'10.58.1.1': {'cpu': cpu, 'memory': '1%', 'service': 'AuthService', 'status': 'Healthy'}}]
+
+    assert [(a.rule, a.state) for a in engine.evaluate(sweep('99%'))] == [('hot', 'firing')]
+    assert [(a.rule, a.state) for a in engine.evaluate(sweep('99%'))] == [('very-hot', 'firing')]
+    assert [(a.rule, a.state) for a in engine.evaluate(sweep('90%'))] == [('very-hot', 'resolved')]
+    assert [(a.rule, a.state) for a in engine.evaluate(sweep('10%'))] == [('hot', 'resolved')]
+    services = [{'AuthService': {'status': 'Unhealthy'}}]
+    assert [a.key for a in engine.evaluate([], services)] == ['AuthService']
+    assert len(received) == 5
+
+
+def test_alert_engine_percentile_window():
+    engine = AlertEngine([
+        {'name': 'p50', 'metric': 'memory', 'window': 3, 'percentile': 50, 'above': 50},
+    ])
+    alerts = []
+    for memory in ('90%', '10%', '90%'):
+        alerts += engine.evaluate(
+            [{'10.58.1.1': {'cpu': '1%', 'memory': memory, 'service': 'AuthService', 'status': 'Healthy'}}])
+    assert [(a.state, a.value) for a in alerts] == [('firing', 90), ('resolved', None), ('firing', 90)]
+
+
+def test_alert_engine_rejects_invalid_rules():
+    with pytest.raises(InvalidAlertRuleError):
+        AlertEngine([{'name': 'bad', 'metric': 'status', 'above': 1}])
+
+
+def _env_vars(mapping):
+    for value in mapping.values():
+        if isinstance(value, dict):
+            yield from _env_vars(value)
+        else:
+            yield value
+
+
+@pytest.fixture
+def config_env(monkeypatch):
+    """
+    Isolates config tests from CPX_HEALTH_MONITOR_* variables exported by the developer,
+    and from configs cached by other tests.
+    """
+    for name in _env_vars(config_module._CONFIG_ENV_VARS_MAP):
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setattr(config_module, '_CONFIG_CACHE', {})
+
+
+def test_config_layers_file_env_and_overrides(tmp_path, monkeypatch, config_env):
+    path = tmp_path / 'config.yaml'
+    path.write_text('monitor:\n  port: 9000\n  concurrency: 4\n  health:\n    cpu: 90\n')
+    monkeypatch.setenv('CPX_HEALTH_MONITOR_CONCURRENCY', '16')
+    config = try_to_load_config(str(path), overrides={'monitor': {'host': 'cpx.local'}})
+    assert config['monitor']['port'] == 9000
+    assert config['monitor']['concurrency'] == 16
+    assert config['monitor']['host'] == 'cpx.local'
+    assert config['monitor']['health'] == {'cpu': 90, 'memory': 80, 'unhealthy_instances': 2}
+
+
+def test_config_is_validated_and_cached(monkeypatch, config_env):
+    with pytest.raises(InvalidConfigValueError):
+        try_to_load_config(overrides={'monitor': {'concurrency': 0}})
+    monkeypatch.setenv('CPX_HEALTH_MONITOR_PORT', 'http')
+    with pytest.raises(InvalidConfigValueError):
+        try_to_load_config()
+    monkeypatch.delenv('CPX_HEALTH_MONITOR_PORT')
+    assert get_config(overrides={'monitor': {'timeout': 1}}) is get_config(
+        overrides={'monitor': {'timeout': 1}})
+
+
+def test_log_record_formatter_caches_per_second():
+    formatter = LogRecordFormatter(datefmt='%Y-%m-%d %H:%M:%S.%f %z %%f')
+    record = logging.makeLogRecord({'created': 1676937600.25, 'msecs': 250})
+    assert formatter.formatTime(record, formatter.datefmt) == '2023-02-21 00:00:00.250000 +0000 %f'
+    record = logging.makeLogRecord({'created': 1676937600.5, 'msecs': 500})
+    assert formatter.formatTime(record, formatter.datefmt) == '2023-02-21 00:00:00.500000 +0000 %f'
+    assert formatter.formatTime(record) == '2023-02-21 00:00:00,500'
+
+
+def test_queue_listener_handler_formats_json_in_background():
+    records = []
+    target = logging.Handler()
+    target.setFormatter(JsonLogRecordFormatter())
+    target.emit = lambda record: records.append(target.format(record))
+    handler = QueueListenerHandler([target])
+    logger = logging.getLogger('cpx_health_monitor.tests.queue')
+    logger.addHandler(handler)
+    logger.propagate = False
+    try:
+        logger.warning('hello %s', 'world')
+        try:
+            1 / 0
+        except ZeroDivisionError:
+            logger.exception('sweep %d failed', 3)
+    finally:
+        logger.removeHandler(handler)
+        handler.close()
+    assert json.loads(records[0])['message'] == 'hello world'
+    failed = json.loads(records[1])
+    assert failed['message'] == 'sweep 3 failed'
+    assert 'ZeroDivisionError' in failed['exc_info'] and 'Traceback' in failed['exc_info']
+
+
+def test_change_tracker_reports_keyed_changes():
+    def snapshot(**instances):
+        return [
+            {ip: {'cpu': cpu, 'memory': '50%', 'service': 'AuthService',
+                  'status': 'Unhealthy' if int(cpu[:-1]) >= 80 else 'Healthy'}}
+            for ip, cpu in instances.items()
+        ]
+
+    tracker = ChangeTracker(cpu_delta=10)
+    assert tracker.update(snapshot(a='10%', b='10%')) == []
+    assert tracker.update(snapshot(a='15%', b='10%')) == []
+    events = tracker.update(snapshot(a='21%', c='10%'))
+    assert sorted((e.kind, e.instance) for e in events) == [
+        ('added', 'c'), ('cpu', 'a'), ('removed', 'b')]
+    assert [(e.old, e.new) for e in events if e.kind == 'cpu'] == [(10, 21)]
+    events = tracker.update(snapshot(a='85%', c='10%'))
+    assert sorted(e.kind for e in events) == ['cpu', 'status']
+
+
+class _FakeResponse:
+    def __init__(self, data, headers=None):
+        self._data = data
+        self.headers = headers or {}
+        self.status_code = 200
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self._data
+
+
+class _FakeServersSession:
+    def __init__(self, responses):
+        self.responses = responses
+        self.params = []
+
+    def get(self, url, params=None, timeout=None):
+        self.params.append(params)
+        return self.responses.pop(0)
+
+
+def test_monitor_tracks_membership_deltas():
+    monitor = CPXMonitor()
+    monitor._session = _FakeServersSession([
+        _FakeResponse(['10.58.1.1', '10.58.1.2'], {'X-Servers-Version': '3'}),
+        _FakeResponse({'version': 4, 'added': ['10.58.1.3'], 'removed': ['10.58.1.1']}),
+        _FakeResponse({'version': 9, 'reset': True, 'servers': ['10.58.1.3', '10.58.1.4']}),
+    ])
+    changes = []
+    monitor.add_membership_listener(lambda added, removed: changes.append((added, removed)))
+
+    assert monitor._get_instances() == ['10.58.1.1', '10.58.1.2']
+    state = monitor.members['10.58.1.2']
+    assert monitor._get_instances() == ['10.58.1.2', '10.58.1.3']
+    assert monitor.members['10.58.1.2'] is state
+    assert monitor._get_instances() == ['10.58.1.3', '10.58.1.4']
+    assert monitor._session.params == [None, {'since': '3'}, {'since': '4'}]
+    assert changes[1:] == [(['10.58.1.3'], ['10.58.1.1']), (['10.58.1.4'], ['10.58.1.2'])]
+
+
+def test_token_bucket_bounds_rate():
+    bucket = TokenBucket(rate=50, burst=5)
+    started = time.monotonic()
+    for _ in range(10):
+        bucket.acquire()
+    assert time.monotonic() - started >= 0.09
+    bucket = TokenBucket(rate=0.1, burst=1)
+    bucket.acquire()
+    with pytest.raises(RateLimitTimeoutError):
+        bucket.acquire(timeout=0)
+
+
+def test_token_bucket_serves_interactive_requests_first():
+    bucket = TokenBucket(rate=20, burst=1)
+    bucket.acquire()
+    order = []
+    sweep = threading.Thread(target=lambda: (bucket.acquire(PRIORITY_SWEEP), order.append('sweep')))
+    sweep.start()
+    time.sleep(0.01)
+    bucket.acquire(PRIORITY_INTERACTIVE)
+    order.append('interactive')
+    sweep.join()
+    assert order == ['interactive', 'sweep']
+
+
+def test_file_token_bucket_is_shared(tmp_path):
+    path = str(tmp_path / 'ratelimit.lock')
+    first, second = FileTokenBucket(path, rate=1, burst=2), FileTokenBucket(path, rate=1, burst=2)
+    first.acquire()
+    second.acquire()
+    with pytest.raises(RateLimitTimeoutError):
+        first.acquire(timeout=0.05)
+
+
+def test_monitor_close_releases_the_rate_limiter_lock_file(tmp_path, monkeypatch):
+    rate_limiter = FileTokenBucket(str(tmp_path / 'ratelimit.lock'), rate=10)
+    closed = []
+    monkeypatch.setattr(os, 'close', closed.append)
+    fd = rate_limiter._fd
+    CPXMonitor(rate_limiter=rate_limiter).close()
+    assert closed == [fd] and rate_limiter._fd is None
+    monkeypatch.undo()
+    os.close(fd)
+
+
+class _FleetMonitor(CPXMonitor):
+    def __init__(self, fleet, **kwargs):
+        super().__init__(**kwargs)
+        self.fleet = fleet
+        self.polled = []
+        self.priorities = set()
+
+    def _get_instances(self):
+        self._replace_members(list(self.fleet))
+        return list(self.fleet)
+
+    def _get_stat(self, instance_ip, priority=None):
+        self.polled.append(instance_ip)
+        self.priorities.add(priority)
+        return dict(self.fleet[instance_ip])
+
+
+def test_get_services_new_is_a_deprecated_alias():
+    fleet = {
+        '10.58.1.1': {'service': 'AuthService', 'cpu': '90%', 'memory': '10%'},
+        '10.58.1.2': {'service': 'MLService', 'cpu': '10%', 'memory': '30%'},
+    }
+    monitor = _FleetMonitor(fleet)
+    stats = monitor.get_stats()
+    with pytest.warns(DeprecationWarning):
+        assert monitor.get_services_new('MLService', stats) == [
+            item for item in monitor.get_services(stats) if 'MLService' in item
+        ]
+
+
+def test_service_estimates_refine_to_exact_statistics():
+    fleet = {
+        f'10.58.{i // 100}.{i % 100}': {
+            'service': 'AuthService' if i < 200 else 'MLService',
+            'cpu': f'{i % 50}%',
+            'memory': f'{(i * 7) % 90}%',
+        }
+        for i in range(210)
+    }
+    monitor = _FleetMonitor(fleet)
+    exact = monitor.get_services(monitor.get_stats())
+    monitor.polled.clear()
+
+    rounds = list(monitor.iter_service_estimates(0.25, min_per_service=5, seed=1))
+    first = dict(item for stats in rounds[0] for item in stats.items())
+    # Every service is sampled, small ones at least min_per_service times.
+    assert first['AuthService']['sampled_instances'] == 50
+    assert first['MLService']['sampled_instances'] == 5
+    assert first['AuthService']['total_instances'] == 200
+    assert first['AuthService']['estimated'] and first['AuthService']['cpu_margin'] > 0
+    assert len(rounds) == 4 and len(monitor.polled) == len(fleet) == len(set(monitor.polled))
+    last = dict(item for stats in rounds[-1] for item in stats.items())
+    for stats in exact:
+        for name, expected in stats.items():
+            assert {key: last[name][key] for key in expected} == expected
+            assert not last[name]['estimated']
+
+
+def test_lru_cache_evicts_least_recently_used_and_expired_entries(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(time, 'monotonic', lambda: now[0])
+    cache = LRUCache(2, ttl=10)
+    cache['a'] = 1
+    cache['b'] = 2
+    assert cache.get('a') == 1
+    cache['c'] = 3
+    assert 'b' not in cache and len(cache) == 2 and cache.evictions == 1
+    now[0] += 11
+    assert cache.get('a') is None and cache.expire() == 1 and len(cache) == 0
+
+
+def test_index_search_cache_is_bounded_and_invalidated():
+    index = InstanceIndex(search_cache=2)
+    index.update(_index_stats())
+    for term in ('auth', 'ml', '10.58'):
+        index.count(search=term)
+    assert len(index.search_cache) == 2
+    index.update([{'10.58.1.9': {'service': 'AuthService', 'cpu': '1%', 'memory': '1%', 'status': 'Healthy'}}], replace=False)
+    assert len(index.search_cache) == 0
+    assert [row[0] for row in index.select(search='auth')] == ['10.58.1.1', '10.58.1.3', '10.58.1.9']
+
+    shared = ['x' * 1000]
+    usage = memory_report({'first': (shared, 1, None), 'second': ({'k': shared}, 1, 4)})
+    assert usage[0].size > 1000 and usage[1].size < 1000 and usage[1].budget == 4
+
+
+def test_monitor_api_returns_typed_results():
+    fleet = {
+        '10.58.1.1': {'service': 'AuthService', 'cpu': '90%', 'memory': '10%'},
+        '10.58.1.2': {'service': 'AuthService', 'cpu': '10%', 'memory': '30%'},
+    }
+    with Monitor(_FleetMonitor(fleet)) as monitor:
+        snapshot = monitor.snapshot()
+        assert snapshot.instances == [
+            InstanceStats('10.58.1.1', 'AuthService', 90, 10, 'Unhealthy'),
+            InstanceStats('10.58.1.2', 'AuthService', 10, 30, 'Healthy'),
+        ]
+        assert snapshot.services == [ServiceStats('AuthService', 50, 20, 'Healthy', 2, 1, 1)]
+        assert monitor.instance('10.58.1.2').healthy
+        assert [i.ip for i in monitor.instances(status='unhealthy')] == ['10.58.1.1']
+    assert monitor.closed
+    with pytest.raises(MonitorClosedError):
+        monitor.snapshot()
+
+
+def test_async_monitor_polls_live_api(cpx_server):
+    async def poll():
+        async with AsyncMonitor(port=cpx_server.port) as monitor:
+            snapshots = [snapshot async for snapshot in monitor.watch(interval=0, count=2)]
+            return snapshots, await monitor.services()
+
+    snapshots, services = asyncio.run(poll())
+    assert len(snapshots) == 2 and all(isinstance(i, InstanceStats) for i in snapshots[0].instances)
+    assert sum(service.total_instances for service in services) > 0
+
+
+def test_monitor_server_serves_cached_snapshot():
+    fleet = {
+        '10.58.1.1': {'service': 'AuthService', 'cpu': '90%', 'memory': '10%'},
+        '10.58.1.2': {'service': 'Auth"Service', 'cpu': '10%', 'memory': '30%'},
+    }
+    monitor = _FleetMonitor(fleet)
+    with MonitorServer(monitor, port=0, interval=60) as server:
+        assert server.wait_ready(5)
+        url = 'http://%s:%d' % server.address
+        responses = [requests.get(url + '/instances') for _ in range(5)]
+        assert len(monitor.polled) == len(fleet)
+        assert responses[0].json()['instances'][0] == {
+            'ip': '10.58.1.1', 'service': 'AuthService', 'cpu': 90, 'memory': 10, 'status': 'Unhealthy', 'extra': {}
+        }
+        etag = responses[0].headers['ETag']
+        assert requests.get(url + '/instances', headers={'If-None-Match': etag}).status_code == 304
+        metrics = requests.get(url + '/metrics').text
+        assert 'cpx_instance_cpu_usage_percent{instance="10.58.1.1",service="AuthService"} 90' in metrics
+        assert 'cpx_service_healthy{service="Auth\\"Service"} 1' in metrics
+        assert requests.get(url + '/healthz').status_code == 200
+        assert requests.get(url + '/nope').status_code == 404
+
+
+def test_monitor_server_counts_failed_sweeps_in_metrics(monkeypatch):
+    monitor = _FleetMonitor({'10.58.1.1': {'service': 'AuthService', 'cpu': '90%', 'memory': '10%'}})
+    server = MonitorServer(monitor, port=0, interval=60)
+    try:
+        server.sweep()
+        assert b'cpx_sweep_errors_total 0\n' in server.responses['/metrics'].body
+
+        def fail():
+            raise requests.ConnectionError('CPX API down')
+
+        monkeypatch.setattr(monitor, 'get_stats', fail)
+        server.sweep()
+        server.sweep()
+        assert b'cpx_sweep_errors_total 2\n' in server.responses['/metrics'].body
+        assert server.snapshot is not None and server.sweeps == 1
+    finally:
+        server.shutdown()
+
+
+def test_trend_tracker_detects_spikes_and_leaks():
+    tracker = TrendTracker(alpha=0.2, z_threshold=3, warmup=5, growth_sweeps=6, growth_min=10)
+
+    def sweep(i, cpu, memory):
+        tracker.update([
+            {'10.58.1.1': {'service': 'AuthService', 'cpu': f'{cpu}%', 'memory': '40%'}},
+            {'10.58.1.2': {'service': 'MLService', 'cpu': '20%', 'memory': f'{memory}%'}},
+        ], timestamp=i * 60.0)
+
+    for i in range(10):
+        sweep(i, 30 + i % 2, 50 - i % 2)
+    assert tracker.get('10.58.1.1').anomalies == () and not tracker.anomalous
+    sweep(10, 95, 49)
+    assert tracker.get('10.58.1.1').anomalies == (ANOMALY_CPU,)
+    assert tracker.anomalous == {'10.58.1.1'}
+
+    for i in range(11, 20):
+        sweep(i, 30, 49 + 2 * (i - 10))
+    trend = tracker.get('10.58.1.2')
+    assert ANOMALY_LEAK in trend.anomalies and trend.memory_growth == 9
+    assert trend.memory_slope > 1
+
+    fleet = {
+        '10.58.1.1': {'service': 'AuthService', 'cpu': '30%', 'memory': '40%'},
+        '10.58.1.2': {'service': 'MLService', 'cpu': '20%', 'memory': '69%'},
+    }
+    printed = []
+    printer = CPXMonitorPrinter(
+        _FleetMonitor(fleet),
+        renderer=lambda title, columns, rows: printed.append((columns, rows)),
+        trends=tracker,
+    )
+    printer.get_stats(anomalous=True)
+    columns, rows = printed[0]
+    assert [name for name, _ in columns][-1] == 'Anomaly'
+    assert [(row[0], row[-1]) for row in rows] == [('10.58.1.2', ANOMALY_LEAK)]
+
+
+def test_hedger_duplicates_slow_requests_within_budget():
+    hedger = Hedger(percentile=90, budget=0.1, min_samples=10, min_delay=0.01)
+    calls = []
+
+    def request():
+        calls.append(None)
+        # The first attempt of the 11th request hangs, its duplicate responds at once.
+        if len(calls) == 11:
+            time.sleep(1)
+        return len(calls)
+
+    assert [hedger.call(request) for _ in range(10)] == list(range(1, 11))
+    assert hedger.threshold == 0.01
+    started = time.monotonic()
+    assert hedger.call(request) == 12
+    assert time.monotonic() - started < 0.5
+    assert hedger.stats()['fired'] == hedger.stats()['won'] == 1
+
+    # The budget of one duplicate per 10 requests is spent.
+    calls.clear()
+    assert hedger.call(request) == 1 and hedger.call(lambda: time.sleep(0.05) or 'slow') == 'slow'
+    assert hedger.stats()['skipped'] == 1 and hedger.fired == 1
+    hedger.close()
+
+
+def test_concurrent_sweeps_overlap_slow_instances(cpx_server_factory, cpx_monitor_factory):
+    server = cpx_server_factory(size=40, latency=0.02)
+    durations = []
+    for concurrency in (1, 8):
+        monitor = cpx_monitor_factory(server, concurrency=concurrency)
+        started = time.monotonic()
+        assert len(monitor.get_stats()) == 40
+        durations.append(time.monotonic() - started)
+    assert durations[1] * 3 < durations[0]
+
+
+@pytest.mark.parametrize('compression', ['none', 'gzip'])
+def test_snapshot_round_trip(tmp_path, compression):
+    stats = _index_stats() + [
+        {'cpx-host-1': {'cpu': '55%', 'memory': '0%', 'service': 'MLService', 'status': 'Healthy'}},
+    ]
+    services = [{'AuthService': {'cpu': '54%', 'memory': '30%', 'status': 'Healthy', 'total_instances': 2}}]
+    path = str(tmp_path / 'fleet.snap')
+    save_snapshot(path, stats, services, timestamp=1.5, compression=compression)
+
+    index = InstanceIndex()
+    index.update(stats)
+    with SnapshotFile(path) as loaded:
+        assert (len(loaded), loaded.timestamp, loaded.services) == (4, 1.5, services)
+        assert sorted(loaded.stats(), key=lambda i: list(i)) == sorted(stats, key=lambda i: list(i))
+        for query in [{}, {'sort': 'cpu', 'top': 2}, {'service': 'authservice', 'sort': 'memory'},
+                      {'status': 'unhealthy', 'sort': 'service', 'limit': 1}]:
+            assert loaded.select(**query) == index.select(**query)
+
+    with open(path, 'r+b') as f:
+        f.write(b'garbage!')
+    with pytest.raises(InvalidSnapshotError):
+        SnapshotFile(path)
+
+
+def test_snapshot_commands(runner, tmp_path):
+    path = str(tmp_path / 'fleet.snap')
+    result = runner.invoke(snapshot, ['save', path])
+    assert result.exit_code == 0 and 'Saved' in result.output
+    result = runner.invoke(snapshot, ['load', path])
+    assert result.exit_code == 0 and 'Service Statistics' in result.output
+    result = runner.invoke(instances, ['list', '--from-snapshot', path, '--top', '3'])
+    assert result.exit_code == 0 and result.output.count('10.58.1.') == 3
+
+
+def test_service_drill_down_only_queries_the_service(tmp_path):
+    fleet = {
+        '10.58.1.%d' % i: {'service': 'AuthService' if i % 3 else 'MLService', 'cpu': '%d%%' % (i * 9), 'memory': '20%'}
+        for i in range(1, 10)
+    }
+    state_file = StateFile(str(tmp_path / 'cache' / 'state.json'), ttl=300)
+    monitor = _FleetMonitor(fleet, state_file=state_file)
+    printed = []
+    printer = CPXMonitorPrinter(monitor, renderer=lambda title, columns, rows: printed.append((title, rows)))
+
+    printer.get_service('mlservice', worst=2)
+    assert len(monitor.polled) == 9 and monitor.priorities == {PRIORITY_INTERACTIVE}
+    (_, [service]), (_, percentiles), (title, worst) = printed
+    assert service[:4] == ['MLService', '54%', '20%', 'Healthy']
+    assert percentiles[0] == ['CPU Usage', '54%', '81%', '81%', '81%']
+    assert title == 'Worst 2 Instances' and [row[0] for row in worst] == ['10.58.1.9', '10.58.1.6']
+
+    monitor.polled.clear()
+    printer.get_service('MLService')
+    assert sorted(monitor.polled) == ['10.58.1.3', '10.58.1.6', '10.58.1.9']
+    monitor.polled.clear()
+    assert printer.get_service('MLService', max_age=60) and monitor.polled == []
+    assert printer.get_service('NoService', max_age=60) == []
+
+    # A new run only queries the instances of the service, and those that joined since.
+    fleet['10.58.1.10'] = {'service': 'MLService', 'cpu': '5%', 'memory': '5%'}
+    monitor = _FleetMonitor(fleet, state_file=state_file)
+    printer = CPXMonitorPrinter(monitor, renderer=lambda title, columns, rows: None)
+    assert len(printer.get_service('MLService')) == 3
+    assert sorted(monitor.polled) == ['10.58.1.10', '10.58.1.3', '10.58.1.6', '10.58.1.9']
+    # The statistics it saved are reused by the next run, within max_age.
+    monitor = _FleetMonitor(fleet, state_file=state_file)
+    stats = monitor.get_service_stats('MLService', max_age=60)
+    assert monitor.polled == [] and len(stats) == 4
+
+    # States older than state_ttl are dropped, and so are files written for another CPX API.
+    assert StateFile(state_file.file_path, ttl=0).load(monitor._endpoint) == {}
+    assert state_file.load('http://elsewhere:8085') == {}
+    with open(state_file.file_path, 'w') as f:
+        f.write('{not json')
+    assert state_file.load(monitor._endpoint) == {}
+
+
+def test_metric_schema_drives_health_aggregation_and_rendering():
+    fleet = {
+        '10.58.1.1': {'service': 'AuthService', 'cpu': '10%', 'memory': '10%', 'latency': '12.5ms', 'conns': 10},
+        '10.58.1.2': {'service': 'AuthService', 'cpu': '10%', 'memory': '10%', 'latency': '900ms', 'conns': '30'},
+        '10.58.1.3': {'service': 'AuthService', 'cpu': '10%', 'memory': '10%'},
+    }
+    schema = MetricSchema.from_config({'metrics': [
+        {'name': 'latency', 'type': 'number', 'unit': 'ms', 'unhealthy_from': 500, 'aggregate': 'max'},
+        {'name': 'connections', 'field': 'conns', 'type': 'integer', 'aggregate': 'sum'},
+    ]})
+    monitor = _FleetMonitor(fleet, metrics=schema.extra)
+    stats = monitor.get_stats()
+    assert [s[ip]['status'] for s in stats for ip in s] == ['Healthy', 'Unhealthy', 'Healthy']
+    [services] = monitor.get_services(stats)
+    assert services['AuthService']['latency'] == '900.0ms' and services['AuthService']['connections'] == '40'
+    assert services['AuthService']['cpu'] == '10%' and services['AuthService']['unhealthy_instances'] == 1
+
+    printed = []
+    printer = CPXMonitorPrinter(monitor, renderer=lambda title, columns, rows: printed.append((columns, rows)))
+    printer.get_stats()
+    columns, rows = printed[-1]
+    assert [name for name, _ in columns[-2:]] == ['Latency', 'Connections']
+    assert list(rows[1][-2:]) == ['900ms', '30'] and list(rows[2][-2:]) == ['', '']
+    printer.get_services(stats)
+    columns, [row] = printed[-1]
+    assert row[-2:] == ['900.0ms', '40']
+
+    engine = AlertEngine([{'name': 'slow', 'metric': 'latency', 'above': 100}], metrics=monitor.metrics)
+    assert [alert.key for alert in engine.evaluate(stats)] == ['10.58.1.2']
+    with pytest.raises(InvalidAlertRuleError):
+        AlertEngine([{'name': 'slow', 'metric': 'latency', 'above': 100}])
+    with pytest.raises(InvalidMetricError):
+        Metric.from_config({'name': 'cpu'})
+
+
+def test_declared_metrics_reach_snapshots_and_prometheus():
+    fleet = {
+        '10.58.1.1': {'service': 'AuthService', 'cpu': '10%', 'memory': '10%', 'latency': '12.5ms'},
+        '10.58.1.2': {'service': 'AuthService', 'cpu': '10%', 'memory': '10%', 'latency': '20ms'},
+    }
+    schema = MetricSchema.from_config({'metrics': [{'name': 'latency', 'unit': 'ms', 'aggregate': 'max'}]})
+    monitor = _FleetMonitor(fleet, metrics=schema.extra)
+    with Monitor(monitor) as api_monitor:
+        snapshot = api_monitor.snapshot()
+    assert [i.extra for i in snapshot.instances] == [{'latency': 12.5}, {'latency': 20.0}]
+    assert snapshot.services[0].extra == {'latency': 20.0}
+
+    server = MonitorServer(_FleetMonitor(fleet, metrics=schema.extra), port=0, interval=60)
+    try:
+        server.sweep()
+        metrics = server.responses['/metrics'].body.decode('utf-8')
+        assert 'cpx_instance_latency{instance="10.58.1.2",service="AuthService"} 20.0' in metrics
+        assert 'cpx_service_latency{service="AuthService"} 20.0' in metrics
+        assert json.loads(server.responses['/instances'].body)['instances'][0]['extra'] == {'latency': 12.5}
+    finally:
+        server.shutdown()